@@ -5,6 +5,7 @@
 import numpy as np
 from pyqtgraph.Qt import QtCore, QtGui
 import subprocess
+import os, shutil, signal, threading, time
 import pyqtgraph as pg
 from pyqtgraph.dockarea import *
 from pyqtgraph.parametertree import Parameter, ParameterTree
@@ -73,7 +74,6 @@ class CrystalIndexing(object):
         self.indexedPeaks = None
         self.hiddenCXI = '.temp.cxi'
         self.hiddenCrystfelStream = '.temp.stream'
-        self.hiddenCrystfelList = '.temp.lst'
         self.indexingOn = False
         self.numIndexedPeaksFound = 0
         self.geom = '.temp.geom'
@@ -86,8 +86,7 @@ class CrystalIndexing(object):
         self.condition = ''
         self.keepData = True
         self.indexCounter = 0
-        self.threadpool = []
-        self.workerpool = []
+        self.service = None
 
         #######################
         # Mandatory parameter #
@@ -314,37 +313,19 @@ class CrystalIndexing(object):
                     self.parent.index.clearIndexedPeaks()
                     self.parent.index.displayWaiting()
 
-                    # Write list of files to index
-                    with open(self.parent.index.hiddenCrystfelList, "w") as text_file:
-                        text_file.write("{} //0".format(self.parent.index.hiddenCXI))
-
                     # Generate a static mask of bad pixels for indexing
                     self.parent.mk.saveCheetahStaticMask()
 
-                    # Step 2: Create a QThread object
-
-                    thread = QtCore.QThread()
-                    self.threadpool.append(thread)
-                    # Step 3: Create a worker object
-                    worker = IndexWorker()
-                    self.workerpool.append(worker)
-                    self.workerpool[-1].setup(self.indexCounter, self.parent.index.hiddenCrystfelList, self.geom, self.peakMethod,
-                                      self.intRadius, self.pdb, self.indexingMethod,
-                                      self.parent.index.hiddenCrystfelStream, self.extra,
-                                      self.parent.runNumber, self.parent.eventNumber, self.tolerance, self.outDir)
-                    # Step 4: Move worker to the thread
-                    self.workerpool[-1].moveToThread(self.threadpool[-1])
-                    # Step 5: Connect signals and slots
-                    self.threadpool[-1].started.connect(self.workerpool[-1].run)
-                    self.workerpool[-1].finished.connect(self.threadpool[-1].quit)
-                    self.workerpool[-1].finished.connect(self.workerpool[-1].deleteLater)
-                    self.threadpool[-1].finished.connect(self.threadpool[-1].deleteLater)
-                    self.workerpool[-1].progress.connect(self.reportProgress)
-                    # Step 6: Start the thread
-                    self.threadpool[-1].start()
-
-                    # Final resets
-                    self.workerpool[-1].finished.connect(self.reportResults)
+                    # Hand the event to the long-lived indexamajig, started on first use or when settings change
+                    if self.service is None:
+                        self.service = IndexingService(self.parent.index.hiddenCrystfelStream, self.parent.args.v)
+                        self.service.indexed.connect(self.reportResults)
+                        self.service.start()
+                        QtGui.QApplication.instance().aboutToQuit.connect(self.service.stop)
+                    self.service.configure(self.geom, self.peakMethod, self.intRadius, self.pdb, self.indexingMethod,
+                                           self.extra, self.tolerance,
+                                           self.outDir + "/r" + str(self.parent.runNumber).zfill(4))
+                    self.service.submit(self.indexCounter, self.parent.eventNumber, self.parent.index.hiddenCXI)
         else:
             # do not display predicted spots
             self.parent.index.clearIndexedPeaks()
@@ -383,8 +364,9 @@ class CrystalIndexing(object):
         if self.showIndexedPeaks:
             if self.numIndexedPeaksFound == 0:  # indexing proceeding
                 xMargin = 5  # pixels
-                maxX = np.max(self.parent.det.indexes_x(self.parent.evt)) + xMargin
-                maxY = np.max(self.parent.det.indexes_y(self.parent.evt))
+                with self.parent.img.psanaLock:
+                    maxX = np.max(self.parent.det.indexes_x(self.parent.evt)) + xMargin
+                    maxY = np.max(self.parent.det.indexes_y(self.parent.evt))
                 # Draw a big triangle
                 cenX = np.array((self.parent.cx,)) + 0.5
                 cenY = np.array((self.parent.cy,)) + 0.5
@@ -416,8 +398,9 @@ class CrystalIndexing(object):
                 if unitCell is not None:
                     xMargin = 0#5
                     yMargin = self.parent.data.shape[1]#400
-                    maxX   = np.max(self.parent.det.indexes_x(self.parent.evt)) + xMargin
-                    maxY   = np.max(self.parent.det.indexes_y(self.parent.evt)) - yMargin
+                    with self.parent.img.psanaLock:
+                        maxX   = np.max(self.parent.det.indexes_x(self.parent.evt)) + xMargin
+                        maxY   = np.max(self.parent.det.indexes_y(self.parent.evt)) - yMargin
                     myMessage = '<div style="text-align: center"><span style="color: #FF00FF; font-size: 12pt;">lattice='+\
                                str(latticeType) +'<br>centering=' + str(centering) + '<br></span></div>'
                     self.parent.img.abc_text = pg.TextItem(html=myMessage, anchor=(0,0))
@@ -448,19 +431,7 @@ class CrystalIndexing(object):
         self.parent.img.win.getView().addItem(self.parent.img.abc_text)
         self.parent.img.abc_text.setPos(0, 0)
 
-    def getSuccessStr(self):
-        # Check indexamajig version
-        cmd = 'indexamajig --version'
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        out, err = process.communicate()
-        (major,minor,patch) = str(out).split('\\n')[0].split(': ')[-1].split('.')
-        if int(major) == 0 and int(minor) < 8:
-            mySuccessString = "1 had crystals" # changed from crystfel v0.8
-        else:
-            mySuccessString = "1 crystals"
-        return mySuccessString
-
-    def reportResults(self, id, eventNumber, out, err):
+    def reportResults(self, id, eventNumber, indexed, err):
 
         if 'command not found' in err:
             print("######################################################################")
@@ -469,10 +440,8 @@ class CrystalIndexing(object):
             print("######################################################################")
 
         if self.indexCounter == id: # only report results if id matches current index counter
-            mySuccessString = self.getSuccessStr()
-
             # Read CrystFEL geometry in stream
-            if mySuccessString in err:  # success
+            if indexed:  # success
                 if self.parent.args.v >= 1: print("Indexing successful!")
                 # Munging geometry file
                 f = open(self.parent.index.hiddenCrystfelStream)
@@ -557,7 +526,7 @@ class CrystalIndexing(object):
                     self.drawIndexedPeaks()
 
             # Read CrystFEL indexed peaks
-            if mySuccessString in str(err):  # success
+            if indexed:  # success
                 with open(self.parent.index.hiddenCrystfelStream) as f:
                     content = f.readlines()
                     for i, val in enumerate(content):
@@ -643,41 +612,151 @@ class CrystalIndexing(object):
         else:
             print("stale indexing results: ", self.indexCounter , id)
 
-class IndexWorker(QtCore.QObject):
-    finished = QtCore.pyqtSignal([int, int, str,str])
-    progress = QtCore.pyqtSignal(int)
-
-    def setup(self, id, hiddenCrystfelList, geom, peakMethod, intRadius, pdb, indexingMethod, hiddenCrystfelStream, extra,
-            runNumber, eventNumber, tolerance, outDir):
-        self.id = id
-        self.hiddenCrystfelList = hiddenCrystfelList
-        self.geom = geom
-        self.peakMethod = peakMethod
-        self.intRadius = intRadius
-        self.pdb = pdb
-        self.indexingMethod = indexingMethod
+class IndexingService(QtCore.QThread):
+    """
+    One long-lived indexamajig reading the files to index from stdin, so that process startup and geometry
+    parsing are paid once rather than per event. Only the most recent request waits to be indexed, older
+    pending ones are dropped. Each result is written as a single event stream (header and chunk) to
+    hiddenCrystfelStream before the indexed signal is emitted. An event whose chunk has not appeared
+    after timeout seconds is reported as not indexed and indexamajig is killed, to be restarted on the
+    next request.
+    """
+    indexed = QtCore.pyqtSignal([int, int, bool, str])
+
+    def __init__(self, hiddenCrystfelStream, verbose=0, timeout=60., parent=None):
+        QtCore.QThread.__init__(self, parent)
         self.hiddenCrystfelStream = hiddenCrystfelStream
-        self.extra = extra
-        self.runNumber = runNumber
-        self.eventNumber = eventNumber
-        self.tolerance = tolerance
-        self.outDir = outDir
-
-    def run(self):
-        cmd = "indexamajig -j 1 -i " + self.hiddenCrystfelList + " -g " + self.geom + " --peaks=" + self.peakMethod + \
-              " --int-radius=" + self.intRadius + " --indexing=" + self.indexingMethod + \
-              " -o " + self.hiddenCrystfelStream + " --temp-dir=" + self.outDir + "/r" + str(self.runNumber).zfill(4) + \
-              " --tolerance=" + str(self.tolerance)
-        if self.pdb: cmd += " --pdb=" + self.pdb
-        if self.extra:
-            _extra = self.extra.replace(",", " ")
+        self.serviceStream = hiddenCrystfelStream + '.service'
+        self.serviceLog = hiddenCrystfelStream + '.service.log'
+        self.verbose = verbose
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.config = None
+        self.request = None
+        self.stopped = False
+        self.process = None
+        self.processConfig = None
+        self.version = None
+
+    def configure(self, geom, peakMethod, intRadius, pdb, indexingMethod, extra, tolerance, tempDir):
+        """indexamajig is restarted before the next request when any of these change"""
+        with self.cond:
+            self.config = (geom, peakMethod, intRadius, pdb, indexingMethod, extra, tolerance, tempDir)
+
+    def submit(self, id, eventNumber, cxiFile):
+        # indexamajig reads the file after the gui may have moved on, give it its own copy
+        myFile = cxiFile[:-len('.cxi')] + '_' + str(id) + '.cxi'
+        shutil.copyfile(cxiFile, myFile)
+        with self.cond:
+            if self.request is not None: os.remove(self.request[2]) # superseded
+            self.request = (id, eventNumber, myFile)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.wait()
+
+    def startProcess(self, config):
+        self.stopProcess()
+        if self.version is None:
+            try:
+                out = subprocess.run(['indexamajig', '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     universal_newlines=True).stdout
+                self.version = out.split('\n')[0].split(': ')[-1]
+            except OSError:
+                self.version = 'unknown'
+            if self.verbose >= 1: print("indexamajig version: ", self.version)
+        (geom, peakMethod, intRadius, pdb, indexingMethod, extra, tolerance, tempDir) = config
+        cmd = "indexamajig -j 1 -i - -g " + geom + " --peaks=" + peakMethod + \
+              " --int-radius=" + intRadius + " --indexing=" + indexingMethod + \
+              " -o " + self.serviceStream + " --temp-dir=" + tempDir + \
+              " --tolerance=" + str(tolerance)
+        if pdb: cmd += " --pdb=" + pdb
+        if extra:
+            _extra = extra.replace(",", " ")
             cmd += " " + _extra
-
         print("cmd: ", cmd)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        out, err = process.communicate()
-        self.out = str(out)
-        self.err = str(err)
-
-        self.finished.emit(self.id, self.eventNumber, self.out, self.err)
+        if os.path.exists(self.serviceStream): os.remove(self.serviceStream)
+        self.log = open(self.serviceLog, 'w')
+        # own process group, so that a hung indexamajig can be killed along with its shell and workers
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.log, stderr=subprocess.STDOUT,
+                                        shell=True, universal_newlines=True, start_new_session=True)
+        self.processConfig = config
+        self.header = None
+        self.pending = ''
+        self.offset = 0
+
+    def stopProcess(self, kill=False):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            if kill or self.process.poll() is None:
+                try:
+                    os.killpg(self.process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+                except OSError:
+                    pass # already gone
+            self.process.wait()
+            self.log.close()
+            self.process = None
+
+    def readChunk(self, myFile, deadline):
+        """Block until the chunk of myFile appears in the stream, returns None if indexamajig exited
+        and raises TimeoutError once deadline (time.time()) has passed"""
+        while not self.stopped:
+            if os.path.exists(self.serviceStream):
+                with open(self.serviceStream) as f:
+                    f.seek(self.offset)
+                    newText = f.read()
+                    self.offset = f.tell()
+                self.pending += newText
+                if self.header is None and '----- Begin chunk -----' in self.pending:
+                    self.header, self.pending = self.pending.split('----- Begin chunk -----', 1)
+                    self.pending = '----- Begin chunk -----' + self.pending
+                while self.header is not None and '----- End chunk -----' in self.pending:
+                    chunk, self.pending = self.pending.split('----- End chunk -----', 1)
+                    chunk += '----- End chunk -----\n'
+                    if myFile in chunk: return chunk
+                if newText: continue
+            if self.process.poll() is not None: return None
+            if time.time() > deadline: raise TimeoutError
+            time.sleep(0.01)
+        return None
 
+    def run(self):
+        while True:
+            with self.cond:
+                while self.request is None and not self.stopped:
+                    self.cond.wait()
+                if self.stopped: break
+                (id, eventNumber, myFile), self.request = self.request, None
+                config = self.config
+            if self.process is None or self.process.poll() is not None or config != self.processConfig:
+                self.startProcess(config)
+            try:
+                self.process.stdin.write(myFile + ' //0\n')
+                self.process.stdin.flush()
+                chunk = self.readChunk(myFile, time.time() + self.timeout)
+            except TimeoutError:
+                print("indexamajig gave no result for event "+str(eventNumber)+" within "+str(self.timeout)+
+                      " s, restarting it")
+                self.stopProcess(kill=True)
+                if os.path.exists(myFile): os.remove(myFile)
+                self.indexed.emit(id, eventNumber, False, '')
+                continue
+            except (IOError, OSError):
+                chunk = None
+            if os.path.exists(myFile): os.remove(myFile)
+            if chunk is None:
+                self.stopProcess()
+                with open(self.serviceLog) as f: err = f.read()
+                self.indexed.emit(id, eventNumber, False, err)
+                continue
+            with open(self.hiddenCrystfelStream, 'w') as f:
+                f.write(self.header)
+                f.write(chunk)
+            self.indexed.emit(id, eventNumber, '--- Begin crystal' in chunk, '')
+        self.stopProcess()
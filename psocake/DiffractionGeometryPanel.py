@@ -8,7 +8,7 @@ from pyqtgraph.dockarea import *
 from pyqtgraph.parametertree import Parameter, ParameterTree
 from pyqtgraph.Qt import QtCore, QtGui
 import subprocess
-import scipy.spatial.distance as sd
+from scipy import ndimage
 import glob
 try:
     from PyQt5.QtWidgets import *
@@ -21,80 +21,149 @@ import PSCalib.GlobalUtils as gu
 from PSCalib.CalibFileFinder import deploy_calib_file
 from psocake.utils import highlight
 
-# Return two equal sized halves of the input image
-# If axis is None, halve along the first axis
-def getTwoHalves(I,centre,axis=None):
-    if axis is None or axis == 0:
-        A = I[:centre,:]
-        B = np.flipud(I[centre:,:])
-
-        (numRowUpper,_) = A.shape
-        (numRowLower,_) = B.shape
-        if numRowUpper >= numRowLower:
-            numRow = numRowLower
-            A = A[-numRow:,:]
-        else:
-            numRow = numRowUpper
-            B = B[-numRow:,:]
-    else:
-        A = I[:,:centre]
-        B = np.fliplr(I[:,centre:])
-
-        (_,numColLeft) = A.shape
-        (_,numColRight) = B.shape
-        if numColLeft >= numColRight:
-            numCol = numColRight
-            A = A[:,-numCol:]
-        else:
-            numCol = numColLeft
-            B = B[:,-numCol:]
-    return A, B
-
-def getScore(A,B):
-    ind = (A>0) & (B>0)
-    dist = sd.euclidean(A[ind].ravel(),B[ind].ravel())
-    numPix = len(ind[np.where(ind==True)])
-    return dist/numPix
+def downsample(I, factor):
+    """block mean of I, trailing rows and columns that do not fill a block are dropped"""
+    rows, cols = I.shape[0] // factor, I.shape[1] // factor
+    return I[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor).mean(axis=(1, 3))
 
-def findDetectorCentre(I,guessRow=None,guessCol=None,range=0):
+def getEdges(I, valid, percentile=90):
+    """
+    :param I: image
+    :param valid: boolean mask of usable pixels
+    :param percentile: keep gradients above this percentile of the valid pixels
+    :return: gradient magnitude of I, zero away from strong edges and next to masked pixels
+    """
+    I = ndimage.uniform_filter(np.where(valid, I, 0).astype(np.float32), 3)
+    mag = np.hypot(*np.gradient(I))
+    # Gaps and panel boundaries are not edges, drop every gradient that saw a masked pixel
+    valid = ndimage.uniform_filter(valid.astype(np.float32), 7) > 0.999
+    if not valid.any(): return np.zeros_like(mag)
+    mag[~valid] = 0
+    mag[mag < np.percentile(mag[valid], percentile)] = 0
+    return mag
+
+def searchWindow(guess, range, size):
+    """[start, end) of the centre search along an axis of length size"""
+    if guess is None: return 1, size # search everything
+    return max(1, int(guess - range)), min(size, int(guess + range))
+
+def findCoarseCentre(E, window0, window1):
+    """
+    Centre of point symmetry of the edge map E: the self-convolution sum_x E(x) E(k - x)
+    peaks at k = 2 * centre, computed with a single FFT
+    :param E: edge map
+    :param window0: [start, end) of the search along the first axis
+    :param window1: [start, end) of the search along the second axis
+    :return: centre in pixels of E
+    """
+    shape = [2 * n for n in E.shape] # no wrap around
+    F = np.fft.rfft2(E, shape)
+    C = np.fft.irfft2(F * F, shape)
+    C = C[2 * window0[0]:2 * window0[1], 2 * window1[0]:2 * window1[1]]
+    k0, k1 = np.unravel_index(np.argmax(C), C.shape)
+    return (k0 + 2 * window0[0]) / 2., (k1 + 2 * window1[0]) / 2.
+
+def findRings(profile, width):
+    """radii of the rings in a radial profile: local maxima standing out of the slowly varying background"""
+    residual = profile - ndimage.uniform_filter1d(profile, 10 * width + 1)
+    isPeak = (profile == ndimage.maximum_filter1d(profile, 4 * width + 1)) & \
+             (residual > residual.mean() + residual.std())
+    return np.nonzero(isPeak)[0]
+
+def nearestRing(rings, size):
+    """index of the nearest of the sorted ring radii for every integer radius below size"""
+    radius = np.arange(size)
+    nearest = np.clip(np.searchsorted(rings, radius), 1, len(rings)) - 1
+    nearest += np.abs(radius - rings[np.minimum(nearest + 1, len(rings) - 1)]) < np.abs(radius - rings[nearest])
+    return nearest
+
+def fitRingCentre(I, valid, centre, width, numSectors=64, numIter=3):
+    """
+    Least-squares fit of concentric circles to the ring maxima found in angular sectors of I
+    :param I: image
+    :param valid: boolean mask of usable pixels
+    :param centre: starting centre
+    :param width: half width in pixels of the radial band searched for each ring
+    :param numSectors: number of angular sectors
+    :param numIter: number of ring search and fit iterations
+    :return: centre
+    """
+    p0, p1 = np.nonzero(valid)
+    v = I[valid]
+    centre = np.asarray(centre, dtype=float)
+    r = np.hypot(p0 - centre[0], p1 - centre[1])
+    rbin = r.astype(int)
+    profile = np.bincount(rbin, weights=v) / np.maximum(np.bincount(rbin), 1)
+    rings = findRings(profile, width)
+    if len(rings) == 0: return centre
+    # Only pixels around the rings take part in the fit
+    ind = np.abs(np.arange(len(profile)) - rings[nearestRing(rings, len(profile))]) <= 3 * width
+    ind = ind[rbin]
+    p0, p1, v = p0[ind], p1[ind], v[ind]
+    band = 2 * width + 1
+    for _ in range(numIter):
+        d0, d1 = p0 - centre[0], p1 - centre[1]
+        r = np.hypot(d0, d1)
+        ring = nearestRing(rings, int(r.max()) + 1)[r.astype(int)]
+        offset = np.rint(r - rings[ring]).astype(int) + width # radial bin inside the ring band
+        sector = (((np.arctan2(d1, d0) + np.pi) / (2 * np.pi)) * numSectors).astype(int) % numSectors
+        ok = (offset >= 0) & (offset < band)
+        idx = (ring[ok] * numSectors + sector[ok]) * band + offset[ok]
+        size = len(rings) * numSectors * band
+        counts = np.bincount(idx, minlength=size).reshape(-1, band)
+        sums = np.bincount(idx, weights=v[ok], minlength=size).reshape(-1, band)
+        filled = (counts > 0).all(axis=1)
+        prof = sums[filled] / counts[filled]
+        if len(prof) < 3: break
+        # Sub-pixel ring maximum in every (ring, sector) with a parabola through the peak bin
+        k = np.clip(prof.argmax(axis=1), 1, band - 2)
+        y0, y1, y2 = [prof[np.arange(len(prof)), k + i] for i in (-1, 0, 1)]
+        curvature = y0 - 2 * y1 + y2
+        shift = np.where(curvature < 0, 0.5 * (y0 - y2) / np.where(curvature < 0, curvature, -1), 0)
+        ringSector = np.nonzero(filled)[0]
+        ringOf, sectorOf = ringSector // numSectors, ringSector % numSectors
+        radius = rings[ringOf] + k + np.clip(shift, -1, 1) - width
+        phi = (sectorOf + 0.5) / numSectors * 2 * np.pi - np.pi
+        x0, x1 = centre[0] + radius * np.cos(phi), centre[1] + radius * np.sin(phi)
+        w = np.maximum(y1 - prof.min(axis=1), 1e-6) # ring contrast
+        # |x|^2 = 2 c.x + (r_k^2 - |c|^2) for every ring k, the per ring constant drops out after
+        # subtracting the weighted ring means
+        norm = np.maximum(np.bincount(ringOf, weights=w, minlength=len(rings)), 1e-12)
+        demean = lambda a: a - (np.bincount(ringOf, weights=w * a, minlength=len(rings)) / norm)[ringOf]
+        A = 2 * np.column_stack((demean(x0), demean(x1)))
+        sw = np.sqrt(w)
+        centre = np.linalg.lstsq(A * sw[:, None], demean(x0 ** 2 + x1 ** 2) * sw, rcond=None)[0]
+        rings = np.rint(np.bincount(ringOf, weights=w * np.hypot(x0 - centre[0], x1 - centre[1]),
+                                    minlength=len(rings)) / norm).astype(int)
+    return centre
+
+def findDetectorCentre(I,guessRow=None,guessCol=None,range=0,factor=4):
     """
-    :param I: assembled image
-    :param guessRow: best guess for centre row position (optional)
-    :param guessCol: best guess for centre col position (optional)
+    Coarse-to-fine search for the centre of the powder rings: FFT point symmetry of the edge map of a
+    downsampled image, followed by a least-squares fit of concentric circles at full resolution
+    :param I: assembled image, pixels <= 0 or not finite are ignored
+    :param guessRow: best guess for centre position along the second axis (optional)
+    :param guessCol: best guess for centre position along the first axis (optional)
     :param range: range of pixels to search either side of the current guess of the centre
-    :return:
+    :param factor: downsampling factor of the coarse search
+    :return: centre along the first axis, centre along the second axis (sub-pixel)
     """
-    range = int(range)
-    # Search for optimum column centre
-    if guessCol is None:
-        startCol = 1 # search everything
-        endCol = I.shape[1]
-    else:
-        startCol = guessCol - range
-        if startCol < 1: startCol = 1
-        endCol = guessCol + range
-        if endCol > I.shape[1]: endCol = I.shape[1]
-    searchArray = np.arange(startCol,endCol)
-    scoreCol = np.zeros(searchArray.shape)
-    for i, centreCol in enumerate(searchArray):
-        A,B = getTwoHalves(I,centreCol,axis=0)
-        scoreCol[i] = getScore(A,B)
-    centreCol = searchArray[np.argmin(scoreCol)]
-    # Search for optimum row centre
-    if guessRow is None:
-        startRow = 1 # search everything
-        endRow = I.shape[0]
-    else:
-        startRow = guessRow - range
-        if startRow < 1: startRow = 1
-        endRow = guessRow + range
-        if endRow > I.shape[0]: endRow = I.shape[0]
-    searchArray = np.arange(startRow,endRow)
-    scoreRow = np.zeros(searchArray.shape)
-    for i, centreRow in enumerate(searchArray):
-        A,B = getTwoHalves(I,centreRow,axis=1)
-        scoreRow[i] = getScore(A,B)
-    centreRow = searchArray[np.argmin(scoreRow)]
+    I = np.asarray(I, dtype=np.float32)
+    valid = np.isfinite(I) & (I > 0)
+    I = np.where(valid, I, 0)
+    window0 = searchWindow(guessCol, range, I.shape[0])
+    window1 = searchWindow(guessRow, range, I.shape[1])
+    # Coarse search on the downsampled image
+    validSmall = downsample(valid.astype(float), factor) == 1
+    E = getEdges(downsample(I, factor), validSmall) > 0
+    c0, c1 = findCoarseCentre(E.astype(float),
+                              (window0[0] // factor, -(-window0[1] // factor)),
+                              (window1[0] // factor, -(-window1[1] // factor)))
+    centre = (c0 * factor + (factor - 1) / 2., c1 * factor + (factor - 1) / 2.)
+    # Refine on the full resolution image
+    centre = fitRingCentre(I, valid, centre, width=factor)
+    centreCol = np.clip(centre[0], window0[0], window0[1] - 1)
+    centreRow = np.clip(centre[1], window1[0], window1[1] - 1)
     return centreCol,centreRow
 
 class DiffractionGeometry(object):
@@ -213,8 +282,9 @@ class DiffractionGeometry(object):
 
     def findPsanaGeometry(self):
         try:
-            self.source = Detector.PyDetector.map_alias_to_source(self.parent.detInfo,
-                                                                  self.parent.exp.ds.env())  # 'DetInfo(CxiDs2.0:Cspad.0)'
+            with self.parent.img.psanaLock:
+                self.source = Detector.PyDetector.map_alias_to_source(self.parent.detInfo,
+                                                                      self.parent.exp.ds.env())  # 'DetInfo(CxiDs2.0:Cspad.0)'
             self.calibSource = self.source.split('(')[-1].split(')')[0]  # 'CxiDs2.0:Cspad.0'
             self.detectorType = gu.det_type_from_source(self.source)  # 1
             self.calibGroup = gu.dic_det_type_to_calib_group[self.detectorType]  # 'CsPad::CalibV1'
@@ -537,11 +607,12 @@ class DiffractionGeometry(object):
             # Calculate detector translation required in x and y
             dx = self.parent.pixelSize * 1e6 * (self.parent.roi.centreX - self.parent.cx)  # microns
             dy = self.parent.pixelSize * 1e6 * (self.parent.roi.centreY - self.parent.cy)  # microns
-            dz = np.mean(-self.parent.det.coords_z(self.parent.evt)) - self.parent.detectorDistance * 1e6 # microns
-            geo = self.parent.det.geometry(self.parent.evt)
-            top = geo.get_top_geo()
-            children = top.get_list_of_children()[0]
-            geo.move_geo(children.oname, 0, dx=-dy, dy=-dx, dz=dz)
+            with self.parent.img.psanaLock:
+                dz = np.mean(-self.parent.det.coords_z(self.parent.evt)) - self.parent.detectorDistance * 1e6 # microns
+                geo = self.parent.det.geometry(self.parent.evt)
+                top = geo.get_top_geo()
+                children = top.get_list_of_children()[0]
+                geo.move_geo(children.oname, 0, dx=-dy, dy=-dx, dz=dz)
             fname =  self.parent.psocakeRunDir + "/"+str(self.parent.runNumber)+'-end.data'
             geo.save_pars_in_file(fname)
             print("#################################################")
@@ -570,7 +641,8 @@ class DiffractionGeometry(object):
         with pg.BusyCursor():
             powderHits = np.load(self.parent.psocakeRunDir + '/' + self.parent.experimentName + '_' + str(self.parent.runNumber).zfill(4) + '_maxHits.npy')
             powderMisses = np.load(self.parent.psocakeRunDir + '/' + self.parent.experimentName + '_' + str(self.parent.runNumber).zfill(4) + '_maxMisses.npy')
-            powderImg = self.parent.det.image(self.parent.evt, np.maximum(powderHits,powderMisses))
+            with self.parent.img.psanaLock:
+                powderImg = self.parent.det.image(self.parent.evt, np.maximum(powderHits,powderMisses))
             centreRow, centreCol = findDetectorCentre(np.log(abs(powderImg)), self.parent.cx, self.parent.cy, range=200)
             print("Current centre along row,centre along column: ", self.parent.cx, self.parent.cy)
             print("Optimum centre along row,centre along column: ", centreRow, centreCol)
@@ -585,16 +657,18 @@ class DiffractionGeometry(object):
                 # Calculate detector translation in x and y
                 dx = self.parent.pixelSize * 1e6 * (self.parent.cx - centreRow)  # microns
                 dy = self.parent.pixelSize * 1e6 * (self.parent.cy - centreCol)  # microns
-                dz = np.mean(-self.parent.det.coords_z(self.parent.evt)) - self.parent.detectorDistance * 1e6  # microns
+                with self.parent.img.psanaLock:
+                    dz = np.mean(-self.parent.det.coords_z(self.parent.evt)) - self.parent.detectorDistance * 1e6  # microns
 
                 dx = self.parent.pixelSize * 1e6 * (self.parent.roi.centreX - self.parent.cx)  # microns
                 dy = self.parent.pixelSize * 1e6 * (self.parent.roi.centreY - self.parent.cy)  # microns
-                dz = np.mean(-self.parent.det.coords_z(self.parent.evt)) - self.parent.detectorDistance * 1e6  # microns
+                with self.parent.img.psanaLock:
+                    dz = np.mean(-self.parent.det.coords_z(self.parent.evt)) - self.parent.detectorDistance * 1e6  # microns
 
-                geo = self.parent.det.geometry(self.parent.evt)
-                top = geo.get_top_geo()
-                children = top.get_list_of_children()[0]
-                geo.move_geo(children.oname, 0, dx=-dy, dy=-dx, dz=dz)
+                    geo = self.parent.det.geometry(self.parent.evt)
+                    top = geo.get_top_geo()
+                    children = top.get_list_of_children()[0]
+                    geo.move_geo(children.oname, 0, dx=-dy, dy=-dx, dz=dz)
                 fname = self.parent.psocakeRunDir + "/" + str(self.parent.runNumber) + '-end.data'
                 geo.save_pars_in_file(fname)
                 print("#################################################")
@@ -46,6 +46,8 @@ class ExperimentInfo(object):
         self.eventTotal = 0
         self.run = None
         self.times = None
+        self.eventIndex = None
+        self.eventIndexSource = None
 
         self.disp_grp = 'Display'
         self.disp_log_str = 'Logscale'
@@ -238,6 +240,8 @@ class ExperimentInfo(object):
         self.secList = None
         self.nsecList = None
         self.fidList = None
+        self.eventIndex = None
+        self.eventIndexSource = None
 
     def setupRunTable(self):
         if logbook_present:
@@ -276,13 +280,14 @@ class ExperimentInfo(object):
 
             self.setupDetGeom()
             if self.parent.facility == self.parent.facilityLCLS:
-                try:
-                    self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
-                                                                               pix_scale_size_um=None,
-                                                                               xy0_off_pix=None,
-                                                                               cframe=gu.CFRAME_PSANA, fract=True)
-                except AttributeError:
-                    self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt)
+                with self.parent.img.psanaLock:
+                    try:
+                        self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
+                                                                                   pix_scale_size_um=None,
+                                                                                   xy0_off_pix=None,
+                                                                                   cframe=gu.CFRAME_PSANA, fract=True)
+                    except AttributeError:
+                        self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt)
             # update image
             self.getEventAndDisplay()
             # Indicate centre of detector
@@ -330,14 +335,15 @@ class ExperimentInfo(object):
 
                     self.setupDetGeom()
                     if self.parent.facility == self.parent.facilityLCLS:
-                        try:
-                            self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
-                                                                                       pix_scale_size_um=None,
-                                                                                       xy0_off_pix=None,
-                                                                                       cframe=gu.CFRAME_PSANA,
-                                                                                       fract=True)
-                        except AttributeError:
-                            self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt)
+                        with self.parent.img.psanaLock:
+                            try:
+                                self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
+                                                                                           pix_scale_size_um=None,
+                                                                                           xy0_off_pix=None,
+                                                                                           cframe=gu.CFRAME_PSANA,
+                                                                                           fract=True)
+                            except AttributeError:
+                                self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt)
                     # update image
                     self.getEventAndDisplay()
                     # Indicate centre of detector
@@ -378,13 +384,14 @@ class ExperimentInfo(object):
 
             self.setupDetGeom()
             if self.parent.facility == self.parent.facilityLCLS:
-                try:
-                    self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
-                                                                               pix_scale_size_um=None,
-                                                                               xy0_off_pix=None,
-                                                                               cframe=gu.CFRAME_PSANA, fract=True)
-                except AttributeError:
-                    self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt)
+                with self.parent.img.psanaLock:
+                    try:
+                        self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
+                                                                                   pix_scale_size_um=None,
+                                                                                   xy0_off_pix=None,
+                                                                                   cframe=gu.CFRAME_PSANA, fract=True)
+                    except AttributeError:
+                        self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt)
             # update image
             self.getEventAndDisplay()
             # Indicate centre of detector
@@ -395,8 +402,10 @@ class ExperimentInfo(object):
         if self.parent.args.v >= 1: print("Done updateDetInfo: ", self.parent.detInfo)
 
     def findEventFromTimestamp(self, secList, nsecList, fidList, sec, nsec, fid):
-        eventNumber = (np.where(secList == sec)[0] & np.where(nsecList == nsec)[0] & np.where(fidList == fid)[0])[0]
-        return eventNumber
+        if self.eventIndex is None or self.eventIndexSource is not secList: # rebuild for another run's lists
+            self.eventIndex = utils.EventIndex(secList, nsecList, fidList)
+            self.eventIndexSource = secList
+        return self.eventIndex.find(sec, nsec, fid)
 
     def convertTimestamp64(self, t):
         _sec = int(t) >> 32
@@ -410,7 +419,8 @@ class ExperimentInfo(object):
     def getEvt(self, evtNumber):
         if self.hasExpRunDetInfo():
             if self.parent.hasRunNumber:
-                _evt = self.run.event(self.times[evtNumber])
+                with self.parent.img.psanaLock:
+                    _evt = self.run.event(self.times[evtNumber])
                 return _evt
             else:
                 return None
@@ -418,7 +428,8 @@ class ExperimentInfo(object):
 
     def getEventID(self, evt):
         if evt is not None:
-            _evtid = evt.get(psana.EventId)
+            with self.parent.img.psanaLock:
+                _evtid = evt.get(psana.EventId)
             _seconds = _evtid.time()[0]
             _nanoseconds = _evtid.time()[1]
             _fiducials = _evtid.fiducials()
@@ -426,7 +437,8 @@ class ExperimentInfo(object):
 
     def getEventAndDisplay(self):
         # update timestamps and fiducial
-        self.parent.evt = self.getEvt(self.parent.eventNumber)
+        with self.parent.img.psanaLock:
+            self.parent.evt = self.getEvt(self.parent.eventNumber)
         if self.parent.evt is not None:
             sec, nanosec, fid = self.getEventID(self.parent.evt)
             self.eventSeconds = str(sec)
@@ -435,6 +447,7 @@ class ExperimentInfo(object):
             self.updateEventID(self.eventSeconds, self.eventNanoseconds, self.eventFiducial)
             self.p.param(self.exp_grp, self.exp_evt_str).setValue(self.parent.eventNumber)
             self.parent.img.updateImage()
+            self.parent.img.prefetchNeighbours(self.parent.eventNumber)
 
     def updateEventNumber(self, data):
         self.parent.eventNumber = data
@@ -556,7 +569,6 @@ class ExperimentInfo(object):
     def updateHiddenCrystfelFiles(self, arg):
         self.parent.index.hiddenCXI = self.parent.psocakeRunDir + '/.temp.cxi'
         self.parent.index.hiddenCrystfelStream = self.parent.psocakeRunDir + '/.temp.stream'
-        self.parent.index.hiddenCrystfelList = self.parent.psocakeRunDir + '/.temp.lst'
 
     def findGeometry(self):
         geomFiles = glob.glob(self.parent.rootDir + '/calib/' + self.parent.detInfo + '/geometry/*.geom')
@@ -573,7 +585,9 @@ class ExperimentInfo(object):
     def updateDetectorDistance(self, arg):
         if self.parent.detectorDistance < 0.01:
             try:
-                self.parent.detectorDistance = np.mean(-self.parent.det.coords_z(self.parent.evt)) * 1e-6  # metres
+                with self.parent.img.psanaLock:
+                    coordsZ = self.parent.det.coords_z(self.parent.evt)
+                self.parent.detectorDistance = np.mean(-coordsZ) * 1e-6  # metres
                 self.parent.geom.p1.param(self.parent.geom.geom_grp,
                                           self.parent.geom.geom_detectorDistance_str).setValue(
                     self.parent.detectorDistance * 1e3)  # mm
@@ -589,13 +603,15 @@ class ExperimentInfo(object):
             self.parent.detectorDistance, self.parent.clen, self.parent.coffset)
 
     def updatePixelSize(self, arg):
-        self.parent.pixelSize = self.parent.det.pixel_size(self.parent.runNumber) * 1e-6 # metres
+        with self.parent.img.psanaLock:
+            self.parent.pixelSize = self.parent.det.pixel_size(self.parent.runNumber) * 1e-6 # metres
         # Update geometry panel
         self.parent.geom.p1.param(self.parent.geom.geom_grp, self.parent.geom.geom_pixelSize_str).setValue(
                 self.parent.pixelSize)  # pixel size
 
     def updatePhotonEnergy(self, arg):
-        self.parent.ebeam = self.parent.evt.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
+        with self.parent.img.psanaLock:
+            self.parent.ebeam = self.parent.evt.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
         try:
             if self.parent.experimentName == 'mfxc00318':
                 wavelength = 0.1256 # namometre
@@ -695,8 +711,9 @@ class ExperimentInfo(object):
             self.parent.clen = 303.8794 / 1000. # metres
         else:
             for i in range(numEvt):  # assume at least 1 second run time
-                evt = self.run.event(self.times[i])
-                self.parent.clen = self.parent.epics.value(self.parent.clenEpics) / 1000. # metres
+                with self.parent.img.psanaLock: # the epics store follows the last fetched event
+                    evt = self.run.event(self.times[i])
+                    self.parent.clen = self.parent.epics.value(self.parent.clenEpics) / 1000. # metres
                 if i == 0:
                     _temp = self.parent.clen
                 elif i > 0:
@@ -760,7 +777,8 @@ class ExperimentInfo(object):
         if self.parent.facility == self.parent.facilityLCLS:
             if self.parent.args.localCalib:
                 if os.path.exists('calib'):
-                    psana.setOption('psana.calib-dir', './calib')
+                    with self.parent.img.psanaLock:
+                        psana.setOption('psana.calib-dir', './calib')
                     if self.parent.args.v >= 1: print("Using local calib directory")
                 else:
                     print("./calib directory does not exist in the present working directory")
@@ -772,10 +790,11 @@ class ExperimentInfo(object):
                 access = 'exp=' + str(self.parent.experimentName) + ':run=' + str(self.parent.runNumber) + ':idx'
                 if 'ffb' in self.parent.access: access += ':dir=/cds/data/drpsrcf/' + self.parent.experimentName[:3] + \
                                                           '/' + self.parent.experimentName + '/xtc'
-                self.ds = psana.DataSource(access)
-                self.run = next(self.ds.runs())
-                self.times = self.run.times()
-                self.env = self.ds.env()
+                with self.parent.img.psanaLock:
+                    self.ds = psana.DataSource(access)
+                    self.run = next(self.ds.runs())
+                    self.times = self.run.times()
+                    self.env = self.ds.env()
             except:
                 print("############# No such datasource exists ###############")
 
@@ -790,15 +809,16 @@ class ExperimentInfo(object):
     def printDetectorNames(self):
         # Print list of available detectors
         if self.parent.detInfoList is None:
-            self.parent.evt = self.run.event(self.times[-1])
-            myAreaDetectors = []
-            self.parent.detnames = psana.DetNames()
-            for k in self.parent.detnames:
-                try:
-                    if Detector.PyDetector.dettype(str(k[0]), self.env) == Detector.AreaDetector.AreaDetector:
-                        myAreaDetectors.append(k)
-                except ValueError:
-                    continue
+            with self.parent.img.psanaLock:
+                self.parent.evt = self.run.event(self.times[-1])
+                myAreaDetectors = []
+                self.parent.detnames = psana.DetNames()
+                for k in self.parent.detnames:
+                    try:
+                        if Detector.PyDetector.dettype(str(k[0]), self.env) == Detector.AreaDetector.AreaDetector:
+                            myAreaDetectors.append(k)
+                    except ValueError:
+                        continue
             self.parent.detInfoList = list(set(myAreaDetectors))
             print("#######################################")
             print("# Available area detectors: ")
@@ -813,25 +833,27 @@ class ExperimentInfo(object):
             self.crawlerRunning = True
 
     def setupDetGeom(self):
-        self.parent.det = psana.Detector(str(self.parent.detInfo), self.env)
-        self.parent.det.do_reshape_2d_to_3d(flag=True)
-        self.parent.detAlias = self.getDetectorAlias(str(self.parent.detInfo))
-        self.parent.epics = self.ds.env().epicsStore()
+        with self.parent.img.psanaLock:
+            self.parent.det = psana.Detector(str(self.parent.detInfo), self.env)
+            self.parent.det.do_reshape_2d_to_3d(flag=True)
+            self.parent.detAlias = self.getDetectorAlias(str(self.parent.detInfo))
+            self.parent.epics = self.ds.env().epicsStore()
         self.setClen()
         # Some detectors do not read out at 120 Hz. So need to loop over events to guarantee a valid detector image.
-        if self.parent.evt is None:
-            if self.parent.args.v >= 1: print("Evt is None")
-            self.parent.evt = self.run.event(self.times[0])
-        if self.parent.args.v >= 1: print("If stuck here, likely calib filesystem down")
-        self.detGuaranteed = self.parent.det.calib(self.parent.evt)
-        if self.detGuaranteed is None:  # image isn't present for this event
-            print("No image in this event. Searching for an event...")
-            for i in np.arange(len(self.times)):
-                evt = self.run.event(self.times[i])
-                self.detGuaranteed = self.parent.det.calib(evt)
-                if self.detGuaranteed is not None:
-                    print("Found an event with image: ", i, self.detGuaranteed.shape)
-                    break
+        with self.parent.img.psanaLock:
+            if self.parent.evt is None:
+                if self.parent.args.v >= 1: print("Evt is None")
+                self.parent.evt = self.run.event(self.times[0])
+            if self.parent.args.v >= 1: print("If stuck here, likely calib filesystem down")
+            self.detGuaranteed = self.parent.det.calib(self.parent.evt)
+            if self.detGuaranteed is None:  # image isn't present for this event
+                print("No image in this event. Searching for an event...")
+                for i in np.arange(len(self.times)):
+                    evt = self.run.event(self.times[i])
+                    self.detGuaranteed = self.parent.det.calib(evt)
+                    if self.detGuaranteed is not None:
+                        print("Found an event with image: ", i, self.detGuaranteed.shape)
+                        break
 
         # detector distance
         self.updateDetectorDistance(self.parent.facility)
@@ -846,7 +868,8 @@ class ExperimentInfo(object):
             self.parent.pixelIndAssem = self.parent.img.getAssembledImage(self.parent.facilityLCLS, self.parent.pixelInd)
             self.parent.pixelIndAssem -= 1  # First pixel is 0
             # Get detector shape
-            self.detGuaranteedData = self.parent.det.image(self.parent.evt, self.detGuaranteed)
+            with self.parent.img.psanaLock:
+                self.detGuaranteedData = self.parent.det.image(self.parent.evt, self.detGuaranteed)
 
         # Write a temporary geom file
         if self.parent.mode == "sfx":
@@ -877,16 +900,19 @@ class ExperimentInfo(object):
             # Launch e-log crawler
             self.setupCrawler()
         if self.hasExpRunDetInfo():
+            # Cached images belong to the previous detector, geometry or calibration
+            self.parent.img.clearImageCache()
             # Set up detector and geometry
             self.setupDetGeom()
             if self.parent.facility == self.parent.facilityLCLS:
-                try:
-                    self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
-                                                                               pix_scale_size_um=None,
-                                                                               xy0_off_pix=None,
-                                                                               cframe=gu.CFRAME_PSANA, fract=True)
-                except AttributeError:
-                    self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt)
+                with self.parent.img.psanaLock:
+                    try:
+                        self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
+                                                                                   pix_scale_size_um=None,
+                                                                                   xy0_off_pix=None,
+                                                                                   cframe=gu.CFRAME_PSANA, fract=True)
+                    except AttributeError:
+                        self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt)
             # update image
             self.getEventAndDisplay()
             # Indicate centre of detector
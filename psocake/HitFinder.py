@@ -1,9 +1,21 @@
 import numpy as np
+from numba import jit
 from psocake import myskbeam
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
 
+@jit(nopython=True, nogil=True)
+def maskAndCount(calib, mask, threshold):
+    """Multiply flat calib by mask in place and count the pixels above threshold, in a single pass"""
+    nPixels = 0
+    for i in range(calib.size):
+        val = calib[i] * mask[i]
+        calib[i] = val
+        if val > threshold:
+            nPixels += 1
+    return nPixels
+
 class HitFinder:
     def __init__(self,exp,run,detname,evt,detector,litPixelThreshold,
                  streakMask_on,streakMask_sigma,streakMask_width,userMask_path,psanaMask_on,psanaMask_calib,
@@ -55,7 +67,7 @@ class HitFinder:
         if self.psanaMask is not None:
             self.userPsanaMask *= self.psanaMask
 
-        # Powder of hits and misses
+        # Powder of hits and misses, in the detector dtype
         self.powderHits = np.zeros_like(self.userPsanaMask)
         self.powderMisses = np.zeros_like(self.userPsanaMask)
 
@@ -63,20 +75,29 @@ class HitFinder:
 
     def findHits(self, calib, evt):
         if self.streakMask_on: # make new streak mask
-            self.streakMask = self.StreakMask.getStreakMaskCalib(evt)
+            self.streakMask = self.StreakMask.getStreakMaskCalib(evt, calib)
         if self.streakMask is not None:
-            self.combinedMask = self.userPsanaMask * self.streakMask
+            if self.combinedMask is None or self.combinedMask is self.userPsanaMask:
+                self.combinedMask = np.empty_like(self.userPsanaMask)
+            np.multiply(self.userPsanaMask, self.streakMask, out=self.combinedMask)
         else:
             self.combinedMask = self.userPsanaMask
 
-        try:
-            calib *= self.combinedMask
-            self.nPixels = np.where(calib > self.litPixelThreshold)[0].shape[0]
-        except:
+        if calib.size != self.combinedMask.size: # frame does not match the mask
             self.nPixels = 0
+        else:
+            # a non-contiguous calib is masked in a contiguous copy, which is written back so that
+            # the caller's calib is masked in place either way
+            flat = calib.reshape(-1) if calib.flags.c_contiguous else np.ascontiguousarray(calib).reshape(-1)
+            try:
+                # mask and count lit pixels in one pass over the flat calib, no temporaries
+                self.nPixels = maskAndCount(flat, self.combinedMask.reshape(-1),
+                                            calib.dtype.type(self.litPixelThreshold))
+                if not calib.flags.c_contiguous: calib[...] = flat.reshape(calib.shape)
+            except:
+                self.nPixels = 0
 
         if self.nPixels >= self.hitThreshold:
-            self.powderHits = np.maximum(self.powderHits, calib)
+            np.maximum(self.powderHits, calib, out=self.powderHits)
         else:
-            self.powderMisses = np.maximum(self.powderMisses, calib)
-
+            np.maximum(self.powderMisses, calib, out=self.powderMisses)
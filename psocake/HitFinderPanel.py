@@ -225,8 +225,9 @@ class HitFinder(object):
         # Write number of pixels found containing photons
         xMargin = 5  # pixels
         yMargin = 0  # pixels
-        maxX = np.max(self.parent.det.indexes_x(self.parent.evt)) + xMargin
-        maxY = np.max(self.parent.det.indexes_y(self.parent.evt)) - yMargin
+        with self.parent.img.psanaLock:
+            maxX = np.max(self.parent.det.indexes_x(self.parent.evt)) + xMargin
+            maxY = np.max(self.parent.det.indexes_y(self.parent.evt)) - yMargin
         myMessage = '<div style="text-align: center"><span style="color: cyan; font-size: 12pt;">Pixels=' + \
                     str(self.nPixels) + ' <br></span></div>'
         self.parent.img.peak_text = pg.TextItem(html=myMessage, anchor=(0, 0))
@@ -75,7 +75,8 @@ class ImageControl(object):
         print("##########################################")
         print("Saving assembled image: ", outputAssem)
         print("##########################################")
-        np.save(str(outputAssem), self.parent.det.image(self.parent.evt, _calib))
+        with self.parent.img.psanaLock:
+            np.save(str(outputAssem), self.parent.det.image(self.parent.evt, _calib))
 
         # Save publication quality images
         vmin, vmax = self.parent.img.win.getLevels()
@@ -88,7 +89,8 @@ class ImageControl(object):
         resColor = '#0497cb'
         textSize = 24
         move = 3 * textSize  # move text to the left
-        img = self.parent.det.image(self.parent.evt, self.parent.calib * self.parent.mk.combinedMask)
+        with self.parent.img.psanaLock:
+            img = self.parent.det.image(self.parent.evt, self.parent.calib * self.parent.mk.combinedMask)
         cx = self.parent.cx
         cy = self.parent.cy
         import matplotlib.pyplot as plt
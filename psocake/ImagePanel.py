@@ -3,6 +3,7 @@ import pyqtgraph as pg
 from pyqtgraph.Qt import QtCore, QtGui
 import numpy as np
 import time
+import threading
 import PSCalib.GlobalUtils as gu
 import psana
 from pyimgalgos.RadialBkgd import RadialBkgd, polarization_factor
@@ -60,6 +61,12 @@ class ImageViewer(object):
         self.displayMinPercentile = 1.0
 
         self.rb = None
+        self.pf = None
+        # Calibrated and assembled events, neighbours of the displayed event are prefetched in the background
+        self.imageCache = LruCache(self.parent.args.imageCacheMB)
+        self.imageCacheGeneration = 0 # bumped on every clear, so an image computed before it is not cached
+        self.psanaLock = threading.RLock() # psana is shared by the gui and the prefetcher
+        self.prefetcher = None
         pg.setConfigOptions(imageAxisOrder="row-major")
         ## Dock 2: Image Panel
         self.dock = Dock("Image Panel", size=(500, 400))
@@ -199,30 +206,34 @@ class ImageViewer(object):
     def getCalib(self, evtNumber):
         if self.parent.exp.run is not None:
             self.parent.evt = self.parent.exp.getEvt(evtNumber)
-            if self.parent.exp.applyCommonMode: # play with different common mode
-                if self.parent.exp.commonMode[0] == 5: # Algorithm 5
-                    calib = self.parent.det.calib(self.parent.evt,
-                                                  cmpars=(self.parent.exp.commonMode[0], self.parent.exp.commonMode[1]))
-                else: # Algorithms 1 to 4
-                    print("### Overriding common mode: ", self.parent.exp.commonMode)
-                    calib = self.parent.det.calib(self.parent.evt,
-                                                  cmpars=(self.parent.exp.commonMode[0], self.parent.exp.commonMode[1],
-                                                          self.parent.exp.commonMode[2], self.parent.exp.commonMode[3]))
-            else:
-                if not self.parent.inputImages:
-                    calib = self.parent.det.calib(self.parent.evt)
-                else:
-                    f = h5py.File(self.parent.inputImages)
-                    ind = np.where(f['eventNumber'][()] == evtNumber)[0][0]
-                    if len(f['/data/data'].shape) == 3:
-                        calib = self.parent.detDesc.ipct(f['data/data'][ind, :, :])
-                    else:
-                        calib = f['data/data'][ind, :, :, :]
-                    f.close()
-            return calib
+            return self.calibEvent(self.parent.evt, evtNumber)
         else:
             return None
 
+    def calibEvent(self, evt, evtNumber):
+        """Calibrated detector of an event, honouring the common mode override and input images"""
+        if self.parent.exp.applyCommonMode: # play with different common mode
+            if self.parent.exp.commonMode[0] == 5: # Algorithm 5
+                calib = self.parent.det.calib(evt,
+                                              cmpars=(self.parent.exp.commonMode[0], self.parent.exp.commonMode[1]))
+            else: # Algorithms 1 to 4
+                print("### Overriding common mode: ", self.parent.exp.commonMode)
+                calib = self.parent.det.calib(evt,
+                                              cmpars=(self.parent.exp.commonMode[0], self.parent.exp.commonMode[1],
+                                                      self.parent.exp.commonMode[2], self.parent.exp.commonMode[3]))
+        else:
+            if not self.parent.inputImages:
+                calib = self.parent.det.calib(evt)
+            else:
+                f = h5py.File(self.parent.inputImages)
+                ind = np.where(f['eventNumber'][()] == evtNumber)[0][0]
+                if len(f['/data/data'].shape) == 3:
+                    calib = self.parent.detDesc.ipct(f['data/data'][ind, :, :])
+                else:
+                    calib = f['data/data'][ind, :, :, :]
+                f.close()
+        return calib
+
     def getCommonModeCorrected(self, evtNumber):
         if self.parent.exp.run is not None:
             try:
@@ -271,26 +282,29 @@ class ImageViewer(object):
         else:
             return None
 
-    def getAssembledImage(self, arg, calib):
+    def getAssembledImage(self, arg, calib, evt=None):
+        if evt is None: evt = self.parent.evt
         _calib = calib.copy() # this is important
         tic = time.time()
         if self.parent.exp.applyFriedel: # Apply Friedel symmetry
             print("Apply Friedel symmetry")
-            try:
-                centre = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
-                                                   pix_scale_size_um=None,
-                                                   xy0_off_pix=None,
-                                                   cframe=gu.CFRAME_PSANA, fract=True)
-            except AttributeError:
-                centre = self.parent.det.point_indexes(self.parent.evt)
+            with self.psanaLock:
+                try:
+                    centre = self.parent.det.point_indexes(evt, pxy_um=(0, 0),
+                                                       pix_scale_size_um=None,
+                                                       xy0_off_pix=None,
+                                                       cframe=gu.CFRAME_PSANA, fract=True)
+                except AttributeError:
+                    centre = self.parent.det.point_indexes(evt)
+                data = self.parent.det.image(evt, _calib)
+                mask = None
+                if self.parent.mk.combinedMask is not None:
+                    mask = self.parent.det.image(evt, self.parent.mk.combinedMask)
             self.fs = FriedelSym(self.parent.exp.detGuaranteedData.shape, centre)
-            data = self.parent.det.image(self.parent.evt, _calib)
-            if self.parent.mk.combinedMask is not None:
-                data = self.fs.applyFriedel(data, mask=self.parent.det.image(self.parent.evt, self.parent.mk.combinedMask), mode='same')
-            else:
-                data = self.fs.applyFriedel(data, mask=None, mode='same')
+            data = self.fs.applyFriedel(data, mask=mask, mode='same')
         else:
-            data = self.parent.det.image(self.parent.evt, _calib)
+            with self.psanaLock:
+                data = self.parent.det.image(evt, _calib)
         if data is None: data = _calib
         toc = time.time()
         if self.parent.args.v >= 1: print("time assemble: ", toc-tic)
@@ -300,39 +314,136 @@ class ImageViewer(object):
         self.parent.geom.findPsanaGeometry()
         if self.parent.geom.calibFile is not None:
             if self.parent.args.v >= 1: print("calibFile: ", self.parent.geom.calibPath+'/'+self.parent.geom.calibFile)
-            self.geo = self.parent.det.geometry(self.parent.runNumber) #self.geo = GeometryAccess(self.parent.geom.calibPath+'/'+self.parent.geom.calibFile)
-            self.xarr, self.yarr, self.zarr = self.geo.get_pixel_coords()
-            self.iX, self.iY = self.geo.get_pixel_coord_indexes()
-            self.mask = self.geo.get_pixel_mask(mbits=0o0377)
+            with self.psanaLock:
+                self.geo = self.parent.det.geometry(self.parent.runNumber) #self.geo = GeometryAccess(self.parent.geom.calibPath+'/'+self.parent.geom.calibFile)
+                self.xarr, self.yarr, self.zarr = self.geo.get_pixel_coords()
+                self.iX, self.iY = self.geo.get_pixel_coord_indexes()
+                self.mask = self.geo.get_pixel_mask(mbits=0o0377)
             # mask for 2x1 edges, two central columns, and unbound pixels with their neighbours
             self.rb = RadialBkgd(self.xarr, self.yarr, mask=self.mask, radedges=None, nradbins=100, phiedges=(0, 360), nphibins=1)
             if self.parent.args.v >= 1: print("Done setupRadialBackground")
         else:
             self.rb = None
+        self.clearImageCache() # radial corrections and assembly follow the geometry
 
     def updatePolarizationFactor(self): # FIXME: change to vertical polarization after July 2020
         if self.rb is not None:
             self.pf = polarization_factor(self.rb.pixel_rad(), self.rb.pixel_phi()+90, self.parent.detectorDistance*1e6) # convert to um
+            self.clearImageCache()
             if self.parent.args.v >= 1: print("Done updatePolarizationFactor")
 
     def updateDetectorCentre(self):
-        try:
-            self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
-                                                                           pix_scale_size_um=None,
-                                                                           xy0_off_pix=None,
-                                                                           cframe=gu.CFRAME_PSANA, fract=True)
-        except AttributeError:
-            self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0))
+        with self.psanaLock:
+            try:
+                self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
+                                                                               pix_scale_size_um=None,
+                                                                               xy0_off_pix=None,
+                                                                               cframe=gu.CFRAME_PSANA, fract=True)
+            except AttributeError:
+                self.parent.cy, self.parent.cx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0))
         if self.parent.cx is None:
             print("#######################################")
             print("WARNING: Unable to get detector center position. Check detector geometry is deployed.")
             print("#######################################")
-            data = self.parent.det.image(self.parent.evt, self.parent.exp.detGuaranteed)
+            with self.psanaLock:
+                data = self.parent.det.image(self.parent.evt, self.parent.exp.detGuaranteed)
             self.parent.cx, self.parent.cy = self.getCentre(data.shape)
         if self.parent.args.v >= 1: print("cx, cy: ", self.parent.cx, self.parent.cy)
 
 
+    def imageCacheKey(self, evtNumber):
+        """Everything the calibrated and assembled image of an event depends on,
+        the cache is cleared when the geometry or polarization factor are rebuilt"""
+        exp = self.parent.exp
+        return (self.parent.experimentName, self.parent.runNumber, self.parent.detInfo, evtNumber,
+                exp.image_property, exp.applyCommonMode, tuple(exp.commonMode) if exp.applyCommonMode else None,
+                exp.medianFilterRank, exp.aduPerPhoton, self.parent.detectorDistance, self.parent.inputImages,
+                self.parent.cx, self.parent.cy)
+
+    def isCacheable(self):
+        """Only per-event images whose inputs are all in imageCacheKey are cached"""
+        exp = self.parent.exp
+        return not exp.applyFriedel and \
+               exp.image_property in (exp.disp_adu, exp.disp_medianCorrection, exp.disp_radialCorrection,
+                                      exp.disp_commonModeCorrected, exp.disp_pedestalCorrected)
+
+    def clearImageCache(self):
+        with self.psanaLock:
+            self.imageCacheGeneration += 1
+            self.imageCache.clear()
+
     def getDetImage(self, evtNumber, calib=None):
+        """Calibrated and assembled image of an event, served from the image cache when possible"""
+        key = None
+        if calib is None and self.isCacheable():
+            key = self.imageCacheKey(evtNumber)
+            cached = self.imageCache.get(key)
+            if cached is not None:
+                calib, data = cached
+                # the epics store follows the last fetched event, which may be a prefetched neighbour
+                with self.psanaLock:
+                    self.parent.evt = self.parent.exp.getEvt(evtNumber)
+                    self.updateEventInfo()
+                self.updateRoiHistogram()
+                return calib.copy(), data
+        with self.psanaLock:
+            calib, data = self.computeDetImage(evtNumber, calib)
+        if key is not None:
+            self.imageCache.put(key, (calib.copy(), data))
+        return calib, data
+
+    def prefetchImage(self, evtNumber):
+        """Calibrate and assemble an event into the image cache without touching the displayed event.
+        psanaLock is only held for the psana calls, the corrections run while the gui is free to use psana"""
+        exp = self.parent.exp
+        with self.psanaLock:
+            if exp.run is None or not self.isCacheable() or exp.image_property in \
+               (exp.disp_commonModeCorrected, exp.disp_pedestalCorrected):
+                return
+            key = self.imageCacheKey(evtNumber)
+            if key in self.imageCache: return
+            # everything the corrections use, as of the key
+            generation = self.imageCacheGeneration
+            imageProperty, medianFilterRank, rb, pf = exp.image_property, exp.medianFilterRank, self.rb, self.pf
+            evt = exp.getEvt(evtNumber)
+            if evt is None: return
+            calib = self.calibEvent(evt, evtNumber)
+            if calib is None: calib = np.zeros_like(exp.detGuaranteed, dtype='float32')
+        if imageProperty == exp.disp_medianCorrection:
+            calib -= median_filter_ndarr(calib, medianFilterRank)
+        elif imageProperty == exp.disp_radialCorrection:
+            shape = calib.shape
+            calib = rb.subtract_bkgd(calib * pf.reshape(shape)) # FIXME: shape is 1d
+            calib.shape = shape
+        data = self.getAssembledImage(self.parent.facility, calib, evt)
+        with self.psanaLock: # a cache clear meanwhile means the image may be stale
+            if generation == self.imageCacheGeneration: self.imageCache.put(key, (calib, data))
+
+    def prefetchNeighbours(self, evtNumber):
+        """Warm the image cache with the events around evtNumber"""
+        if self.parent.args.prefetch <= 0: return
+        if self.prefetcher is None:
+            self.prefetcher = ImagePrefetcher(self, self.parent.args.prefetch)
+            QtGui.QApplication.instance().aboutToQuit.connect(self.prefetcher.stop)
+        self.prefetcher.request(evtNumber)
+
+    def updateEventInfo(self):
+        # Update photon energy
+        self.parent.exp.updatePhotonEnergy(self.parent.facility)
+
+        # Update clen
+        self.parent.geom.updateClen(self.parent.facility)
+
+    def updateRoiHistogram(self):
+        if self.parent.roi.roiCurrent == 'rect':
+            self.parent.roi.updateRoi(self.parent.roi.roi)
+        elif self.parent.roi.roiCurrent == 'poly':
+            self.parent.roi.updateRoi(self.parent.roi.roiPoly)
+        elif self.parent.roi.roiCurrent == 'circ':
+            self.parent.roi.updateRoi(self.parent.roi.roiCircle)
+
+    def computeDetImage(self, evtNumber, calib=None):
+        """Calibrated and assembled image of an event, called with psanaLock held"""
         if calib is None:
             if self.parent.exp.image_property == self.parent.exp.disp_medianCorrection:  # median subtraction
                 calib = self.getCalib(evtNumber)
@@ -415,11 +526,7 @@ class ImageViewer(object):
                         calib[:,:,i] = i
                     self.parent.firstUpdate = True
 
-        # Update photon energy
-        self.parent.exp.updatePhotonEnergy(self.parent.facility)
-
-        # Update clen
-        self.parent.geom.updateClen(self.parent.facility)
+        self.updateEventInfo()
 
         # Write a temporary geom file
         #self.parent.geom.deployCrystfelGeometry(self.parent.facility)
@@ -433,12 +540,7 @@ class ImageViewer(object):
             data = self.getAssembledImage(self.parent.facility, calib)
 
         # Update ROI histogram
-        if self.parent.roi.roiCurrent == 'rect':
-            self.parent.roi.updateRoi(self.parent.roi.roi)
-        elif self.parent.roi.roiCurrent == 'poly':
-            self.parent.roi.updateRoi(self.parent.roi.roiPoly)
-        elif self.parent.roi.roiCurrent == 'circ':
-            self.parent.roi.updateRoi(self.parent.roi.roiCircle)
+        self.updateRoiHistogram()
 
         return calib, data
 
@@ -446,3 +548,41 @@ class ImageViewer(object):
         cx = shape[1]/2
         cy = shape[0]/2
         return cx,cy
+
+class ImagePrefetcher(QtCore.QThread):
+    """Background thread filling the image cache with the neighbours of the displayed event"""
+    def __init__(self, viewer, numNeighbours, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.viewer = viewer
+        self.numNeighbours = numNeighbours
+        self.centre = None
+        self.wake = threading.Event()
+        self.stopped = False
+
+    def request(self, evtNumber):
+        self.centre = evtNumber
+        self.wake.set()
+        if not self.isRunning(): self.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        self.wait()
+
+    def neighbours(self, centre):
+        """next event first, then previous, then further out"""
+        total = self.viewer.parent.exp.eventTotal
+        for i in range(1, self.numNeighbours + 1):
+            for evtNumber in (centre + i, centre - i):
+                if 0 <= evtNumber < total: yield evtNumber
+
+    def run(self):
+        while not self.stopped:
+            self.wake.wait()
+            self.wake.clear()
+            for evtNumber in self.neighbours(self.centre):
+                if self.stopped or self.wake.is_set(): break # user moved on
+                try:
+                    self.viewer.prefetchImage(evtNumber)
+                except Exception as e:
+                    if self.viewer.parent.args.v >= 1: print("prefetch failed: ", evtNumber, e)
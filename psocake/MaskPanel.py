@@ -396,11 +396,13 @@ class MaskMaker(object):
     def updatePsanaMaskOn(self):
         if self.parent.det is not None:
             self.initMask()
-            self.psanaMask = self.parent.det.mask(self.parent.evt, calib=self.mask_calibOn, status=self.mask_statusOn,
-                                           edges=self.mask_edgesOn, central=self.mask_centralOn,
-                                           unbond=self.mask_unbondOn, unbondnbrs=self.mask_unbondnrsOn)
+            with self.parent.img.psanaLock:
+                self.psanaMask = self.parent.det.mask(self.parent.evt, calib=self.mask_calibOn, status=self.mask_statusOn,
+                                               edges=self.mask_edgesOn, central=self.mask_centralOn,
+                                               unbond=self.mask_unbondOn, unbondnbrs=self.mask_unbondnrsOn)
             if self.psanaMask is not None:
-                self.psanaMaskAssem = self.parent.det.image(self.parent.evt, self.psanaMask)
+                with self.parent.img.psanaLock:
+                    self.psanaMaskAssem = self.parent.det.image(self.parent.evt, self.psanaMask)
             else:
                 self.psanaMaskAssem = None
             self.parent.pk.updateClassification()
@@ -417,14 +419,17 @@ class MaskMaker(object):
     def initMask(self):
         if self.parent.det is not None:
             if self.gapAssemInd is None:
-                self.gapAssem = self.parent.det.image(self.parent.evt, np.ones_like(self.parent.exp.detGuaranteed,dtype='int'))
+                with self.parent.img.psanaLock:
+                    self.gapAssem = self.parent.det.image(self.parent.evt, np.ones_like(self.parent.exp.detGuaranteed,dtype='int'))
                 self.gapAssemInd = np.where(self.gapAssem==0)
             if self.userMask is None and self.parent.data is not None:
                 # initialize
                 self.userMaskAssem = np.ones_like(self.parent.data,dtype='int')
-                self.userMask = self.parent.det.ndarray_from_image(self.parent.evt,self.userMaskAssem, pix_scale_size_um=None, xy0_off_pix=None)
+                with self.parent.img.psanaLock:
+                    self.userMask = self.parent.det.ndarray_from_image(self.parent.evt,self.userMaskAssem, pix_scale_size_um=None, xy0_off_pix=None)
             if self.streakMask is None:
-                self.StreakMask = myskbeam.StreakMask(self.parent.det, self.parent.evt, width=self.streak_width, sigma=self.streak_sigma)
+                with self.parent.img.psanaLock:
+                    self.StreakMask = myskbeam.StreakMask(self.parent.det, self.parent.evt, width=self.streak_width, sigma=self.streak_sigma)
         if self.parent.args.v >= 1: print("Done initMask")
 
     def displayMask(self):
@@ -484,8 +489,9 @@ class MaskMaker(object):
                 1 - self.userMaskAssem[coord_row.astype('int'), coord_col.astype('int')])
 
             # update userMask
-            self.userMask = self.parent.det.ndarray_from_image(self.parent.evt, self.userMaskAssem, pix_scale_size_um=None,
-                                                                xy0_off_pix=None)
+            with self.parent.img.psanaLock:
+                self.userMask = self.parent.det.ndarray_from_image(self.parent.evt, self.userMaskAssem, pix_scale_size_um=None,
+                                                                    xy0_off_pix=None)
 
             self.displayMask()
             self.parent.pk.algInitDone = False
@@ -517,8 +523,9 @@ class MaskMaker(object):
                 self.userMaskAssem[j01, i01] = (1 - self.userMaskAssem[j01, i01])
 
             # update userMask
-            self.userMask = self.parent.det.ndarray_from_image(self.parent.evt, self.userMaskAssem, pix_scale_size_um=None,
-                                                                xy0_off_pix=None)
+            with self.parent.img.psanaLock:
+                self.userMask = self.parent.det.ndarray_from_image(self.parent.evt, self.userMaskAssem, pix_scale_size_um=None,
+                                                                    xy0_off_pix=None)
 
             self.displayMask()
             self.parent.pk.algInitDone = False
@@ -541,8 +548,9 @@ class MaskMaker(object):
                 print("You can only mask/unmask based on threshold ")
 
             # update userMask
-            self.userMask = self.parent.det.ndarray_from_image(self.parent.evt, self.userMaskAssem, pix_scale_size_um=None,
-                                                                xy0_off_pix=None)
+            with self.parent.img.psanaLock:
+                self.userMask = self.parent.det.ndarray_from_image(self.parent.evt, self.userMaskAssem, pix_scale_size_um=None,
+                                                                    xy0_off_pix=None)
 
             self.displayMask()
             self.parent.pk.algInitDone = False
@@ -554,7 +562,8 @@ class MaskMaker(object):
         self.initMask()
         if self.parent.data is not None and self.maskingMode > 0:
             calib = np.ones_like(self.parent.calib)
-            img = self.parent.det.image(self.parent.evt, calib)
+            with self.parent.img.psanaLock:
+                img = self.parent.det.image(self.parent.evt, calib)
 
             self.selected = self.mask_poly.getArrayRegion(img, self.parent.img.win.getImageItem()) #, returnMappedCoords=True)
 
@@ -574,8 +583,9 @@ class MaskMaker(object):
                 self.userMaskAssem *= _mask
 
             # update userMask
-            self.userMask = self.parent.det.ndarray_from_image(self.parent.evt, self.userMaskAssem, pix_scale_size_um=None,
-                                                                xy0_off_pix=None)
+            with self.parent.img.psanaLock:
+                self.userMask = self.parent.det.ndarray_from_image(self.parent.evt, self.userMaskAssem, pix_scale_size_um=None,
+                                                                    xy0_off_pix=None)
             #
             self.displayMask()
             self.parent.pk.algInitDone = False
@@ -653,7 +663,8 @@ class MaskMaker(object):
         if self.userMask.shape != self.parent.calib.shape:
             self.userMask = None
         if self.userMask is not None:
-            self.userMaskAssem = self.parent.det.image(self.parent.evt, self.userMask)
+            with self.parent.img.psanaLock:
+                self.userMaskAssem = self.parent.det.image(self.parent.evt, self.userMask)
         else:
             self.userMaskAssem = None
         self.userMaskOn = True
@@ -51,6 +51,7 @@ class PeakFinder:
         self.distance = distance
 
         self.windows = windows
+        self.geomCache = kwargs.get("geomCache") # shared masks and geometry, see utils.GeometryCache
 
         self.userMask = None
         self.psanaMask = None
@@ -64,9 +65,13 @@ class PeakFinder:
 
         if facility == 'LCLS':
             # Make psana mask
-            self.psanaMask = detector.mask(run, calib=self.psanaMask_calib, status=self.psanaMask_status,
-                                           edges=self.psanaMask_edges, central=self.psanaMask_central,
-                                           unbond=self.psanaMask_unbond, unbondnbrs=self.psanaMask_unbondnrs)
+            maskFlags = dict(calib=self.psanaMask_calib, status=self.psanaMask_status,
+                             edges=self.psanaMask_edges, central=self.psanaMask_central,
+                             unbond=self.psanaMask_unbond, unbondnbrs=self.psanaMask_unbondnrs)
+            if self.geomCache is not None:
+                self.psanaMask = self.geomCache.mask(**maskFlags)
+            else:
+                self.psanaMask = detector.mask(run, **maskFlags)
             # Combine userMask and psanaMask
             self.userPsanaMask = np.ones_like(self.psanaMask, dtype=np.int16)
             if self.userMask is not None:
@@ -117,18 +122,36 @@ class PeakFinder:
                                                       cframe=gu.CFRAME_PSANA, fract=True)
             except AttributeError:
                 self.cx, self.cy = self.det.point_indexes(evt, pxy_um=(0, 0))
-            self.iX = np.array(self.det.indexes_x(evt), dtype=np.int64)
-            self.iY = np.array(self.det.indexes_y(evt), dtype=np.int64)
-            if len(self.iX.shape) == 2:
-                self.iX = np.expand_dims(self.iX, axis=0)
-                self.iY = np.expand_dims(self.iY, axis=0)
+            if self.geomCache is not None:
+                self.iX, self.iY = self.geomCache.indexes()
+            else:
+                self.iX = np.array(self.det.indexes_x(evt), dtype=np.int64)
+                self.iY = np.array(self.det.indexes_y(evt), dtype=np.int64)
+                if len(self.iX.shape) == 2:
+                    self.iX = np.expand_dims(self.iX, axis=0)
+                    self.iY = np.expand_dims(self.iY, axis=0)
             # Initialize radial background subtraction
-            self.setupExperiment()
+            self.setupExperiment(kwargs.get("ds"), kwargs.get("psanaRun"), kwargs.get("times"), evt)
             if self.radialFilterOn:
                 self.setupRadialBackground()
                 self.updatePolarizationFactor()
 
-    def setupExperiment(self):
+    def setupExperiment(self, ds=None, run=None, times=None, evt=None):
+        """
+        Open the run, or reuse the handles of the caller, which already has the run open
+        :param ds: psana DataSource of the run, the detector passed to the constructor is then reused as well
+        :param run: psana run of ds, taken from ds when not given
+        :param times: event times of run
+        :param evt: any event of run, the first event is fetched when not given
+        """
+        if ds is not None:
+            self.ds = ds
+            self.run = run if run is not None else next(ds.runs())
+            self.times = times if times is not None else self.run.times()
+            self.eventTotal = len(self.times)
+            self.env = ds.env()
+            self.evt = evt if evt is not None else self.run.event(self.times[0])
+            return
         access = 'exp=' + str(self.exp) + ':run=' + str(self.run) + ':idx'
         if 'ffb' in self.access.lower(): access += ':dir=/cds/data/drpsrcf/' + self.exp[:3] + '/' + self.exp + '/xtc'
         self.ds = psana.DataSource(access)
@@ -141,6 +164,12 @@ class PeakFinder:
         self.det.do_reshape_2d_to_3d(flag=True)
 
     def setupRadialBackground(self):
+        if self.geomCache is not None:
+            self.xarr, self.yarr, self.mask = self.geomCache.pixelCoords()
+            self.iX, self.iY = self.geomCache.indexes()
+            self.rb = RadialBkgd(self.xarr, self.yarr, mask=self.mask, radedges=None, nradbins=100,
+                                 phiedges=(0, 360), nphibins=1)
+            return
         self.geo = self.det.geometry(self.run)  # self.geo = GeometryAccess(self.parent.geom.calibPath+'/'+self.parent.geom.calibFile)
         self.xarr, self.yarr, self.zarr = self.geo.get_pixel_coords()
         self.ix = self.det.indexes_x(self.evt)
@@ -165,7 +194,7 @@ class PeakFinder:
         #t0 = time.time()
         if facility == 'LCLS':
             if self.streakMask_on: # make new streak mask
-                self.streakMask = self.StreakMask.getStreakMaskCalib(evt)
+                self.streakMask = self.StreakMask.getStreakMaskCalib(evt, calib)
 
             # Apply background correction
             if self.medianFilterOn:
@@ -231,19 +260,7 @@ class PeakFinder:
                                                        nsigm=self.son_min,
                                                        mask=self.combinedMask.astype(np.uint16))
         #t2 = time.time()
-        self.numPeaksFound = self.peaks.shape[0]
-
-        if self.numPeaksFound >= minPeaks:
-            if facility == 'LCLS':
-                cenX = self.iX[np.array(self.peaks[:, 0], dtype=np.int64),
-                               np.array(self.peaks[:, 1], dtype=np.int64),
-                               np.array(self.peaks[:, 2], dtype=np.int64)] + 0.5
-                cenY = self.iY[np.array(self.peaks[:, 0], dtype=np.int64),
-                               np.array(self.peaks[:, 1], dtype=np.int64),
-                               np.array(self.peaks[:, 2], dtype=np.int64)] + 0.5
-            self.maxRes = getMaxRes(cenX, cenY, self.cx, self.cy)
-        else:
-            self.maxRes = 0
+        self.updateMaxRes(minPeaks)
         #t3 = time.time()
         if self.numPeaksFound >= minPeaks:
             if self.powderHits is None:
@@ -262,6 +279,28 @@ class PeakFinder:
         #print "breakdown (powder, maxRes, peaks, mask): ", t4-t3,t3-t2,t2-t1,t1-t0
         # 0.013 3.0e-06 0.122 3.09e-06
 
+    def updateMaxRes(self, minPeaks=15):
+        """Update number of peaks and maximum resolution from self.peaks"""
+        self.numPeaksFound = self.peaks.shape[0]
+
+        if self.numPeaksFound >= minPeaks:
+            if facility == 'LCLS':
+                cenX = self.iX[np.array(self.peaks[:, 0], dtype=np.int64),
+                               np.array(self.peaks[:, 1], dtype=np.int64),
+                               np.array(self.peaks[:, 2], dtype=np.int64)] + 0.5
+                cenY = self.iY[np.array(self.peaks[:, 0], dtype=np.int64),
+                               np.array(self.peaks[:, 1], dtype=np.int64),
+                               np.array(self.peaks[:, 2], dtype=np.int64)] + 0.5
+            self.maxRes = getMaxRes(cenX, cenY, self.cx, self.cy)
+        else:
+            self.maxRes = 0
+
+    def setPeaks(self, peaks, minPeaks=15):
+        """Use previously found peaks, e.g. from a PeakCache, without calibrating the event.
+        Powders are not updated."""
+        self.peaks = peaks
+        self.updateMaxRes(minPeaks)
+
 def getMaxRes(posX, posY, centerX, centerY):
     maxRes = np.max(np.sqrt((posX - centerX) ** 2 + (posY - centerY) ** 2))
     return maxRes
@@ -4,9 +4,9 @@ import h5py
 from pyqtgraph.dockarea import *
 from pyqtgraph.parametertree import Parameter, ParameterTree
 import json, os
-from scipy.spatial import distance
-import subprocess
 import skimage.measure as sm
+from pyqtgraph.Qt import QtCore
+import PSCalib.GlobalUtils as gu
 
 from psalgos.pypsalgos import PyAlgos  # replacement for: from ImgAlgos.PyAlgos import PyAlgos
 from psocake import utils
@@ -105,6 +105,13 @@ class PeakFinding:
             self.showPeaks = False
         self.turnOnAutoPeaks = False
         self.ind = None
+        self.indKey = None
+        self.radiusMap = None
+        self.radiusMapKey = None
+        self.numPowderEvents = 256
+        self.powderThread = None
+        self.powderWorker = None
+        self.powderText = None
         self.pairsFoundPerSpot = 0
         self.peaks = None
         self.numPeaksFound = 0
@@ -517,11 +524,12 @@ class PeakFinding:
         if self.parent.calib is not None:
             if self.parent.mk.streakMaskOn:
                 self.parent.mk.initMask()
-                self.parent.mk.streakMask = self.parent.mk.StreakMask.getStreakMaskCalib(self.parent.evt)
-                if self.parent.mk.streakMask is None:
-                    self.parent.mk.streakMaskAssem = None
-                else:
-                    self.parent.mk.streakMaskAssem = self.parent.det.image(self.parent.evt, self.parent.mk.streakMask)
+                with self.parent.img.psanaLock:
+                    self.parent.mk.streakMask = self.parent.mk.StreakMask.getStreakMaskCalib(self.parent.evt)
+                    if self.parent.mk.streakMask is None:
+                        self.parent.mk.streakMaskAssem = None
+                    else:
+                        self.parent.mk.streakMaskAssem = self.parent.det.image(self.parent.evt, self.parent.mk.streakMask)
                 self.algInitDone = False
 
             self.parent.mk.displayMask()
@@ -575,8 +583,9 @@ class PeakFinding:
                         self.alg.set_peak_selection_pars(npix_min=self.hitParam_alg1_npix_min, npix_max=self.hitParam_alg1_npix_max, \
                                                 amax_thr=self.hitParam_alg1_amax_thr, atot_thr=self.hitParam_alg1_atot_thr, \
                                                 son_min=self.hitParam_alg1_son_min)
-                    ix = self.parent.det.indexes_x(self.parent.evt)
-                    iy = self.parent.det.indexes_y(self.parent.evt)
+                    with self.parent.img.psanaLock:
+                        ix = self.parent.det.indexes_x(self.parent.evt)
+                        iy = self.parent.det.indexes_y(self.parent.evt)
                     self.iX = np.array(ix, dtype=np.int64)
                     self.iY = np.array(iy, dtype=np.int64)
 
@@ -599,67 +608,20 @@ class PeakFinding:
                     else:
                         ################################
                         # Determine thr_high and thr_low
-                        if self.ind is None:
-                            with pg.BusyCursor():
-                                powderSumFname = self.parent.psocakeRunDir + '/' + \
-                                            self.parent.experimentName + '_' + \
-                                            str(self.parent.runNumber).zfill(4) + '_' + \
-                                            self.parent.detInfo + '_mean.npy'
-                                if not os.path.exists(powderSumFname):
-                                    # Generate powder
-                                    cmd = "mpirun -n 6 generatePowder exp=" + self.parent.experimentName + \
-                                          ":run=" + str(self.parent.runNumber) + " -d " + self.parent.detInfo + \
-                                          " -o " + self.parent.psocakeRunDir
-                                    cmd += " -n " + str(256)
-                                    cmd += " --random"
-                                    print("Running on local machine: ", cmd)
-                                    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                                               shell=True)
-                                    out, err = process.communicate()
-                                # Copy as background.npy
-                                import shutil
-                                shutil.copyfile(powderSumFname, self.parent.psocakeRunDir + '/background.npy')
-
-                                # Read in powder pattern and calculate pixel indices
-                                powderSum = np.load(powderSumFname)
-                                powderSum1D = powderSum.ravel()
-                                cy, cx = self.parent.det.indexes_xy(self.parent.evt)
-                                #ipx, ipy = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0))
-                                try:
-                                    ipy, ipx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
-                                                                          pix_scale_size_um=None,
-                                                                          xy0_off_pix=None,
-                                                                          cframe=gu.CFRAME_PSANA, fract=True)
-                                except AttributeError:
-                                    ipx, ipy = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0))
-                                r = np.sqrt((cx - ipx) ** 2 + (cy - ipy) ** 2).ravel().astype(int)
-                                startR = 0
-                                endR = np.max(r)
-                                profile = np.zeros(endR - startR, )
-                                for i, val in enumerate(np.arange(startR, endR)):
-                                    ind = np.where(r == val)[0].astype(int)
-                                    if len(ind) > 0: profile[i] = np.mean(powderSum1D[ind])
-                                myThreshInd = np.argmax(profile)
-                                print("###################################################")
-                                print("Solution scattering radius (pixels): ", myThreshInd)
-                                print("###################################################")
-                                thickness = 10
-                                indLo = np.where(r >= myThreshInd - thickness / 2.)[0].astype(int)
-                                indHi = np.where(r <= myThreshInd + thickness / 2.)[0].astype(int)
-                                self.ind = np.intersect1d(indLo, indHi)
-
-                                ix = self.parent.det.indexes_x(self.parent.evt)
-                                iy = self.parent.det.indexes_y(self.parent.evt)
-                                self.iX = np.array(ix, dtype=np.int64)
-                                self.iY = np.array(iy, dtype=np.int64)
-
-                        calib1D = self.parent.calib.ravel()
-                        mean = np.mean(calib1D[self.ind])
-                        spread = np.std(calib1D[self.ind])
-                        highSigma = 3.5
-                        lowSigma = 2.5
-                        thr_high = int(mean + highSigma * spread + 50)
-                        thr_low = int(mean + lowSigma * spread + 50)
+                        if self.ind is None or self.indKey != self.getPowderKey():
+                            self.ind = None
+                            self.startPowder()
+                        if self.ind is None: # powder is still being accumulated, use the manual thresholds meanwhile
+                            thr_high = self.hitParam_alg1_thr_high
+                            thr_low = self.hitParam_alg1_thr_low
+                        else:
+                            calib1D = self.parent.calib.ravel()
+                            mean = np.mean(calib1D[self.ind])
+                            spread = np.std(calib1D[self.ind])
+                            highSigma = 3.5
+                            lowSigma = 2.5
+                            thr_high = int(mean + highSigma * spread + 50)
+                            thr_low = int(mean + lowSigma * spread + 50)
 
                         self.peaks = self.alg.findPeaks(self.parent.calib,
                                                         npix_min=self.hitParam_alg1_npix_min,
@@ -705,7 +667,8 @@ class PeakFinding:
                     x = cenX - self.parent.cx # args.center[0]
                     y = cenY - self.parent.cy # args.center[1]
 
-                    pixSize = float(self.parent.det.pixel_size(self.parent.evt))
+                    with self.parent.img.psanaLock:
+                        pixSize = float(self.parent.det.pixel_size(self.parent.evt))
                     detdis = float(self.parent.detectorDistance)
                     z = detdis / pixSize * np.ones(x.shape)  # pixels
                     wavelength = 12.407002 / float(self.parent.photonEnergy)  # Angstrom
@@ -729,34 +692,96 @@ class PeakFinding:
                 self.drawPeaks()
             if self.parent.args.v >= 1: print("Done updateClassification")
 
-    def calculate_likelihood(self, qPeaks):
+    def getPowderKey(self):
+        return (self.parent.experimentName, self.parent.runNumber, self.parent.detInfo)
+
+    def getPowderSumFname(self):
+        return self.parent.psocakeRunDir + '/' + self.parent.experimentName + '_' + \
+               str(self.parent.runNumber).zfill(4) + '_' + self.parent.detInfo + '_mean.npy'
+
+    def getRadiusMap(self):
+        """Integer distance of every pixel from the beam centre, computed once per run and detector"""
+        if self.radiusMapKey != self.getPowderKey():
+            with self.parent.img.psanaLock:
+                cy, cx = self.parent.det.indexes_xy(self.parent.evt)
+                try:
+                    ipy, ipx = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0),
+                                                             pix_scale_size_um=None,
+                                                             xy0_off_pix=None,
+                                                             cframe=gu.CFRAME_PSANA, fract=True)
+                except AttributeError:
+                    ipx, ipy = self.parent.det.point_indexes(self.parent.evt, pxy_um=(0, 0))
+            self.radiusMap = np.sqrt((cx - ipx) ** 2 + (cy - ipy) ** 2).ravel().astype(int)
+            self.radiusMapKey = self.getPowderKey()
+        return self.radiusMap
+
+    def startPowder(self):
+        """Mean powder of randomly sampled events for the auto thresholds, accumulated on a background thread"""
+        if self.powderThread is not None: return # already accumulating
+        powderSumFname = self.getPowderSumFname()
+        if os.path.exists(powderSumFname):
+            self.setPowder(np.load(powderSumFname))
+            return
+        self.powderThread = QtCore.QThread()
+        self.powderWorker = PowderWorker()
+        self.powderWorker.setup(self.getPowderKey(), self.parent.exp.run, self.parent.exp.times, self.parent.det,
+                                self.numPowderEvents, self.parent.img.psanaLock)
+        self.powderWorker.moveToThread(self.powderThread)
+        self.powderThread.started.connect(self.powderWorker.run)
+        self.powderWorker.progress.connect(self.reportPowderProgress)
+        self.powderWorker.finished.connect(self.powderThread.quit)
+        self.powderWorker.finished.connect(self.powderFinished)
+        self.powderThread.start()
+
+    def reportPowderProgress(self, n):
+        myMessage = '<div style="text-align: center"><span style="color: #FF00FF; font-size: 12pt;">' + \
+                    'Auto threshold powder ' + str(n) + '%</span></div>'
+        if self.powderText is None:
+            self.powderText = pg.TextItem(html=myMessage, anchor=(0, 0))
+            self.parent.img.win.getView().addItem(self.powderText)
+            self.powderText.setPos(0, 0)
+        else:
+            self.powderText.setHtml(myMessage)
+
+    def powderFinished(self, key, powderSum):
+        self.powderThread.wait()
+        self.powderThread = None
+        self.powderWorker = None
+        if self.powderText is not None:
+            self.parent.img.win.getView().removeItem(self.powderText)
+            self.powderText = None
+        if key != self.getPowderKey(): # run or detector changed meanwhile
+            return
+        if powderSum is None:
+            print("Could not generate powder for the auto thresholds")
+            return
+        np.save(self.getPowderSumFname(), powderSum)
+        self.setPowder(powderSum)
+        if self.turnOnAutoPeaks and self.showPeaks and self.doingUpdate is False:
+            self.updateClassification()
+
+    def setPowder(self, powderSum):
+        """Select the pixels in the ring of strongest solution scattering of the powder"""
+        np.save(self.parent.psocakeRunDir + '/background.npy', powderSum)
+        r = self.getRadiusMap()
+        # Mean powder per integer radius, radii without pixels are zero
+        profile = np.bincount(r, weights=powderSum.ravel()) / np.maximum(np.bincount(r), 1)
+        myThreshInd = np.argmax(profile[:-1])
+        print("###################################################")
+        print("Solution scattering radius (pixels): ", myThreshInd)
+        print("###################################################")
+        thickness = 10
+        self.ind = np.nonzero(np.abs(r - myThreshInd) <= thickness / 2.)[0]
+        self.indKey = self.getPowderKey()
+
+        with self.parent.img.psanaLock:
+            ix = self.parent.det.indexes_x(self.parent.evt)
+            iy = self.parent.det.indexes_y(self.parent.evt)
+        self.iX = np.array(ix, dtype=np.int64)
+        self.iY = np.array(iy, dtype=np.int64)
 
-        nPeaks = int(qPeaks.shape[1])
-        selfD = distance.cdist(qPeaks.transpose(), qPeaks.transpose(), 'euclidean')
-        sortedSelfD = np.sort(selfD)
-        closestNeighborDist = sortedSelfD[:, 1]
-        meanClosestNeighborDist = np.median(closestNeighborDist)
-        closestPeaks = [None] * nPeaks
-        coords = qPeaks.transpose()
-        pairsFound = 0.
-
-        for ii in range(nPeaks):
-            index = np.where(selfD[ii, :] == closestNeighborDist[ii])
-            closestPeaks[ii] = coords[list(index[0]), :].copy()
-            p = coords[ii, :]
-            flip = 2 * p - closestPeaks[ii]
-            d = distance.cdist(coords, flip, 'euclidean')
-            sigma = closestNeighborDist[ii] / 4.
-            mu = 0.
-            bins = d
-            vals = np.exp(-(bins - mu) ** 2 / (2. * sigma ** 2))
-            weight = np.sum(vals)
-            pairsFound += weight
-
-        pairsFound = pairsFound / 2.
-        pairsFoundPerSpot = pairsFound / float(nPeaks)
-
-        return [meanClosestNeighborDist, pairsFoundPerSpot]
+    def calculate_likelihood(self, qPeaks):
+        return utils.calculateLikelihood(qPeaks)
 
     def getMaxRes(self, posX, posY, centerX, centerY):
         maxRes = np.max(np.sqrt((posX-centerX)**2 + (posY-centerY)**2))
@@ -764,8 +789,9 @@ class PeakFinding:
         return maxRes # in pixels
 
     def assemblePeakPos(self, peaks):
-        self.ix = self.parent.det.indexes_x(self.parent.evt)
-        self.iy = self.parent.det.indexes_y(self.parent.evt)
+        with self.parent.img.psanaLock:
+            self.ix = self.parent.det.indexes_x(self.parent.evt)
+            self.iy = self.parent.det.indexes_y(self.parent.evt)
         if self.ix is None:
             (_, dim0, dim1) = self.parent.calib.shape
             self.iy = np.tile(np.arange(dim0), [dim1, 1])
@@ -836,3 +862,35 @@ class PeakFinding:
             self.parent.img.filePeak_feature.setData([], [], pxMode=False)
         if self.parent.args.v >= 1: print("Done drawPeaks")
         self.parent.geom.drawCentre()
+
+class PowderWorker(QtCore.QObject):
+    """Mean of calibrated events sampled at random from the open run"""
+    finished = QtCore.pyqtSignal(object, object)
+    progress = QtCore.pyqtSignal(int)
+
+    def setup(self, key, run, times, det, numEvents, lock, seed=1234):
+        self.key = key
+        self.run = run
+        self.times = times
+        self.det = det
+        self.numEvents = numEvents
+        self.lock = lock
+        self.seed = seed
+
+    def run(self):
+        numEvents = min(self.numEvents, len(self.times))
+        # Sorted so that the events are read in file order
+        ind = np.sort(np.random.RandomState(self.seed).choice(len(self.times), numEvents, replace=False))
+        powderSum = None
+        numFound = 0
+        for i, j in enumerate(ind):
+            with self.lock: # psana is shared with the gui
+                evt = self.run.event(self.times[j])
+                calib = self.det.calib(evt) if evt is not None else None
+            if calib is not None:
+                if powderSum is None: powderSum = np.zeros(calib.shape, dtype=np.float64)
+                powderSum += calib
+                numFound += 1
+            self.progress.emit(int((i + 1) * 100 / numEvents))
+        if numFound > 0: powderSum /= numFound
+        self.finished.emit(self.key, powderSum)
@@ -79,7 +79,8 @@ class RoiHistogram(object):
         if self.parent.data is not None:
             if self.updateRoiStatus == True:
                 calib = np.ones_like(self.parent.calib)
-                img = self.parent.det.image(self.parent.evt, calib)
+                with self.parent.img.psanaLock:
+                    img = self.parent.det.image(self.parent.evt, calib)
                 pixelsExist = roi.getArrayRegion(img, self.parent.img.win.getImageItem())
                 if roi.name == 'poly':
                     self.ret = roi.getArrayRegion(self.parent.data, self.parent.img.win.getImageItem())#, returnMappedCoords=True)
@@ -114,8 +115,9 @@ class RoiHistogram(object):
                     mask_roi[self.x0:self.x1, self.y0:self.y1] = 1
                     # Print unassembled coordinates per asic
                     if self.parent.facility == self.parent.facilityLCLS:
-                        self.nda = self.parent.det.ndarray_from_image(self.parent.evt, mask_roi, pix_scale_size_um=None,
-                                                                      xy0_off_pix=None)
+                        with self.parent.img.psanaLock:
+                            self.nda = self.parent.det.ndarray_from_image(self.parent.evt, mask_roi, pix_scale_size_um=None,
+                                                                          xy0_off_pix=None)
                         for itile, tile in enumerate(self.nda):
                             if tile.sum() > 0:
                                 ax0 = np.arange(0, tile.sum(axis=0).shape[0])[tile.sum(axis=0) > 0]
@@ -161,8 +163,9 @@ class RoiHistogram(object):
                         self.y1) + "]")  # Note: self.parent.data[x0:x1,y0:y1]
                     mask_roi = np.zeros_like(self.parent.data)
                     mask_roi[self.x0:self.x1, self.y0:self.y1] = 1
-                    self.nda = self.parent.det.ndarray_from_image(self.parent.evt, mask_roi, pix_scale_size_um=None,
-                                                           xy0_off_pix=None)
+                    with self.parent.img.psanaLock:
+                        self.nda = self.parent.det.ndarray_from_image(self.parent.evt, mask_roi, pix_scale_size_um=None,
+                                                               xy0_off_pix=None)
                     for itile, tile in enumerate(self.nda):
                         if tile.sum() > 0:
                             ax0 = np.arange(0, tile.sum(axis=0).shape[0])[tile.sum(axis=0) > 0]
@@ -46,37 +46,64 @@ class DetectorDescriptor(ABC):
         ChDim = namedtuple('ChDim', ['dim0', 'dim1'])
         return ChDim(self.quads.numAsicsPerQuad * self.psanaDim.rows, self.quads.numQuad * self.psanaDim.cols)
 
-    @abstractmethod
-    def convert_peaks_to_cheetah(s, r, c):
+    @property
+    def segMap(self):
+        """cached (rowOffset, colOffset, segs): cheetah tile offsets of every psana segment
+        and the psana segment at every (asic, quad) position of the tile"""
+        if getattr(self, '_segMap', None) is None:
+            numQuad, numAsicsPerQuad = self.quads
+            seg = np.arange(numQuad * numAsicsPerQuad)
+            SegMap = namedtuple('SegMap', ['rowOffset', 'colOffset', 'segs'])
+            self._segMap = SegMap(rowOffset=(seg % numAsicsPerQuad) * self.psanaDim.rows,
+                                  colOffset=(seg // numAsicsPerQuad) * self.psanaDim.cols,
+                                  segs=seg.reshape(numQuad, numAsicsPerQuad).T)
+        return self._segMap
+
+    def convert_peaks_to_cheetah(self, s, r, c):
         """convert psana peak positions to cheetah tile positions"""
+        s = np.asarray(s).astype(np.int64)
+        row2d = self.segMap.rowOffset[s] + r
+        col2d = self.segMap.colOffset[s] + c
+        return row2d, col2d
 
-    @abstractmethod
-    def convert_peaks_to_psana(row2d, col2d):
+    def convert_peaks_to_psana(self, row2d, col2d):
         """convert cheetah tile peak positions to psana positions"""
+        row2d = np.asarray(row2d)
+        col2d = np.asarray(col2d)
+        s = self.segMap.segs[(row2d // self.psanaDim.rows).astype(np.int64),
+                             (col2d // self.psanaDim.cols).astype(np.int64)]
+        r = row2d % self.psanaDim.rows
+        c = col2d % self.psanaDim.cols
+        return s, r, c
 
-    def pct(self, unassembled):
-        """psana cheetah transform: convert psana unassembled detector to cheetah tile shape"""
-        counter = 0
-        img = np.zeros(self.tileDim)
-        for quad in range(self.quads.numQuad):
-            for seg in range(self.quads.numAsicsPerQuad):
-                img[seg * self.psanaDim.rows:(seg + 1) * self.psanaDim.rows,
-                    quad * self.psanaDim.cols:(quad + 1) * self.psanaDim.cols] = unassembled[counter, :, :]
-                counter += 1
-
-        return img
-
-    def ipct(self, tile):
-        """inverse psana cheetah transform: convert cheetah tile to psana unassembled detector shape"""
-        calib = np.zeros((self.quads.numQuad * self.quads.numAsicsPerQuad, self.psanaDim.rows, self.psanaDim.cols))
-        counter = 0
-        for quad in range(self.quads.numQuad):
-            for seg in range(self.quads.numAsicsPerQuad):
-                calib[counter, :, :] = \
-                    tile[seg * self.psanaDim.rows:(seg + 1) * self.psanaDim.rows,
-                         quad * self.psanaDim.cols:(quad + 1) * self.psanaDim.cols]
-                counter += 1
-        return calib
+    def pct(self, unassembled, out=None, dtype=np.float64):
+        """psana cheetah transform: convert psana unassembled detector to cheetah tile shape
+        :param unassembled: psana unassembled detector (seg, row, col)
+        :param out: optional C-contiguous output tile to write into, avoids allocating a new tile
+        :param dtype: dtype of the new tile when out is not given
+        """
+        numQuad, numAsicsPerQuad = self.quads
+        rows, cols = self.psanaDim.rows, self.psanaDim.cols
+        if out is None:
+            out = np.empty(self.tileDim, dtype=dtype)
+        # tile[seg*rows+r, quad*cols+c] = unassembled[quad*numAsicsPerQuad+seg, r, c]
+        out.reshape(numAsicsPerQuad, rows, numQuad, cols)[...] = \
+            np.reshape(unassembled, (numQuad, numAsicsPerQuad, rows, cols)).transpose(1, 2, 0, 3)
+        return out
+
+    def ipct(self, tile, out=None, dtype=np.float64):
+        """inverse psana cheetah transform: convert cheetah tile to psana unassembled detector shape
+        :param tile: cheetah tile (dim0, dim1)
+        :param out: optional C-contiguous output array (seg, row, col) to write into
+        :param dtype: dtype of the new array when out is not given
+        """
+        numQuad, numAsicsPerQuad = self.quads
+        rows, cols = self.psanaDim.rows, self.psanaDim.cols
+        if out is None:
+            out = np.empty((numQuad * numAsicsPerQuad, rows, cols), dtype=dtype)
+        out.reshape(numQuad, numAsicsPerQuad, rows, cols)[...] = \
+            np.reshape(tile, (numAsicsPerQuad, rows, numQuad, cols)).transpose(2, 0, 1, 3)
+        return out
 
 class cspad(DetectorDescriptor):
 
@@ -92,23 +119,6 @@ class cspad(DetectorDescriptor):
         Quads = namedtuple('Quads', ['numQuad', 'numAsicsPerQuad'])
         return Quads(numQuad=4, numAsicsPerQuad=8)
 
-    def convert_peaks_to_cheetah(self, s, r, c):
-        """convert psana peak positions to cheetah tile positions"""
-        if isinstance(s, np.ndarray):
-            s = s.astype('int')
-            r = r.astype('int')
-            c = c.astype('int')
-        row2d = (s % self.quads.numAsicsPerQuad) * self.psanaDim.rows + r  # where s%8 is a segment in quad number [0,7]
-        col2d = (s / self.quads.numAsicsPerQuad) * self.psanaDim.cols + c  # where s/8 is a quad number [0,3]
-        return row2d, col2d
-
-    def convert_peaks_to_psana(self, row2d, col2d):
-        """convert cheetah tile peak positions to psana positions"""
-        s = (row2d / self.psanaDim.rows) + (col2d / self.psanaDim.cols * self.quads.numAsicsPerQuad)
-        r = row2d % self.psanaDim.rows
-        c = col2d % self.psanaDim.cols
-        return s, r, c
-
 class epix10k2m(DetectorDescriptor):
 
     @property
@@ -123,19 +133,6 @@ class epix10k2m(DetectorDescriptor):
         Quads = namedtuple('Quads', ['numQuad', 'numAsicsPerQuad'])
         return Quads(numQuad=1, numAsicsPerQuad=16)
 
-    def convert_peaks_to_cheetah(self, s, r, c):
-        """convert psana peak positions to cheetah tile positions"""
-        row2d = s * self.psanaDim.rows + r
-        col2d = c
-        return row2d, col2d
-
-    def convert_peaks_to_psana(self, row2d, col2d):
-        """convert cheetah tile peak positions to psana positions"""
-        s = (row2d / self.psanaDim.rows) + (col2d / self.psanaDim.cols)
-        r = row2d % self.psanaDim.rows
-        c = col2d % self.psanaDim.cols
-        return s, r, c
-
 class jungfrau4m(DetectorDescriptor):
 
     @property
@@ -150,19 +147,6 @@ class jungfrau4m(DetectorDescriptor):
         Quads = namedtuple('Quads', ['numQuad', 'numAsicsPerQuad'])
         return Quads(numQuad=1, numAsicsPerQuad=8)
 
-    def convert_peaks_to_cheetah(self, s, r, c):
-        """convert psana peak positions to cheetah tile positions"""
-        row2d = s * self.psanaDim.rows + r
-        col2d = c
-        return row2d, col2d
-
-    def convert_peaks_to_psana(self, row2d, col2d):
-        """convert cheetah tile peak positions to psana positions"""
-        s = (row2d / self.psanaDim.rows)
-        r = row2d % self.psanaDim.rows
-        c = col2d
-        return s, r, c
-
 class rayonix(DetectorDescriptor):
 
     @property
@@ -177,19 +161,6 @@ class rayonix(DetectorDescriptor):
         Quads = namedtuple('Quads', ['numQuad', 'numAsicsPerQuad'])
         return Quads(numQuad=1, numAsicsPerQuad=1)
 
-    def convert_peaks_to_cheetah(self, s, r, c):
-        """convert psana peak positions to cheetah tile positions"""
-        row2d = r
-        col2d = c
-        return row2d, col2d
-
-    def convert_peaks_to_psana(self, row2d, col2d):
-        """convert cheetah tile peak positions to psana positions"""
-        s = 0
-        r = row2d
-        c = col2d
-        return s, r, c
-
 def invertBinaryImage(img):
     """For a binary image, swap 0s and 1s"""
     return -1*(img-1)
@@ -36,6 +36,8 @@ parser.add_argument("--psanaMask_unbondnrs",help="psana unbonded pixel neighbors
 parser.add_argument("-v","--verbose",help="verbosity of output for debugging, 1=print, 2=print+plot",default=0, type=int)
 parser.add_argument("--localCalib", help="use local calib directory, default=False", action='store_true')
 parser.add_argument("--tag",help="cxi file tag",default="", type=str)
+parser.add_argument("--batchSize", help="number of events each client sends to the master at a time", default=100, type=int)
+parser.add_argument("--batchInterval", help="maximum number of seconds a client holds on to its results", default=5, type=float)
 args = parser.parse_args()
 
 def getNoe(args):
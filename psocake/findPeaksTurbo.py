@@ -63,7 +63,16 @@ parser.add_argument("--minRes", help="Index only if above minimum resolution",de
 parser.add_argument("--localCalib", help="Use local calib directory. A calib directory must exist in your current working directory.", action='store_true')
 parser.add_argument("--profile", help="Turn on profiling. Saves timing information for calibration, peak finding, and saving to hdf5", action='store_true')
 parser.add_argument("--cxiVersion", help="cxi version",default=140, type=int)
+parser.add_argument("--writeBuffer", help="number of hits buffered in memory before writing to hdf5",default=64, type=int)
+parser.add_argument("--scheduler", help="event scheduling: static (contiguous block per rank) or dynamic (batches handed out on demand)",default="static", type=str)
+parser.add_argument("--schedulerBatch", help="number of events per batch for the dynamic scheduler",default=8, type=int)
+parser.add_argument("--singleFile", help="all ranks write their hits into the master .cxi with parallel hdf5 (driver='mpio') instead of one .cxi per rank. Writes are collective: whenever any rank has min(--writeBuffer, --imageBuffer) hits buffered, every rank stops after its current event to write, so ranks wait for the slowest one at each write; larger buffers mean fewer waits but more memory. Evr codes are not saved", action='store_true')
+parser.add_argument("--imageBuffer", help="number of hit images held in memory per rank in --singleFile mode, hits are written once a rank has min(--writeBuffer, --imageBuffer) of them", default=8, type=int)
+parser.add_argument("--vds", help="write the hits of all ranks into the master .cxi as HDF5 virtual datasets", action='store_true')
+parser.add_argument("--prefetch", help="number of events fetched and calibrated ahead of peak finding, 0 to calibrate in the main thread", default=4, type=int)
+parser.add_argument("--peakCache", help="directory of a persistent per-event peak cache. Reruns with the same calib constants and peak finding parameters only recalibrate the hits passing minPeaks, maxPeaks and minRes. Cached misses are not calibrated, so powderMisses and _maxMisses then only include uncached misses; the number left out is saved in the peakCacheMisses attribute of powderMisses. Leave unset when a complete powder of misses is needed", default="", type=str)
 parser.add_argument("--auto", help="automatically determine peak finding parameter per event", default="False", type=str)
+parser.add_argument("--geomCache", help="directory of a persistent cache of detector masks and geometry, reused by jobs with the same calib constants. The arrays are shared between the ranks of a node either way", default="", type=str)
 # LCLS specific
 parser.add_argument("-a","--access", help="Set data node access: {ana,ffb}",default="ana", type=str)
 parser.add_argument("-t","--tag", help="Set tag for cxi filename",default="", type=str)
@@ -73,6 +82,7 @@ parser.add_argument("--cm1", help="Psana common mode correction parameter 1",def
 parser.add_argument("--cm2", help="Psana common mode correction parameter 2",default=0, type=int)
 parser.add_argument("--cm3", help="Psana common mode correction parameter 3",default=0, type=int)
 args = parser.parse_args()
+if args.singleFile: assert h5py.get_config().mpi, '--singleFile requires h5py built with parallel hdf5'
 if args.localCalib: psana.setOption('psana.calib-dir','./calib')
 
 # Get number of events to process all together
@@ -113,26 +123,29 @@ if rank == 0:
     # outDir already contains runStr, so set run = None
     cheetahUtils.saveCheetahFormatMask(args.outDir, detDesc, None, combinedMask)
 
-def createCxi(fname):
+# per-hit datasets cropped to the number of hits in each per-rank .cxi
+vdsDatasets = ['/LCLS/eventNumber', '/LCLS/machineTime', '/LCLS/machineTimeNanoSeconds', '/LCLS/fiducial',
+               '/LCLS/photon_energy_eV', '/LCLS/detector_1/EncoderValue',
+               '/entry_1/instrument_1/detector_1/data', '/entry_1/result_1/nPeaks',
+               '/entry_1/result_1/peakXPosRaw', '/entry_1/result_1/peakYPosRaw',
+               '/entry_1/result_1/rcent', '/entry_1/result_1/ccent',
+               '/entry_1/result_1/rmin', '/entry_1/result_1/rmax',
+               '/entry_1/result_1/cmin', '/entry_1/result_1/cmax',
+               '/entry_1/result_1/peakTotalIntensity', '/entry_1/result_1/peakMaxIntensity',
+               '/entry_1/result_1/peakRadius']
+
+def createCxi(fname, comm=None):
     # Create hdf5 and save psana input
-    myHdf5 = h5py.File(fname, 'w')
-    myHdf5['/status/findPeaks'] = 'fail'
-    # Save user input arguments
-    dt = h5py.special_dtype(vlen=bytes)
-    myInput = ""
-    for key,value in vars(args).items():
-        myInput += key
-        myInput += " "
-        myInput += str(value)
-        myInput += "\n"
-    dset = myHdf5.create_dataset("/psocake/input",(1,), dtype=dt)
-    dset[...] = myInput
-    #myHdf5.flush()
-
-    myHdf5.create_dataset("cxi_version", data=args.cxiVersion)
-    #myHdf5.flush()
+    # With comm, all ranks create the master .cxi of --singleFile together. Parallel hdf5 allocates
+    # the storage of every dataset up front, so per-hit datasets start empty and grow collectively
+    # as hits are written, and rank 0 adds the rest with addCxiInfo once the file is closed.
+    if comm is None:
+        myHdf5 = h5py.File(fname, 'w')
+        rows = numJobs
+    else:
+        myHdf5 = h5py.File(fname, 'w', driver='mpio', comm=comm)
+        rows = 0
 
-    dt = h5py.special_dtype(vlen=np.float)
     dti = h5py.special_dtype(vlen=np.dtype('int32'))
 
     ###################
@@ -140,148 +153,148 @@ def createCxi(fname):
     ###################
     lcls_1 = myHdf5.create_group("LCLS")
     lcls_detector_1 = lcls_1.create_group("detector_1")
-    ds_lclsDet_1 = lcls_detector_1.create_dataset("EncoderValue",(numJobs,),
+    ds_lclsDet_1 = lcls_detector_1.create_dataset("EncoderValue",(rows,),
                                                   maxshape=(None,),
                                                   dtype=float)
     ds_lclsDet_1.attrs["axes"] = "experiment_identifier"
 
-    ds_ebeamCharge_1 = lcls_detector_1.create_dataset("electronBeamEnergy",(numJobs,),
+    ds_ebeamCharge_1 = lcls_detector_1.create_dataset("electronBeamEnergy",(rows,),
                                                       maxshape=(None,),
                                                       dtype=float)
     ds_ebeamCharge_1.attrs["axes"] = "experiment_identifier"
 
-    ds_beamRepRate_1 = lcls_detector_1.create_dataset("beamRepRate",(numJobs,),
+    ds_beamRepRate_1 = lcls_detector_1.create_dataset("beamRepRate",(rows,),
                                                       maxshape=(None,),
                                                       dtype=float)
     ds_beamRepRate_1.attrs["axes"] = "experiment_identifier"
 
-    ds_particleN_electrons_1 = lcls_detector_1.create_dataset("particleN_electrons",(numJobs,),
+    ds_particleN_electrons_1 = lcls_detector_1.create_dataset("particleN_electrons",(rows,),
                                                               maxshape=(None,),
                                                               dtype=float)
     ds_particleN_electrons_1.attrs["axes"] = "experiment_identifier"
 
-    ds_eVernier_1 = lcls_1.create_dataset("eVernier",(numJobs,),
+    ds_eVernier_1 = lcls_1.create_dataset("eVernier",(rows,),
                                           maxshape=(None,),
                                           dtype=float)
     ds_eVernier_1.attrs["axes"] = "experiment_identifier"
 
-    ds_charge_1 = lcls_1.create_dataset("charge",(numJobs,),
+    ds_charge_1 = lcls_1.create_dataset("charge",(rows,),
                                         maxshape=(None,),
                                         dtype=float)
     ds_charge_1.attrs["axes"] = "experiment_identifier"
 
-    ds_peakCurrentAfterSecondBunchCompressor_1 = lcls_1.create_dataset("peakCurrentAfterSecondBunchCompressor",(numJobs,),
+    ds_peakCurrentAfterSecondBunchCompressor_1 = lcls_1.create_dataset("peakCurrentAfterSecondBunchCompressor",(rows,),
                                                                        maxshape=(None,),
                                                                        dtype=float)
     ds_peakCurrentAfterSecondBunchCompressor_1.attrs["axes"] = "experiment_identifier"
 
-    ds_pulseLength_1 = lcls_1.create_dataset("pulseLength",(numJobs,),
+    ds_pulseLength_1 = lcls_1.create_dataset("pulseLength",(rows,),
                                              maxshape=(None,),
                                              dtype=float)
     ds_pulseLength_1.attrs["axes"] = "experiment_identifier"
 
-    ds_ebeamEnergyLossConvertedToPhoton_mJ_1 = lcls_1.create_dataset("ebeamEnergyLossConvertedToPhoton_mJ",(numJobs,),
+    ds_ebeamEnergyLossConvertedToPhoton_mJ_1 = lcls_1.create_dataset("ebeamEnergyLossConvertedToPhoton_mJ",(rows,),
                                                                      maxshape=(None,),
                                                                      dtype=float)
     ds_ebeamEnergyLossConvertedToPhoton_mJ_1.attrs["axes"] = "experiment_identifier"
 
-    ds_calculatedNumberOfPhotons_1 = lcls_1.create_dataset("calculatedNumberOfPhotons",(numJobs,),
+    ds_calculatedNumberOfPhotons_1 = lcls_1.create_dataset("calculatedNumberOfPhotons",(rows,),
                                                            maxshape=(None,),
                                                            dtype=float)
     ds_calculatedNumberOfPhotons_1.attrs["axes"] = "experiment_identifier"
 
-    ds_photonBeamEnergy_1 = lcls_1.create_dataset("photonBeamEnergy",(numJobs,),
+    ds_photonBeamEnergy_1 = lcls_1.create_dataset("photonBeamEnergy",(rows,),
                                                   maxshape=(None,),
                                                   dtype=float)
     ds_photonBeamEnergy_1.attrs["axes"] = "experiment_identifier"
 
-    ds_wavelength_1 = lcls_1.create_dataset("wavelength",(numJobs,),
+    ds_wavelength_1 = lcls_1.create_dataset("wavelength",(rows,),
                                             maxshape=(None,),
                                             dtype=float)
     ds_wavelength_1.attrs["axes"] = "experiment_identifier"
 
-    ds_sec_1 = lcls_1.create_dataset("machineTime",(numJobs,),
+    ds_sec_1 = lcls_1.create_dataset("machineTime",(rows,),
                                      maxshape=(None,),
                                      dtype=int)
     ds_sec_1.attrs["axes"] = "experiment_identifier"
 
-    ds_nsec_1 = lcls_1.create_dataset("machineTimeNanoSeconds",(numJobs,),
+    ds_nsec_1 = lcls_1.create_dataset("machineTimeNanoSeconds",(rows,),
                                       maxshape=(None,),
                                       dtype=int)
     ds_nsec_1.attrs["axes"] = "experiment_identifier"
 
-    ds_fid_1 = lcls_1.create_dataset("fiducial",(numJobs,),
+    ds_fid_1 = lcls_1.create_dataset("fiducial",(rows,),
                                      maxshape=(None,),
                                      dtype=int)
     ds_fid_1.attrs["axes"] = "experiment_identifier"
 
-    ds_photonEnergy_1 = lcls_1.create_dataset("photon_energy_eV",(numJobs,),
+    ds_photonEnergy_1 = lcls_1.create_dataset("photon_energy_eV",(rows,),
                                               maxshape=(None,),
                                               dtype=float) # photon energy in eV
     ds_photonEnergy_1.attrs["axes"] = "experiment_identifier"
 
-    ds_wavelengthA_1 = lcls_1.create_dataset("photon_wavelength_A",(numJobs,),
+    ds_wavelengthA_1 = lcls_1.create_dataset("photon_wavelength_A",(rows,),
                                              maxshape=(None,),
                                              dtype=float)
     ds_wavelengthA_1.attrs["axes"] = "experiment_identifier"
 
     #### Datasets not in Cheetah ###
-    ds_evtNum_1 = lcls_1.create_dataset("eventNumber",(numJobs,),
+    ds_evtNum_1 = lcls_1.create_dataset("eventNumber",(rows,),
                                         maxshape=(None,),
                                         dtype=int)
     ds_evtNum_1.attrs["axes"] = "experiment_identifier"
 
-    ds_evr0_1 = lcls_detector_1.create_dataset("evr0",(numJobs,),
+    ds_evr0_1 = lcls_detector_1.create_dataset("evr0",(rows,),
                                                maxshape=(None,),
                                                dtype=dti)
     ds_evr0_1.attrs["axes"] = "experiment_identifier"
 
-    ds_evr1_1 = lcls_detector_1.create_dataset("evr1",(numJobs,),
+    ds_evr1_1 = lcls_detector_1.create_dataset("evr1",(rows,),
                                                maxshape=(None,),
                                                dtype=dti)
     ds_evr1_1.attrs["axes"] = "experiment_identifier"
 
-    ds_evr2_1 = lcls_detector_1.create_dataset("evr2",(numJobs,),
+    ds_evr2_1 = lcls_detector_1.create_dataset("evr2",(rows,),
                                                maxshape=(None,),
                                                dtype=dti)
     ds_evr2_1.attrs["axes"] = "experiment_identifier"
 
-    ds_ttspecAmpl_1 = lcls_1.create_dataset("ttspecAmpl",(numJobs,),
+    ds_ttspecAmpl_1 = lcls_1.create_dataset("ttspecAmpl",(rows,),
                                             maxshape=(None,),
                                             dtype=float)
     ds_ttspecAmpl_1.attrs["axes"] = "experiment_identifier"
 
-    ds_ttspecAmplNxt_1 = lcls_1.create_dataset("ttspecAmplNxt",(numJobs,),
+    ds_ttspecAmplNxt_1 = lcls_1.create_dataset("ttspecAmplNxt",(rows,),
                                                maxshape=(None,),
                                                dtype=float)
     ds_ttspecAmplNxt_1.attrs["axes"] = "experiment_identifier"
 
-    ds_ttspecFltpos_1 = lcls_1.create_dataset("ttspecFltPos",(numJobs,),
+    ds_ttspecFltpos_1 = lcls_1.create_dataset("ttspecFltPos",(rows,),
                                               maxshape=(None,),
                                               dtype=float)
     ds_ttspecFltpos_1.attrs["axes"] = "experiment_identifier"
 
-    ds_ttspecFltposFwhm_1 = lcls_1.create_dataset("ttspecFltPosFwhm",(numJobs,),
+    ds_ttspecFltposFwhm_1 = lcls_1.create_dataset("ttspecFltPosFwhm",(rows,),
                                                   maxshape=(None,),
                                                   dtype=float)
     ds_ttspecFltposFwhm_1.attrs["axes"] = "experiment_identifier"
 
-    ds_ttspecFltposPs_1 = lcls_1.create_dataset("ttspecFltPosPs",(numJobs,),
+    ds_ttspecFltposPs_1 = lcls_1.create_dataset("ttspecFltPosPs",(rows,),
                                                 maxshape=(None,),
                                                 dtype=float)
     ds_ttspecFltposPs_1.attrs["axes"] = "experiment_identifier"
 
-    ds_ttspecRefAmpl_1 = lcls_1.create_dataset("ttspecRefAmpl",(numJobs,),
+    ds_ttspecRefAmpl_1 = lcls_1.create_dataset("ttspecRefAmpl",(rows,),
                                                maxshape=(None,),
                                                dtype=float)
     ds_ttspecRefAmpl_1.attrs["axes"] = "experiment_identifier"
 
     lcls_injector_1 = lcls_1.create_group("injector_1")
-    ds_pressure_1 = lcls_injector_1.create_dataset("pressureSDS",(numJobs,),
+    ds_pressure_1 = lcls_injector_1.create_dataset("pressureSDS",(rows,),
                                                    maxshape=(None,),
                                                    dtype=float)
     ds_pressure_1.attrs["axes"] = "experiment_identifier"
-    ds_pressure_2 = lcls_injector_1.create_dataset("pressureSDSB",(numJobs,),
+    ds_pressure_2 = lcls_injector_1.create_dataset("pressureSDSB",(rows,),
                                                    maxshape=(None,),
                                                    dtype=float)
     ds_pressure_2.attrs["axes"] = "experiment_identifier"
@@ -292,36 +305,12 @@ def createCxi(fname):
     # entry_1
     ###################
     entry_1 = myHdf5.create_group("entry_1")
-    ds_expId = entry_1.create_dataset("experimental_identifier",(numJobs,),
+    ds_expId = entry_1.create_dataset("experimental_identifier",(rows,),
                                       maxshape=(None,),
                                       dtype=int)
     ds_expId.attrs["axes"] = "experiment_identifier"
 
-    myHdf5.create_dataset("/entry_1/result_1/nPeaksAll", data=np.ones(numJobs,)*-1, dtype=int)
-    myHdf5.create_dataset("/entry_1/result_1/peakXPosRawAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
-    myHdf5.create_dataset("/entry_1/result_1/peakYPosRawAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
-    myHdf5.create_dataset("/entry_1/result_1/peakTotalIntensityAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
-    myHdf5.create_dataset("/entry_1/result_1/peakMaxIntensityAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
-    myHdf5.create_dataset("/entry_1/result_1/peakRadiusAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
-    myHdf5.create_dataset("/entry_1/result_1/maxResAll", data=np.ones(numJobs,)*-1, dtype=int)
-    myHdf5.create_dataset("/entry_1/result_1/likelihoodAll", data=np.ones(numJobs, ) * -1, dtype=float)
-
-    myHdf5.create_dataset("/entry_1/result_1/timeToolDelayAll", data=np.ones(numJobs, ) * -1, dtype=float)
-    myHdf5.create_dataset("/entry_1/result_1/laserTimeZeroAll", data=np.ones(numJobs, ) * -1, dtype=float)
-    myHdf5.create_dataset("/entry_1/result_1/laserTimeDelayAll", data=np.ones(numJobs, ) * -1, dtype=float)
-    myHdf5.create_dataset("/entry_1/result_1/laserTimePhaseLockedAll", data=np.ones(numJobs, ) * -1, dtype=float)
-    #myHdf5.flush()
-
-    if args.profile:
-        myHdf5.create_dataset("/entry_1/result_1/calibTime", data=np.zeros(numJobs, ), dtype=float)
-        myHdf5.create_dataset("/entry_1/result_1/peakTime", data=np.zeros(numJobs, ), dtype=float)
-        myHdf5.create_dataset("/entry_1/result_1/saveTime", data=np.zeros(numJobs, ), dtype=float)
-        myHdf5.create_dataset("/entry_1/result_1/reshapeTime", (0,), maxshape=(None,), dtype=float)
-        myHdf5.create_dataset("/entry_1/result_1/totalTime", data=np.zeros(numJobs, ), dtype=float)
-        myHdf5.create_dataset("/entry_1/result_1/rankID", data=np.zeros(numJobs, ), dtype=int)
-        #myHdf5.flush()
-
-    ds_nPeaks = myHdf5.create_dataset("/entry_1/result_1/nPeaks",(numJobs,),
+    ds_nPeaks = myHdf5.create_dataset("/entry_1/result_1/nPeaks",(rows,),
                                       maxshape=(None,),
                                       dtype=int)
     ds_nPeaks.attrs["axes"] = "experiment_identifier"
@@ -329,110 +318,108 @@ def createCxi(fname):
     ds_nPeaks.attrs["minPeaks"] = args.minPeaks
     ds_nPeaks.attrs["maxPeaks"] = args.maxPeaks
     ds_nPeaks.attrs["minRes"] = args.minRes
-    ds_posX = myHdf5.create_dataset("/entry_1/result_1/peakXPosRaw",(numJobs,args.maxPeaks),
+    # chunk several hits together so buffered hits are written in few chunks,
+    # but keep chunks well below the default 1MB chunk cache of the readers
+    peakChunks = (max(1, min(args.writeBuffer, 16)), args.maxPeaks)
+    ds_posX = myHdf5.create_dataset("/entry_1/result_1/peakXPosRaw",(rows,args.maxPeaks),
                                     maxshape=(None,args.maxPeaks),
-                                    chunks = (1, args.maxPeaks),
+                                    chunks=peakChunks,
                                     dtype=float)
     ds_posX.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_posY = myHdf5.create_dataset("/entry_1/result_1/peakYPosRaw",(numJobs,args.maxPeaks),
+    ds_posY = myHdf5.create_dataset("/entry_1/result_1/peakYPosRaw",(rows,args.maxPeaks),
                                     maxshape=(None,args.maxPeaks),
-                                    chunks=(1, args.maxPeaks),
+                                    chunks=peakChunks,
                                     dtype=float)
     ds_posY.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_rcent = myHdf5.create_dataset("/entry_1/result_1/rcent", (numJobs, args.maxPeaks),
+    ds_rcent = myHdf5.create_dataset("/entry_1/result_1/rcent", (rows, args.maxPeaks),
                                      maxshape=(None, args.maxPeaks),
-                                     chunks=(1, args.maxPeaks),
+                                     chunks=peakChunks,
                                      dtype=float)
     ds_rcent.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_ccent = myHdf5.create_dataset("/entry_1/result_1/ccent", (numJobs, args.maxPeaks),
+    ds_ccent = myHdf5.create_dataset("/entry_1/result_1/ccent", (rows, args.maxPeaks),
                                      maxshape=(None, args.maxPeaks),
-                                     chunks=(1, args.maxPeaks),
+                                     chunks=peakChunks,
                                      dtype=float)
     ds_ccent.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_rmin = myHdf5.create_dataset("/entry_1/result_1/rmin", (numJobs, args.maxPeaks),
+    ds_rmin = myHdf5.create_dataset("/entry_1/result_1/rmin", (rows, args.maxPeaks),
                                      maxshape=(None, args.maxPeaks),
-                                     chunks=(1, args.maxPeaks),
+                                     chunks=peakChunks,
                                      dtype=float)
     ds_rmin.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_rmax = myHdf5.create_dataset("/entry_1/result_1/rmax", (numJobs, args.maxPeaks),
+    ds_rmax = myHdf5.create_dataset("/entry_1/result_1/rmax", (rows, args.maxPeaks),
                                      maxshape=(None, args.maxPeaks),
-                                     chunks=(1, args.maxPeaks),
+                                     chunks=peakChunks,
                                      dtype=float)
     ds_rmax.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_cmin = myHdf5.create_dataset("/entry_1/result_1/cmin", (numJobs, args.maxPeaks),
+    ds_cmin = myHdf5.create_dataset("/entry_1/result_1/cmin", (rows, args.maxPeaks),
                                      maxshape=(None, args.maxPeaks),
-                                     chunks=(1, args.maxPeaks),
+                                     chunks=peakChunks,
                                      dtype=float)
     ds_cmin.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_cmax = myHdf5.create_dataset("/entry_1/result_1/cmax", (numJobs, args.maxPeaks),
+    ds_cmax = myHdf5.create_dataset("/entry_1/result_1/cmax", (rows, args.maxPeaks),
                                      maxshape=(None, args.maxPeaks),
-                                     chunks=(1, args.maxPeaks),
+                                     chunks=peakChunks,
                                      dtype=float)
     ds_cmax.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_atot = myHdf5.create_dataset("/entry_1/result_1/peakTotalIntensity",(numJobs,args.maxPeaks),
+    ds_atot = myHdf5.create_dataset("/entry_1/result_1/peakTotalIntensity",(rows,args.maxPeaks),
                                     maxshape=(None,args.maxPeaks),
-                                    chunks=(1, args.maxPeaks),
+                                    chunks=peakChunks,
                                     dtype=float)
 
     ds_atot.attrs["axes"] = "experiment_identifier:peaks"
-    ds_amax = myHdf5.create_dataset("/entry_1/result_1/peakMaxIntensity", (numJobs,args.maxPeaks),
+    ds_amax = myHdf5.create_dataset("/entry_1/result_1/peakMaxIntensity", (rows,args.maxPeaks),
                                     maxshape = (None,args.maxPeaks),
-                                    chunks = (1,args.maxPeaks),
+                                    chunks=peakChunks,
                                     dtype=float)
     ds_amax.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_radius = myHdf5.create_dataset("/entry_1/result_1/peakRadius",(numJobs,args.maxPeaks),
+    ds_radius = myHdf5.create_dataset("/entry_1/result_1/peakRadius",(rows,args.maxPeaks),
                                      maxshape=(None,args.maxPeaks),
-                                     chunks=(1, args.maxPeaks),
+                                     chunks=peakChunks,
                                      dtype=float)
     ds_radius.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_maxRes = myHdf5.create_dataset("/entry_1/result_1/maxRes",(numJobs,),
+    ds_maxRes = myHdf5.create_dataset("/entry_1/result_1/maxRes",(rows,),
                                      maxshape=(None,),
                                      dtype=int)
     ds_maxRes.attrs["axes"] = "experiment_identifier:peaks"
 
-    ds_likelihood = myHdf5.create_dataset("/entry_1/result_1/likelihood",(numJobs,),
+    ds_likelihood = myHdf5.create_dataset("/entry_1/result_1/likelihood",(rows,),
                                          maxshape=(None,),
                                          dtype=float)
     ds_likelihood.attrs["axes"] = "experiment_identifier"
 
-    ds_timeToolDelay = myHdf5.create_dataset("/entry_1/result_1/timeToolDelay",(numJobs,),
+    ds_timeToolDelay = myHdf5.create_dataset("/entry_1/result_1/timeToolDelay",(rows,),
                                              maxshape=(None,),
                                              dtype=float)
     ds_timeToolDelay.attrs["axes"] = "experiment_identifier"
 
-    ds_laserTimeZero = myHdf5.create_dataset("/entry_1/result_1/laserTimeZero",(numJobs,),
+    ds_laserTimeZero = myHdf5.create_dataset("/entry_1/result_1/laserTimeZero",(rows,),
                                              maxshape=(None,),
                                              dtype=float)
     ds_laserTimeZero.attrs["axes"] = "experiment_identifier"
 
-    ds_laserTimeDelay = myHdf5.create_dataset("/entry_1/result_1/laserTimeDelay",(numJobs,),
+    ds_laserTimeDelay = myHdf5.create_dataset("/entry_1/result_1/laserTimeDelay",(rows,),
                                              maxshape=(None,),
                                              dtype=float)
     ds_laserTimeDelay.attrs["axes"] = "experiment_identifier"
 
-    ds_laserTimePhaseLocked = myHdf5.create_dataset("/entry_1/result_1/laserTimePhaseLocked",(numJobs,),
+    ds_laserTimePhaseLocked = myHdf5.create_dataset("/entry_1/result_1/laserTimePhaseLocked",(rows,),
                                                    maxshape=(None,),
                                                    dtype=float)
     ds_laserTimePhaseLocked.attrs["axes"] = "experiment_identifier"
 
     #myHdf5.flush()
 
-    entry_1.create_dataset("start_time",data=0)#ps.getStartTime())
-    sample_1 = entry_1.create_group("sample_1")
-    sample_1.create_dataset("name",data=args.sample)
     instrument_1 = entry_1.create_group("instrument_1")
-    instrument_1.create_dataset("name", data=args.instrument)
-    #myHdf5.flush()
 
     source_1 = instrument_1.create_group("source_1")
     ds_photonEnergy = source_1.create_dataset("energy",(0,),
@@ -452,7 +439,7 @@ def createCxi(fname):
     #myHdf5.flush()
 
     detector_1 = instrument_1.create_group("detector_1")
-    ds_data_1 = detector_1.create_dataset("data", (numJobs, dim0, dim1),
+    ds_data_1 = detector_1.create_dataset("data", (rows, dim0, dim1),
                                          chunks=(1, dim0, dim1),
                                          maxshape=(None, dim0, dim1),
                                          dtype=np.float32)
@@ -497,27 +484,74 @@ def createCxi(fname):
                               maxshape=(dim0, dim1),
                               dtype=float)
 
-    ds_dist_1 = detector_1.create_dataset("distance",(numJobs,),
+    ds_dist_1 = detector_1.create_dataset("distance",(rows,),
                                          maxshape=(None,),
                                          dtype=float) # in meters
     ds_dist_1.attrs["axes"] = "experiment_identifier"
 
-    ds_x_pixel_size_1 = detector_1.create_dataset("x_pixel_size",(numJobs,),
+    ds_x_pixel_size_1 = detector_1.create_dataset("x_pixel_size",(rows,),
                                                  maxshape=(None,),
                                                  dtype=float)
     ds_x_pixel_size_1.attrs["axes"] = "experiment_identifier"
 
-    ds_y_pixel_size_1 = detector_1.create_dataset("y_pixel_size",(numJobs,),
+    ds_y_pixel_size_1 = detector_1.create_dataset("y_pixel_size",(rows,),
                                                  maxshape=(None,),
                                                  dtype=float)
     ds_y_pixel_size_1.attrs["axes"] = "experiment_identifier"
 
-    detector_1.create_dataset("description",data=args.det)
-    #myHdf5.flush()
+    if comm is None: addCxiInfo(myHdf5)
 
     # Close hdf5 file
     myHdf5.close()
 
+def addCxiInfo(myHdf5):
+    # Per-event datasets, status and strings, written serially since parallel hdf5
+    # can not write variable length data
+    myHdf5['/status/findPeaks'] = 'fail'
+    # Save user input arguments
+    dt = h5py.special_dtype(vlen=bytes)
+    myInput = ""
+    for key,value in vars(args).items():
+        myInput += key
+        myInput += " "
+        myInput += str(value)
+        myInput += "\n"
+    dset = myHdf5.create_dataset("/psocake/input",(1,), dtype=dt)
+    dset[...] = myInput
+    #myHdf5.flush()
+
+    myHdf5.create_dataset("cxi_version", data=args.cxiVersion)
+    #myHdf5.flush()
+
+    myHdf5.create_dataset("/entry_1/result_1/nPeaksAll", data=np.ones(numJobs,)*-1, dtype=int)
+    myHdf5.create_dataset("/entry_1/result_1/peakXPosRawAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
+    myHdf5.create_dataset("/entry_1/result_1/peakYPosRawAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
+    myHdf5.create_dataset("/entry_1/result_1/peakTotalIntensityAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
+    myHdf5.create_dataset("/entry_1/result_1/peakMaxIntensityAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
+    myHdf5.create_dataset("/entry_1/result_1/peakRadiusAll", (numJobs,args.maxPeaks), dtype=float, chunks=(1,args.maxPeaks))
+    myHdf5.create_dataset("/entry_1/result_1/maxResAll", data=np.ones(numJobs,)*-1, dtype=int)
+    myHdf5.create_dataset("/entry_1/result_1/likelihoodAll", data=np.ones(numJobs, ) * -1, dtype=float)
+
+    myHdf5.create_dataset("/entry_1/result_1/timeToolDelayAll", data=np.ones(numJobs, ) * -1, dtype=float)
+    myHdf5.create_dataset("/entry_1/result_1/laserTimeZeroAll", data=np.ones(numJobs, ) * -1, dtype=float)
+    myHdf5.create_dataset("/entry_1/result_1/laserTimeDelayAll", data=np.ones(numJobs, ) * -1, dtype=float)
+    myHdf5.create_dataset("/entry_1/result_1/laserTimePhaseLockedAll", data=np.ones(numJobs, ) * -1, dtype=float)
+    #myHdf5.flush()
+
+    if args.profile:
+        myHdf5.create_dataset("/entry_1/result_1/calibTime", data=np.zeros(numJobs, ), dtype=float)
+        myHdf5.create_dataset("/entry_1/result_1/peakTime", data=np.zeros(numJobs, ), dtype=float)
+        myHdf5.create_dataset("/entry_1/result_1/saveTime", data=np.zeros(numJobs, ), dtype=float)
+        myHdf5.create_dataset("/entry_1/result_1/reshapeTime", (0,), maxshape=(None,), dtype=float)
+        myHdf5.create_dataset("/entry_1/result_1/totalTime", data=np.zeros(numJobs, ), dtype=float)
+        myHdf5.create_dataset("/entry_1/result_1/rankID", data=np.zeros(numJobs, ), dtype=int)
+        #myHdf5.flush()
+
+    myHdf5.create_dataset("/entry_1/start_time",data=0)#ps.getStartTime())
+    myHdf5.create_dataset("/entry_1/sample_1/name",data=args.sample)
+    myHdf5.create_dataset("/entry_1/instrument_1/name", data=args.instrument)
+    myHdf5.create_dataset("/entry_1/instrument_1/detector_1/description",data=args.det)
+
 # Remove all previous .cxi files (important if rerun with reduced ranks)
 def removeOldCxi():
     if args.tag:
@@ -562,16 +596,23 @@ if rank == 0:
 comm.Barrier()
 
 # create .cxi per rank
-fname = args.outDir + '/' + args.exp +"_"+ runStr +"_"+str(rank)
-if args.tag: fname += '_' + args.tag
-fname += ".cxi"
-createCxi(fname)
+if not args.singleFile:
+    fname = args.outDir + '/' + args.exp +"_"+ runStr +"_"+str(rank)
+    if args.tag: fname += '_' + args.tag
+    fname += ".cxi"
+    createCxi(fname)
 
 # create master .cxi
-if rank == 0:
-    fnameAll = args.outDir + '/' + args.exp +"_"+ runStr
-    if args.tag: fnameAll += '_' + args.tag
-    fnameAll += ".cxi"
+fnameAll = args.outDir + '/' + args.exp +"_"+ runStr
+if args.tag: fnameAll += '_' + args.tag
+fnameAll += ".cxi"
+if args.singleFile:
+    createCxi(fnameAll, comm) # collective
+    if rank == 0:
+        with h5py.File(fnameAll, "r+") as F:
+            addCxiInfo(F)
+    comm.Barrier() # master .cxi is opened by all ranks
+elif rank == 0:
     createCxi(fnameAll)
 
 toc = time.time()
@@ -579,50 +620,82 @@ if rank == 0: print("h5 setup (rank, time): ", rank, toc-tic)
 
 tic = time.time()
 
-runclient(args,ds,run,times,det,numJobs,detDesc)
+numHits, numProcessed, nPeaksAll, numCachedMisses = runclient(args,ds,run,times,det,numJobs,detDesc)
 
 toc = time.time()
 if rank == 0: print("compute time (rank, time): ", rank, toc-tic)
 
-comm.Barrier()
+# Merge results across ranks in memory: every event is owned by exactly one rank
+# and unprocessed events are -1, so a max-reduction merges nPeaksAll as well as the powders
+powderHits = np.ascontiguousarray(detDesc.pct(det.peakFinder.powderHits), dtype=np.float64)
+powderMisses = np.ascontiguousarray(detDesc.pct(det.peakFinder.powderMisses), dtype=np.float64)
+nPeaksAll = np.ascontiguousarray(nPeaksAll, dtype=np.int64)
+if rank == 0:
+    maxHits = np.empty_like(powderHits)
+    maxMisses = np.empty_like(powderMisses)
+    nPeaksAllMerged = np.empty_like(nPeaksAll)
+else:
+    maxHits = maxMisses = nPeaksAllMerged = None
+comm.Reduce(powderHits, maxHits, op=MPI.MAX, root=0)
+comm.Reduce(powderMisses, maxMisses, op=MPI.MAX, root=0)
+comm.Reduce(nPeaksAll, nPeaksAllMerged, op=MPI.MAX, root=0)
+hitsPerRank = comm.gather(numHits, root=0)
+numProcessed = comm.reduce(numProcessed, op=MPI.SUM, root=0)
+numCachedMisses = comm.reduce(numCachedMisses, op=MPI.SUM, root=0)
+
+comm.Barrier() # per-rank .cxi files are closed
 
-# Write out a status_peaks.txt
+# Write out master .cxi and status_peaks.txt
 if rank == 0:
-    numHits = 0
-    numProcessed = 0
+    numHits = sum(hitsPerRank)
     masterFname = args.outDir + '/' + args.exp +"_"+ runStr
     if args.tag: masterFname += '_' + args.tag
     masterFname += ".cxi"
 
-    powderHits = None
-    powderMisses = None
     with h5py.File(masterFname,"r+") as F:
-        for i in range(size):
-            fname = args.outDir + '/' + args.exp +"_"+ runStr +"_"+str(i)
-            if args.tag: fname += '_' + args.tag
-            fname += ".cxi"
-            while not os.path.exists(fname):
-                time.sleep(1)
-            with h5py.File(fname,"r+") as f:
-                numHits += len(f['/LCLS/eventNumber'])
-                numProcessed += f["/LCLS/eventNumber"].attrs['numEvents']
-                # copy over nPeaks from other ranks
-                ind = np.where(f['/entry_1/result_1/nPeaksAll'][()]>-1)[0]
-                if len(ind) > 0:
-                    for i in ind:
-                        F['/entry_1/result_1/nPeaksAll'][i] = f['/entry_1/result_1/nPeaksAll'][i]
-                if powderHits is not None:
-                    powderHits = np.maximum(powderHits, f["/entry_1/data_1/powderHits"][()])
-                    powderMisses = np.maximum(powderMisses, f["/entry_1/data_1/powderMisses"][()])
-                else:
-                    powderHits = f["/entry_1/data_1/powderHits"][()]
-                    powderMisses = f["/entry_1/data_1/powderMisses"][()]
+        F['/entry_1/result_1/nPeaksAll'][...] = nPeaksAllMerged
         F["/LCLS/eventNumber"].attrs["numCores"] = size # use this to figure out how many files are generated
-        F["/entry_1/data_1/powderHits"][...] = powderHits
-        F["/entry_1/data_1/powderMisses"][...] = powderMisses
+        F["/LCLS/eventNumber"].attrs["singleFile"] = args.singleFile # hits are in the master .cxi
+        F["/entry_1/data_1/powderHits"][...] = maxHits
+        F["/entry_1/data_1/powderMisses"][...] = maxMisses
+        # misses served from the peak cache are not calibrated and so not in powderMisses
+        F["/entry_1/data_1/powderMisses"].attrs["peakCacheMisses"] = numCachedMisses
+        if numCachedMisses > 0:
+            print("powderMisses leaves out {} misses served from the peak cache".format(numCachedMisses))
 
         if args.mask is not None:
             F['/entry_1/data_1/mask'][:, :] = cheetahUtils.readMask(args.mask)
+
+        if args.singleFile:
+            F["/LCLS/eventNumber"].attrs["numEvents"] = numProcessed
+            del F['/status/findPeaks']
+            F['/status/findPeaks'] = 'success'
+            for name, powder in [("_maxHits", maxHits), ("_maxMisses", maxMisses)]:
+                fname = args.outDir + '/' + args.exp + "_" + runStr + name
+                if args.tag: fname += '_' + args.tag
+                fname += ".npy"
+                np.save(fname, detDesc.ipct(powder))
+        elif args.vds:
+            # concatenate the per-rank hits as virtual datasets instead of copying them
+            fnames = []
+            for i in range(size):
+                fname = args.exp +"_"+ runStr +"_"+str(i)
+                if args.tag: fname += '_' + args.tag
+                fname += ".cxi"
+                fnames.append(fname) # relative to the master file
+            for dset in vdsDatasets:
+                shape = (numHits,) + F[dset].shape[1:]
+                layout = h5py.VirtualLayout(shape=shape, dtype=F[dset].dtype)
+                offset = 0
+                for fname, n in zip(fnames, hitsPerRank):
+                    if n == 0: continue
+                    layout[offset:offset + n] = h5py.VirtualSource(fname, dset, shape=(n,) + shape[1:])
+                    offset += n
+                attrs = dict(F[dset].attrs)
+                del F[dset]
+                F.create_virtual_dataset(dset, layout, fillvalue=0)
+                for key, value in attrs.items():
+                    F[dset].attrs[key] = value
         print("Done writing master .cxi")
     hitRate = numHits * 100. / numProcessed
 
@@ -49,6 +49,8 @@ parser.add_argument("-a","--access", default="ana", type=str,
                     help="Set data node access: {ana,ffb}")
 parser.add_argument("--noInfiniband", action='store_true', help="Do not use infiniband.")
 parser.add_argument("-i","--inputImages", default="", type=str, help="full path to hdf5 file with calibrated CsPad images saved as /data/data and /eventNumber. It can be in a cheetah format (3D) or psana unassembled format (4D)")
+parser.add_argument("--imageCacheMB", default=512, type=int, help="memory cap of the calibrated and assembled image cache in MB")
+parser.add_argument("--prefetch", default=2, type=int, help="number of events on each side of the displayed event to prefetch, 0 disables prefetching")
 args = parser.parse_args()
 
 if 'label' in args.mode: import LabelingPanel
@@ -480,8 +482,9 @@ class MainFrame(QtGui.QWidget):
                             self.mk.userMaskAssem[indexY, indexX] = (1 - self.mk.userMaskAssem[indexY, indexX])
                         self.mk.displayMask()
 
-                        self.mk.userMask = self.det.ndarray_from_image(self.evt, self.mk.userMaskAssem,
-                                                                       pix_scale_size_um=None, xy0_off_pix=None)
+                        with self.img.psanaLock:
+                            self.mk.userMask = self.det.ndarray_from_image(self.evt, self.mk.userMaskAssem,
+                                                                           pix_scale_size_um=None, xy0_off_pix=None)
                         self.algInitDone = False
                         self.pk.updateClassification()
 
@@ -1,6 +1,6 @@
 import psana
 import numpy as np
-from mpidata import mpidata 
+from mpidata import mpidata, batchTag
 import HitFinder as hf
 import HitFinder_chiSquared as hfChi
 import time
@@ -10,6 +10,28 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
+class hitBatch(object):
+    """nPixels of consecutive events, sent to the master as one int64 array [first event, nPixels...]
+    once batchSize events are collected or batchInterval seconds have passed"""
+    def __init__(self, batchSize, batchInterval):
+        self.buf = np.empty(max(batchSize, 1) + 1, dtype=np.int64)
+        self.batchInterval = batchInterval
+        self.numEvents = 0
+        self.lastSend = time.time()
+
+    def append(self, nevent, nPixels):
+        if self.numEvents == 0: self.buf[0] = nevent
+        self.buf[1 + self.numEvents] = nPixels
+        self.numEvents += 1
+        if self.numEvents == len(self.buf) - 1 or time.time() - self.lastSend >= self.batchInterval:
+            self.send()
+
+    def send(self):
+        if self.numEvents > 0:
+            comm.Send([self.buf, self.numEvents + 1, MPI.INT64_T], dest=0, tag=batchTag)
+        self.numEvents = 0
+        self.lastSend = time.time()
+
 def runclient(args):
     #t0 = time.time()
     ds = psana.DataSource("exp="+args.exp+":run="+str(args.run)+':idx')
@@ -20,15 +42,20 @@ def runclient(args):
     d.do_reshape_2d_to_3d(flag=True)
     #t1 = time.time()
     #print "setup: ", rank, t1-t0
-    for nevent in np.arange(len(times)):
+    numJobs = len(times)
+    if args.noe >= 0: numJobs = min(args.noe, numJobs)
+    # each rank looks at a contiguous block of events, so that a batch is a contiguous hyperslab for the master
+    myJobs = np.array_split(np.arange(numJobs), size-1)[rank-1]
+    batch = hitBatch(args.batchSize, args.batchInterval)
+    for nevent in myJobs:
         t2 = time.time()
-        if nevent == args.noe : break
-        if nevent%(size-1) != rank-1: continue # different ranks look at different events
         evt = run.event(times[nevent])
         detarr = d.calib(evt)
         #t3 = time.time()
 
-        if detarr is None: continue
+        if detarr is None:
+            batch.append(nevent, -1)
+            continue
 
         # Initialize hit finding
         if not hasattr(d,'hitFinder'):
@@ -71,12 +98,9 @@ def runclient(args):
                                            hitThreshold=args.hitThreshold)
         d.hitFinder.findHits(detarr,evt)
         #t4 = time.time()
-        md=mpidata()
-        md.small.eventNum = nevent
-        md.small.nPixels = d.hitFinder.nPixels
-        md.small.powder = 0
-        md.send() # send mpi data object to master when desired
+        batch.append(nevent, d.hitFinder.nPixels)
         #print "hit finder: ", rank, t3-t2, t4-t3
+    batch.send()
 
     # At the end of the run, send the powder of hits and misses
     md = mpidata()
@@ -1,5 +1,5 @@
-import h5py, json
-from mpidata import mpidata
+import h5py, json, time
+from mpidata import mpidata, batchTag
 import psana
 import numpy as np
 
@@ -50,10 +50,30 @@ def runmaster(args,nClients):
     writeStatus(statusFname, d)
 
     myHdf5 = h5py.File(fname, 'r+')
+    nHits = myHdf5[grpName+dset_nHits]
+    status = MPI.Status()
+    batch = np.empty(args.batchSize + 1, dtype=np.int64)
+    lastStatus = time.time()
     while nClients > 0:
+        comm.Probe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        if status.Get_tag() == batchTag:
+            # nPixels of consecutive events [first event, nPixels...]
+            n = status.Get_count(MPI.INT64_T)
+            if n > len(batch): batch = np.empty(n, dtype=np.int64)
+            comm.Recv([batch, n, MPI.INT64_T], source=status.Get_source(), tag=batchTag)
+            nHits[batch[0]:batch[0]+n-1] = batch[1:n]
+            numProcessed += np.count_nonzero(batch[1:n] >= 0)
+            # Update status at most once a second
+            if time.time() - lastStatus >= 1:
+                myHdf5.flush()
+                fracDone = numProcessed * 100. / numEvents
+                d = {"fracDone": fracDone}
+                writeStatus(statusFname, d)
+                lastStatus = time.time()
+            continue
         # Remove client if the run ended
         md = mpidata()
-        md.recv()
+        md.recv(source=status.Get_source())
         if md.small.endrun:
             nClients -= 1
         elif md.small.powder == 1:
@@ -63,18 +83,9 @@ def runmaster(args,nClients):
             else:
                 powderHits = np.maximum(powderHits, md.powderHits)
                 powderMisses = np.maximum(powderMisses, md.powderMisses)
-        else:
-            try:
-                nPixels = md.small.nPixels
-            except:
-                continue
-            myHdf5[grpName+dset_nHits][md.small.eventNum] = nPixels
-            myHdf5.flush()
-            numProcessed += 1
-            # Update status
-            fracDone = numProcessed * 100. / numEvents
-            d = {"fracDone": fracDone}
-            writeStatus(statusFname, d)
+    fracDone = numProcessed * 100. / numEvents
+    d = {"fracDone": fracDone}
+    writeStatus(statusFname, d)
 
     np.save(powderHitFname, powderHits)
     np.save(powderMissesFname, powderMisses)
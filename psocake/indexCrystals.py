@@ -3,7 +3,7 @@ import h5py, os, time, json, sys
 import argparse
 import subprocess
 import numpy as np
-from psocake.utils import batchSubmit
+from psocake.utils import batchSubmit, StreamIndex, mergeStreams, FileTail, StreamProgress
 
 parser = argparse.ArgumentParser()
 parser.add_argument('expRun', nargs='?', default=None, help="Psana-style experiment/run string in the format (e.g. exp=cxi06216:run=22). This option trumps -e and -r options.")
@@ -121,39 +121,28 @@ def getMyChunkSize(numJobs, numWorkers, chunkSize, rank):
 def writeStatus(fname, d):
     json.dump(d, open(fname, 'w'))
 
-def getIndexedPeaks():
-    # Merge all stream files into one
-    if not tag:
-        totalStream = runDir + "/" + experimentName + "_" + str(runNumber).zfill(4) + ".stream"
-    else:
-        totalStream = runDir + "/" + experimentName + "_" + str(runNumber).zfill(4) + "_" + tag + ".stream"
-    with open(totalStream, 'w') as outfile:
-        for fname in myStreamList:
-            #print("Reading: ", fname)
-            try:
-                with open(fname) as infile:
-                    outfile.write(infile.read())
-            except:  # file may not exist yet
-                print("Couldn't open: ", fname)
-                pass
+def getIndexedPeaks(merge=True):
+    """
+    Number of indexed and processed events in the stream files, counted from their indexes
+    :param merge: also merge all stream files into one
+    """
+    if merge:
+        if not tag:
+            totalStream = runDir + "/" + experimentName + "_" + str(runNumber).zfill(4) + ".stream"
+        else:
+            totalStream = runDir + "/" + experimentName + "_" + str(runNumber).zfill(4) + "_" + tag + ".stream"
+        streamIndex = mergeStreams(myStreamList, totalStream)
+        return streamIndex.numIndexed(), len(streamIndex)
 
-    # Add indexed peaks and remove images in hdf5
     indexedPeaks = 0
     numProcessed = 0
-    try:
-        fstream = open(totalStream, 'r')
-        content = fstream.readlines()
-        fstream.close()
-
-        for i, val in enumerate(content):
-            if "indexed_by =" in val:
-                _ind = val.split("indexed_by =")[-1].strip()
-                if 'none' not in _ind:
-                    indexedPeaks += 1
-            if "End of peak list" in val:
-                numProcessed += 1
-    except:
-        pass
+    for fname in myStreamList:
+        try:
+            streamIndex = StreamIndex(fname)
+        except (IOError, OSError):  # file may not exist yet
+            continue
+        indexedPeaks += streamIndex.numIndexed()
+        numProcessed += len(streamIndex)
     return indexedPeaks, numProcessed
 
 def getpath(cxi_name):
@@ -167,7 +156,18 @@ def condition_check(hf, ival, iicondition):
     if not iicondition: return True
     return eval(iicondition)
 
+def isSingleFile(fname):
+    """True if findPeaksTurbo --singleFile saved all hits in the master .cxi"""
+    try:
+        with h5py.File(fname, 'r') as f:
+            return bool(f['/LCLS/eventNumber'].attrs.get('singleFile', False))
+    except:
+        return False
+
+singleFile = isSingleFile(peakFile)
+
 def getPeakFileIndex(experimentName, runNumber, pkTag, eventSizes, currentInd):
+    if singleFile: return peakFile, currentInd
     b = np.cumsum(eventSizes)
     peakfileInd = np.where((b - currentInd) > 0)[0][0]
     if peakfileInd > 0:
@@ -187,6 +187,7 @@ if args.tag: fnameIndex += '_'+args.tag
 fnameIndex += ".txt"
 
 def findSize(runDir,experimentName,runNumber,pkTag):
+    if singleFile: return 1
     numSize = -1
     if pkTag:
         searchWord = pkTag+'.cxi'
@@ -236,6 +237,7 @@ for ind in range(numSize):
     pFile = runDir + '/' + experimentName + '_' + str(runNumber).zfill(4) + '_' + str(ind)
     if args.pkTag: pFile += '_'+args.pkTag
     pFile += '.cxi'
+    if singleFile: pFile = peakFile
     hf = h5py.File(pFile, 'r')
     icondition = args.condition
     iposition = [ipos for ipos, ichar in enumerate(icondition) if ichar == '#']
@@ -378,6 +380,7 @@ for rank in range(numWorkers):
 if batch == "lsf":
     myKeyString = "The output (if any) is above this job summary."
     mySuccessString = "Successfully completed."
+    myCancelString = "TERM_OWNER"
 else: # slurm
     myKeyString = "Final: "
     mySuccessString = "Final: "
@@ -396,76 +399,81 @@ except:
     print("Try reading file: ", fname)
     with open(fname) as infile:
         d = json.load(infile)
-        numEvents = int(d['numHits'])
-        
+        numHits = int(d['numHits'])
+
+# Follow the logs and streams as they grow instead of grepping them every cycle
+tail = FileTail()
+for fname in myLogList + myStreamList:
+    tail.watch(fname)
+progress = StreamProgress()
+seen = [set() for myLog in myLogList] # job status strings found in each log so far
+lastJobCheck = np.zeros((numWorkers,))
 while Done == 0:
     for i, myLog in enumerate(myLogList):
+        if haveFinished[i] != 0: continue
         if os.path.isfile(myLog):  # log file exists
-            if haveFinished[i] == 0:  # i^th job is still running
-                # check if job has finished
-                p = subprocess.Popen(["grep", "-E", myKeyString+"|"+myCancelString, myLog], stdout=subprocess.PIPE)
-                output = p.communicate()[0]
-                p.stdout.close()
-                if myKeyString in str(output):  # job has completely finished
-                    # check job was a success or a failure
-                    p = subprocess.Popen(["grep", mySuccessString, myLog], stdout=subprocess.PIPE)
-                    output = p.communicate()[0]
-                    p.stdout.close()
-                    if mySuccessString in str(output):  # success
-                        print("successfully done indexing: ", runNumber, myLog)
-                        haveFinished[i] = 1
-                        if len(np.where(abs(haveFinished) == 1)[0]) == numWorkers:
-                            print("Done indexing")
-                            Done = 1
-                    else:  # failure
-                        print("failed attempt", runNumber, myLog)
-                        haveFinished[i] = -1
-                        if len(np.where(abs(haveFinished) == 1)[0]) == numWorkers:
-                            print("Done indexing")
-                            Done = -1
-                elif myCancelString in str(output): # job has been cancelled
-                    print("cancelled job", runNumber, myLog)
+            output = tail.read(myLog)[0].decode("utf-8", "replace")
+            seen[i].update(key for key in (myKeyString, mySuccessString, myCancelString) if key in output)
+            if myKeyString in seen[i]:  # job has completely finished
+                # check job was a success or a failure
+                if mySuccessString in seen[i]:  # success
+                    print("successfully done indexing: ", runNumber, myLog)
+                    haveFinished[i] = 1
+                    if len(np.where(abs(haveFinished) == 1)[0]) == numWorkers:
+                        print("Done indexing")
+                        Done = 1
+                else:  # failure
+                    print("failed attempt", runNumber, myLog)
                     haveFinished[i] = -1
                     if len(np.where(abs(haveFinished) == 1)[0]) == numWorkers:
                         print("Done indexing")
                         Done = -1
-                else: # job is still going, update indexing rate
-                    if args.v >= 1: print("indexing hasn't finished yet: ", runNumber, myJobList, haveFinished)
-                    indexedPeaks = None#, numProcessed = getIndexedPeaks()
-
-                    if indexedPeaks is not None:
-                        numIndexedNow = indexedPeaks #len(np.where(indexedPeaks > 0)[0])
-                        if numProcessed == 0:
-                            indexRate = 0
-                        else:
-                            indexRate = numIndexedNow * 100. / numProcessed
-                        if numHits > 0:
-                            fracDone = numProcessed * 100. / numHits
-                        else:
-                            fracDone = 0
-
-                        if args.v >= 1: print("Progress [runNumber, numIndexed, indexRate, fracDone]: ", runNumber, numIndexedNow, indexRate, fracDone)
-                        try:
-                            d = {"numIndexed": numIndexedNow, "indexRate": indexRate, "fracDone": fracDone}
-                            writeStatus(fnameIndex, d)
-                        except:
-                            print("Couldn't update status")
-                            pass
-                    else:
-                        pass #print "getIndexedPeaks returned None"
-                    time.sleep(10)
-        else: # log file does not exist
+            elif myCancelString in seen[i]: # job has been cancelled
+                print("cancelled job", runNumber, myLog)
+                haveFinished[i] = -1
+                if len(np.where(abs(haveFinished) == 1)[0]) == numWorkers:
+                    print("Done indexing")
+                    Done = -1
+        elif time.time() - lastJobCheck[i] >= 10: # log file does not exist, ask the scheduler at most every 10 s
             if args.v >= 1: print("no such file yet: ", runNumber, myLog)
+            lastJobCheck[i] = time.time()
             jobKilled = checkJobExit(myJobList[i])
             if jobKilled == 1:
                 if args.v >= 0: print("indexing job failure: ", myLog)
                 haveFinished[i] = -1
                 if args.v >= 0: print("Error: exit indexing crystals")
                 sys.exit()
-            time.sleep(10)
+
+    # update indexing rate, status file is only written when the counts change
+    changed = False
+    for fname in myStreamList:
+        changed |= progress.update(fname, *tail.read(fname))
+    if changed and Done == 0:
+        if args.v >= 1: print("indexing hasn't finished yet: ", runNumber, myJobList, haveFinished)
+        numIndexedNow = progress.numIndexed()
+        numProcessed = progress.numProcessed()
+        if numProcessed == 0:
+            indexRate = 0
+        else:
+            indexRate = numIndexedNow * 100. / numProcessed
+        if numHits > 0:
+            fracDone = numProcessed * 100. / numHits
+        else:
+            fracDone = 0
+
+        if args.v >= 1: print("Progress [runNumber, numIndexed, indexRate, fracDone]: ", runNumber, numIndexedNow, indexRate, fracDone)
+        try:
+            d = {"numIndexed": numIndexedNow, "indexRate": indexRate, "fracDone": fracDone}
+            writeStatus(fnameIndex, d)
+        except:
+            print("Couldn't update status")
+            pass
+
+    if Done == 0:
+        tail.wait(10)
 
     if abs(Done) == 1:
-        indexedPeaks, numProcessed = getIndexedPeaks()
+        indexedPeaks, numProcessed = getIndexedPeaks(merge=False)
         if indexedPeaks is not None:
             numIndexedNow = indexedPeaks #len(np.where(indexedPeaks > 0)[0])
             if numProcessed == 0:
@@ -503,11 +511,17 @@ while Done == 0:
                 os.remove(fname)
             except:
                 print("Couldn't remove {}".format(fname))
+            if os.path.exists(fname + '.idx.npy'): # left by StreamIndex
+                try:
+                    os.remove(fname + '.idx.npy')
+                except:
+                    print("Couldn't remove {}".format(fname + '.idx.npy'))
         for fname in myLists:
             try:
                 os.remove(fname)
             except:
                 print("Couldn't remove {}".format(fname))
+tail.close()
 hf.close()
 print("Done indexing run (time elapsed): ", runNumber, time.time()-tic)
 
@@ -20,6 +20,8 @@ parser.add_argument("-m","--mask",help="full path to binary mask numpy ndarray (
 parser.add_argument("-l","--litPixelThreshold",help="number of ADUs to be considered a lit pixel",default=100, type=float)
 parser.add_argument("-v","--verbose",help="verbosity of output for debugging, 1=print, 2=print+plot",default=0, type=int)
 parser.add_argument("--localCalib", help="use local calib directory, default=False", action='store_true')
+parser.add_argument("--batchSize", help="number of events each worker sends to the master at a time", default=100, type=int)
+parser.add_argument("--flushInterval", help="seconds between flushes of the output file", default=10, type=float)
 args = parser.parse_args()
 assert os.path.isdir(args.outdir)
 
@@ -30,6 +32,14 @@ size = comm.Get_size()
 assert size>=2, 'Require at least two mpi ranks'
 numslaves = size-1
 
+# Per-event result sent from the workers to the master in batches
+eventDtype = np.dtype([('seconds', np.uint32), ('nanoseconds', np.uint32),
+                       ('fiducials', np.uint32), ('hitMetric', np.float32)])
+eventType = MPI.Datatype.Create_struct([1, 1, 1, 1],
+                                       [eventDtype.fields[name][1] for name in eventDtype.names],
+                                       [MPI.UNSIGNED, MPI.UNSIGNED, MPI.UNSIGNED, MPI.FLOAT])
+eventType = eventType.Create_resized(0, eventDtype.itemsize).Commit()
+
 if rank == 0:
     psana_version = subprocess.check_output(["ls","-lart","/reg/g/psdm/sw/releases/ana-current"]).split('-> ')[-1].split('\n')[0]
     svn_version = subprocess.check_output("svnversion")
@@ -120,7 +130,8 @@ def getEventID(evt):
     fiducials = evtid.fiducials()
     return seconds, nanoseconds, fiducials
 
-def nunchakuAlgorithm(stickLength=15):
+def nunchakuAlgorithm(t=None, fid=None, hitMetric=None, stickLength=15):
+    """Reorder results in time. Results already held in memory are not read back from file."""
     # Generate output filename
     if args.tag is None:
         outname = os.path.join(args.outdir, env.experiment()+'_'+str(run.run())+'.h5')
@@ -128,9 +139,10 @@ def nunchakuAlgorithm(stickLength=15):
         outname = os.path.join(args.outdir, env.experiment() + '_' + str(run.run()) + '_' + args.tag + '.h5')
     # Clean up hdf5 structure if it exists
     f = h5py.File(outname, 'r+')
-    t             = f[grpName+'/eventTime'][()]
-    fid           = f[grpName+'/fiducials'][()]
-    hitMetric     = f[grpName+'/hitMetric'][()]
+    if t is None:
+        t             = f[grpName+'/eventTime'][()]
+        fid           = f[grpName+'/fiducials'][()]
+        hitMetric     = f[grpName+'/hitMetric'][()]
     timeOrder   = t.argsort()
     hitMetric = hitMetric[timeOrder]
     numEvents = len(hitMetric)
@@ -148,48 +160,27 @@ def nunchakuAlgorithm(stickLength=15):
     f.flush()
     f.close()
 
-class bigMsg:
-    """Message holding the events message and raw image"""
-    def __init__(self):
-        self.data = []
-        self.smallMsg = smallMsg()
-        self.reset()
-
-    def reset(self):
-        self.data = []
-
-    def send(self):
-        self.smallMsg.send()
-
-        for res in self.data:
-            for arr in res:
-                comm.Send(arr.astype(float), dest=0, tag=1)
-        self.reset()
+class batchMsg:
+    """Batch of per-event results sent to the master as one typed buffer"""
+    def __init__(self, batchSize):
+        self.events = np.zeros(max(batchSize, 1), dtype=eventDtype)
+        self.numEvents = 0
 
-class smallMsg:
-    """Class to hold data for event (no image)"""
-    def __init__(self):
-        self.done = False
-        self.events = []
-        self.reset()
-
-    def reset(self):
-        self.events     = []
-        #self.arraySizes = []
-        self.done = False
+    def append(self, seconds, nanoseconds, fiducials, hitMetric):
+        self.events[self.numEvents] = (seconds, nanoseconds, fiducials, hitMetric)
+        self.numEvents += 1
+        if self.numEvents == len(self.events):
+            self.send()
 
     def send(self):
-        comm.send(self, dest=0, tag=0)
-        self.reset()
+        if self.numEvents > 0:
+            comm.Send([self.events, self.numEvents, eventType], dest=0, tag=1)
+        self.numEvents = 0
 
     def sendDone(self):
-        self.done = True
-        comm.send(self, dest=0, tag=0)
-        self.reset()
-
-    def sendNonResettingDone(self):
-        self.done = True
-        comm.send(self, dest=0, tag=0)
+        """Send remaining events followed by an empty batch"""
+        self.send()
+        comm.Send([self.events, 0, eventType], dest=0, tag=1)
 
 def getNumEventsToProc(run,noe):
     """Returns number of events to process."""
@@ -234,7 +225,7 @@ class slave_class(object):
         evt = self.run.event(self.myJobs[0])
         getMasks(evt)
         #getGains(evt)
-        self.myMsg = smallMsg()
+        self.myMsg = batchMsg(args.batchSize)
 
         for i in range(numDet):
             self.myMask[i]  = myDetList[i].spiMask.copy() # important to copy
@@ -262,12 +253,8 @@ class slave_class(object):
             except:
                 hitMetric = 0
 
-            # Sends smallMsg component to BigMsg
-            self.myMsg.events = (seconds, nanoseconds, fiducials, hitMetric)
-
-            # Sends to BigMsg a list of detector arrays if it's a hit
-            # otherwise, sends an empty list
-            self.myMsg.send()
+            # Results are sent to the master once a batch is full
+            self.myMsg.append(seconds, nanoseconds, fiducials, hitMetric)
 
         # Finished handling all assigned events
         # send a message when we're done
@@ -327,24 +314,32 @@ def master():
     # Receive results from slaves
     status = MPI.Status()
     nevts = 0
+    eventTime = np.zeros(numEventsToProc, dtype=np.uint64)
+    fids = np.zeros(numEventsToProc, dtype=np.uint32)
+    hitMetric = np.zeros(numEventsToProc, dtype=np.float32)
+    events = np.zeros(max(args.batchSize, 1), dtype=eventDtype)
+    lastFlush = time.time()
     while slavecount:
-        # Receive event message (pickled object)
-        smallMsg = comm.recv(source=MPI.ANY_SOURCE, tag=0, status=status)
-        if smallMsg.done:
+        # Receive a batch of events
+        comm.Probe(source=MPI.ANY_SOURCE, tag=1, status=status)
+        n = status.Get_count(eventType)
+        comm.Recv([events, n, eventType], source=status.Get_source(), tag=1)
+        if n == 0:
             print('Received done message from rank',status.Get_source(), \
                   'at',time.strftime('%H:%M:%S'))
             slavecount-=1
         else:
-            seconds = smallMsg.events[0]
-            nanoseconds = smallMsg.events[1]
-            fiducials = smallMsg.events[2]
-            hitMetric = smallMsg.events[3]
-
-            evttime_ds[nevts] = (seconds << 32) | nanoseconds
-            fids_ds[nevts] = fiducials
-            hitMetric_ds[nevts] = hitMetric
-            f.flush()
-            nevts+=1
+            batch = events[:n]
+            eventTime[nevts:nevts+n] = (batch['seconds'].astype(np.uint64) << np.uint64(32)) | batch['nanoseconds']
+            fids[nevts:nevts+n] = batch['fiducials']
+            hitMetric[nevts:nevts+n] = batch['hitMetric']
+            evttime_ds[nevts:nevts+n] = eventTime[nevts:nevts+n]
+            fids_ds[nevts:nevts+n] = fids[nevts:nevts+n]
+            hitMetric_ds[nevts:nevts+n] = hitMetric[nevts:nevts+n]
+            nevts+=n
+            if time.time() - lastFlush > args.flushInterval:
+                f.flush()
+                lastFlush = time.time()
 
     # Save attributes
     hitMetric_ds.attrs['numEvents'] = nevts
@@ -357,19 +352,21 @@ def master():
     f.flush()
     f.close()
 
+    return eventTime, fids, hitMetric
+
 ################################################################################
 # Code for this mpi process continues here
 ################################################################################
 
 curr_slave = slave_class(run, numslaves, rank, args.noe, numDet)
 if rank==0:
-    master()
+    results = master()
     print("If you are running from an interactive node, you may ignore the 'mpi_warn_on_fork' message.")
 else:
     print('Starting rank: ',rank,'hostname: ',socket.gethostname())
     curr_slave.process_run()
 
 if rank==0:
-    nunchakuAlgorithm() # reorder in time
+    nunchakuAlgorithm(*results) # reorder in time
 
 MPI.Finalize()
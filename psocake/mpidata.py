@@ -4,6 +4,8 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
+batchTag = 0 # typed result batches, mpidata messages are tagged with the sending rank
+
 class arrayinfo(object):
     def __init__(self,name,array):
         self.name = name
@@ -38,10 +40,10 @@ class mpidata(object):
             assert arr.flags['C_CONTIGUOUS']
             comm.Send(arr,dest=0,tag=rank)
 
-    def recv(self):
+    def recv(self,source=MPI.ANY_SOURCE):
         assert rank==0
         status=MPI.Status()       
-        self.small=comm.recv(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG,status=status)
+        self.small=comm.recv(source=source,tag=MPI.ANY_TAG,status=status)
         recvRank = status.Get_source()
         if not self.small.endrun:
             for arrinfo in self.small.arrayinfolist:
@@ -1,4 +1,5 @@
 from scipy import signal as sg
+from scipy import ndimage
 import numpy as np
 from skimage.morphology import h_maxima
 from skimage.measure import label, regionprops
@@ -412,12 +413,84 @@ class StreakMask:
                 a=np.arange(calib.size)+1
                 a=a.reshape(calib.shape)
                 self.assem=det.image(evt,a)
+                self.setupCrop()
             else:
                 self.assem = None
         else:
             self.assem = None
 
+    def setupCrop(self):
+        """Cache the crop window to calib pixel index map and the per-event buffers"""
+        cropAssem = self.assem[self.ix-self.halfWidth:self.ix+self.halfWidth,self.iy-self.halfWidth:self.iy+self.halfWidth]
+        self.cropValid = cropAssem > 0 # assembled pixels with a detector pixel behind them
+        self.cropInd = (cropAssem[self.cropValid] - 1).astype(np.int64) # flat calib index of those pixels
+        self.edges = self.imgEdges == 1
+        self.imgCrop = np.zeros(cropAssem.shape)
+        self.imgBlur = np.zeros(cropAssem.shape)
+        self.mask = np.zeros(cropAssem.shape, dtype=bool)
+        self.myLabel = np.zeros(cropAssem.shape, dtype=np.int32)
+        self.myMask = np.zeros(cropAssem.shape, dtype=bool)
+        self.calibMask = np.ones(self.calibShape)
+        self.maskedInd = np.zeros((0,), dtype=np.int64) # calib pixels masked by the previous event
+
     def getStreakMaskCalib(self, evt, calib=None):
+        """
+        Streak mask in calib shape: 1 for good pixels, 0 for streak pixels.
+        Only the cropped window is assembled, through the cached crop to calib index map,
+        and streaks are found with a single labelling pass.
+        Note that the returned array is reused and overwritten by the next call.
+        :param evt: psana event
+        :param calib: calibrated detector data, calibrated from evt if not given
+        """
+        if self.assem is None: return None
+
+        if calib is None:
+            calib = self.det.calib(evt)
+            if calib is None: return None
+
+        # Assemble cropped centre of image
+        self.imgCrop[self.cropValid] = np.ravel(calib)[self.cropInd]
+
+        # Blur image with a 2x2 box, equivalent to sg.convolve(imgCrop,np.ones((2,2)),mode='same')
+        imgBlur = self.imgBlur
+        imgBlur[...] = self.imgCrop
+        imgBlur[1:,:] += self.imgCrop[:-1,:]
+        imgBlur[:,1:] += self.imgCrop[:,:-1]
+        imgBlur[1:,1:] += self.imgCrop[:-1,:-1]
+        positive = imgBlur[imgBlur>0]
+        if positive.size > 0:
+            mean = positive.mean()
+            std = positive.std()
+        else: # nothing above zero, nothing to mask
+            mean = std = 0
+
+        # Mask out pixels above sigma
+        mask = np.greater(imgBlur, mean+self.sigma*std, out=self.mask)
+        signalOnEdge = mask & self.edges
+        mask |= self.edges
+
+        # Connected components: all pixels connected to edge pixels are masked out
+        numLabels = ndimage.label(mask, output=self.myLabel)
+        myLabel = self.myLabel
+        touchesEdge = np.zeros(numLabels+1, dtype=bool)
+        touchesEdge[myLabel[self.edges]] = True
+        touchesEdge[0] = False
+        myMask = np.take(touchesEdge, myLabel, out=self.myMask) # True where masked
+
+        # Delete edges
+        myMask[self.edges] = False
+        myMask |= signalOnEdge
+
+        # Convert assembled to unassembled
+        calibMask = self.calibMask.reshape(-1)
+        calibMask[self.maskedInd] = 1
+        self.maskedInd = self.cropInd[myMask[self.cropValid]]
+        calibMask[self.maskedInd] = 0
+
+        return self.calibMask
+
+    def getStreakMaskCalibReference(self, evt, calib=None):
+        """Reference implementation of getStreakMaskCalib, assembling the whole image"""
         if self.assem is not None:
 
             if calib is not None:
@@ -441,7 +514,7 @@ class StreakMask:
             mask[self.myInd[0].ravel(),self.myInd[1].ravel()] = 1
 
             # Connected components
-            myLabel = label(mask, neighbors=4, connectivity=1, background=0)
+            myLabel = label(mask, connectivity=1, background=0) # 4-connected
             # All pixels connected to edge pixels is masked out
             myMask = np.ones_like(mask)
             myParts = np.unique(myLabel[self.myInd])
@@ -1,5 +1,6 @@
 import numpy as np
 import h5py
+import os, hashlib, time, threading
 import PSCalib.GlobalUtils as gu
 import psana
 import psocake.PeakFinder as pf
@@ -22,21 +23,99 @@ def get_es_value(es, name, NoneCheck=False, exceptReturn=0):
     return value
 
 
-def calcPeaks(args, nHits, myHdf5, detarr, evt, d, nevent, detDesc, es, evr0, evr1, evr2):
+def isHit(args, nPeaks, maxRes):
+    return nPeaks >= args.minPeaks and \
+           nPeaks <= args.maxPeaks and \
+           maxRes >= args.minRes
+
+# peak finding parameters that change the peaks found in an event,
+# post-filters (minPeaks, maxPeaks, minRes) are applied to cached peaks
+peakCacheParams = ['algorithm', 'alg_npix_min', 'alg_npix_max', 'alg_amax_thr', 'alg_atot_thr', 'alg_son_min',
+                   'alg1_thr_low', 'alg1_thr_high', 'alg1_rank', 'alg1_radius', 'alg1_dr',
+                   'streakMask_on', 'streakMask_sigma', 'streakMask_width', 'userMask_path',
+                   'psanaMask_on', 'psanaMask_calib', 'psanaMask_status', 'psanaMask_edges',
+                   'psanaMask_central', 'psanaMask_unbond', 'psanaMask_unbondnrs',
+                   'medianBackground', 'medianRank', 'radialBackground', 'detectorDistance',
+                   'localCalib', 'inputImages', 'cm0', 'cm1', 'cm2', 'cm3', 'auto']
+
+# datasets with one row per hit written through the hit buffer, evr codes are variable length
+# and only written with one file per rank
+hitDatasets = ['/LCLS/eventNumber', '/LCLS/machineTime', '/LCLS/machineTimeNanoSeconds', '/LCLS/fiducial',
+               '/entry_1/data_1/data', '/entry_1/result_1/nPeaks',
+               '/entry_1/result_1/peakXPosRaw', '/entry_1/result_1/peakYPosRaw',
+               '/entry_1/result_1/rcent', '/entry_1/result_1/ccent', '/entry_1/result_1/rmin',
+               '/entry_1/result_1/rmax', '/entry_1/result_1/cmin', '/entry_1/result_1/cmax',
+               '/entry_1/result_1/peakTotalIntensity', '/entry_1/result_1/peakMaxIntensity',
+               '/entry_1/result_1/peakRadius',
+               '/entry_1/result_1/timeToolDelay', '/entry_1/result_1/laserTimeZero',
+               '/entry_1/result_1/laserTimeDelay', '/entry_1/result_1/laserTimePhaseLocked',
+               '/LCLS/ttspecAmpl', '/LCLS/ttspecAmplNxt', '/LCLS/ttspecFltPos', '/LCLS/ttspecFltPosFwhm',
+               '/LCLS/ttspecFltPosPs', '/LCLS/ttspecRefAmpl']
+
+def getPeakCacheKey(args, det, evt):
+    """Key of the peak cache: run, detector, calib constants and peak finding parameters"""
+    key = {'exp': args.exp, 'run': args.run, 'det': args.det}
+    for name in peakCacheParams:
+        key[name] = getattr(args, name, None)
+    # files are identified by their modification time as well as their name
+    for name in ['userMask_path', 'inputImages']:
+        fname = getattr(args, name, None)
+        if fname and os.path.exists(fname): key[name+'_mtime'] = os.path.getmtime(fname)
+    # calib constants version
+    calibHash = hashlib.sha1()
+    consts = [det.pedestals(evt), det.gain(evt), det.status(evt), det.common_mode(evt)]
+    if args.radialBackground: consts.append(det.coords_x(evt))
+    for const in consts:
+        if const is not None: calibHash.update(np.ascontiguousarray(const).tobytes())
+    key['calib'] = calibHash.hexdigest()
+    return key
+
+# (dataset, epics PV) of the values saved for every hit, {} is the instrument
+# FIXME: Timetool variable name change (Nov/2021) TTSPEC -> TIMETOOL
+hitEpics = [('/entry_1/result_1/timeToolDelay', '{}:LAS:MMN:04.RBV'),
+            ('/entry_1/result_1/laserTimeZero', 'LAS:FS5:VIT:FS_TGT_TIME_OFFSET'),
+            ('/entry_1/result_1/laserTimeDelay', 'LAS:FS5:VIT:FS_TGT_TIME_DIAL'),
+            ('/entry_1/result_1/laserTimePhaseLocked', 'LAS:FS5:VIT:PHASE_LOCKED'),
+            ('/LCLS/ttspecAmpl', '{}:TIMETOOL:AMPL'),
+            ('/LCLS/ttspecAmplNxt', '{}:TIMETOOL:AMPLNXT'),
+            ('/LCLS/ttspecFltPos', '{}:TIMETOOL:FLTPOS'),
+            ('/LCLS/ttspecFltPosFwhm', '{}:TIMETOOL:FLTPOSFWHM'),
+            ('/LCLS/ttspecFltPosPs', '{}:TIMETOOL:FLTPOS_PS'),
+            ('/LCLS/ttspecRefAmpl', '{}:TIMETOOL:REFAMPL')]
+
+def getEventInfo(args, evt, es, evr0, evr1, evr2):
+    """
+    Time stamp, epics values and evr codes of an event keyed by dataset. The epics store
+    follows the most recently fetched event, so this is called right after fetching evt.
+    """
+    evtId = evt.get(psana.EventId)
+    info = {'/LCLS/machineTime': evtId.time()[0],
+            '/LCLS/machineTimeNanoSeconds': evtId.time()[1],
+            '/LCLS/fiducial': evtId.fiducials()}
+    instrument = args.instrument.upper()
+    for dataset, pv in hitEpics:
+        info[dataset] = get_es_value(es, pv.format(instrument), NoneCheck=True)
+    for name, evr in [('evr0', evr0), ('evr1', evr1), ('evr2', evr2)]:
+        if evr:
+            ec = evr.eventCodes(evt)
+            if ec is None: ec = [-1]
+            info['/LCLS/detector_1/' + name] = np.array(ec, dtype=np.int32)
+    return info
+
+def calcPeaks(args, nHits, hitBuffer, nPeaksAll, detarr, evt, d, nevent, detDesc, info):
     """ Find peaks and writes to cxi file """
     d.peakFinder.findPeaks(detarr, evt, args.minPeaks) # this will perform background subtraction on detarr
-    myHdf5["/entry_1/result_1/nPeaksAll"][nevent] = len(d.peakFinder.peaks)
-    
-    if len(d.peakFinder.peaks) >= args.minPeaks and \
-       len(d.peakFinder.peaks) <= args.maxPeaks and \
-       d.peakFinder.maxRes >= args.minRes:
-        evtId = evt.get(psana.EventId)
-        myHdf5['/LCLS/eventNumber'][nHits] = nevent
-        myHdf5['/LCLS/machineTime'][nHits] = evtId.time()[0]
-        myHdf5['/LCLS/machineTimeNanoSeconds'][nHits] = evtId.time()[1]
-        myHdf5['/LCLS/fiducial'][nHits] = evtId.fiducials()
-        _data = detDesc.pct(detarr)
-        myHdf5['/entry_1/data_1/data'][nHits,:,:] = _data
+    nPeaks = len(d.peakFinder.peaks)
+    nPeaksAll[nevent] = nPeaks
+
+    if isHit(args, nPeaks, d.peakFinder.maxRes):
+        hitBuffer.set('/LCLS/eventNumber', nevent)
+        if isinstance(hitBuffer, Hdf5SharedWriteBuffer):
+            # the slot of this hit in the shared file is only known once the round is flushed
+            hitBuffer.set('/entry_1/data_1/data', detDesc.pct(detarr, out=d.tile))
+        else:
+            # images are chunked per hit, so they are written straight through
+            hitBuffer.h5file['/entry_1/data_1/data'][nHits,:,:] = detDesc.pct(detarr, out=d.tile)
         # https://confluence.slac.stanford.edu/display/PSDM/Hit+and+Peak+Finding+Algorithms#HitandPeakFindingAlgorithms-Peakfinders
         segs = d.peakFinder.peaks[:,0]
         rows = d.peakFinder.peaks[:,1]
@@ -50,19 +129,19 @@ def calcPeaks(args, nHits, myHdf5, detarr, evt, d, nevent, detDesc, es, evr0, ev
         cminT = d.peakFinder.peaks[:,12] # minimal col "
         cmaxT = d.peakFinder.peaks[:,13] # maximal col "
         cheetahRows, cheetahCols = detDesc.convert_peaks_to_cheetah(segs, rows, cols) #,
-        myHdf5["/entry_1/result_1/nPeaks"][nHits] = len(d.peakFinder.peaks)
-        myHdf5["/entry_1/result_1/peakXPosRaw"][nHits, :len(d.peakFinder.peaks)] = cheetahCols.astype('int')
-        myHdf5["/entry_1/result_1/peakYPosRaw"][nHits, :len(d.peakFinder.peaks)] = cheetahRows.astype('int')
+        hitBuffer.set("/entry_1/result_1/nPeaks", nPeaks)
+        hitBuffer.setRow("/entry_1/result_1/peakXPosRaw", cheetahCols.astype('int'))
+        hitBuffer.setRow("/entry_1/result_1/peakYPosRaw", cheetahRows.astype('int'))
 
-        myHdf5["/entry_1/result_1/rcent"][nHits, :len(d.peakFinder.peaks)] = rcentT
-        myHdf5["/entry_1/result_1/ccent"][nHits, :len(d.peakFinder.peaks)] = ccentT
-        myHdf5["/entry_1/result_1/rmin"][nHits, :len(d.peakFinder.peaks)] = rminT
-        myHdf5["/entry_1/result_1/rmax"][nHits, :len(d.peakFinder.peaks)] = rmaxT
-        myHdf5["/entry_1/result_1/cmin"][nHits, :len(d.peakFinder.peaks)] = cminT
-        myHdf5["/entry_1/result_1/cmax"][nHits, :len(d.peakFinder.peaks)] = cmaxT
+        hitBuffer.setRow("/entry_1/result_1/rcent", rcentT)
+        hitBuffer.setRow("/entry_1/result_1/ccent", ccentT)
+        hitBuffer.setRow("/entry_1/result_1/rmin", rminT)
+        hitBuffer.setRow("/entry_1/result_1/rmax", rmaxT)
+        hitBuffer.setRow("/entry_1/result_1/cmin", cminT)
+        hitBuffer.setRow("/entry_1/result_1/cmax", cmaxT)
 
-        myHdf5["/entry_1/result_1/peakTotalIntensity"][nHits, :len(d.peakFinder.peaks)] = atots
-        myHdf5["/entry_1/result_1/peakMaxIntensity"][nHits, :len(d.peakFinder.peaks)] = amaxs
+        hitBuffer.setRow("/entry_1/result_1/peakTotalIntensity", atots)
+        hitBuffer.setRow("/entry_1/result_1/peakMaxIntensity", amaxs)
 
         cenX = d.iX[np.array(d.peakFinder.peaks[:, 0], dtype=np.int64),
                     np.array(d.peakFinder.peaks[:, 1], dtype=np.int64),
@@ -73,44 +152,12 @@ def calcPeaks(args, nHits, myHdf5, detarr, evt, d, nevent, detDesc, es, evr0, ev
         x = cenX - d.ipx
         y = cenY - d.ipy
         radius = np.sqrt((x ** 2) + (y ** 2))
-        myHdf5["/entry_1/result_1/peakRadius"][nHits, :len(d.peakFinder.peaks)] = radius
-
-        # Save epics variables
-        # FIXME: Timetool variable name change (Nov/2021) TTSPEC -> TIMETOOL
-        instrument = args.instrument.upper()
-        timeToolDelay = get_es_value(es, instrument+':LAS:MMN:04.RBV', NoneCheck=True)
-        laserTimeZero = get_es_value(es, 'LAS:FS5:VIT:FS_TGT_TIME_OFFSET', NoneCheck=True)
-        laserTimeDelay = get_es_value(es, 'LAS:FS5:VIT:FS_TGT_TIME_DIAL', NoneCheck=True)
-        laserTimePhaseLocked = get_es_value(es, 'LAS:FS5:VIT:PHASE_LOCKED', NoneCheck=True)
-        ttspecAmpl = get_es_value(es, instrument+':TIMETOOL:AMPL', NoneCheck=True)
-        ttspecAmplNxt = get_es_value(es, instrument+':TIMETOOL:AMPLNXT', NoneCheck=True)
-        ttspecFltPos = get_es_value(es, instrument+':TIMETOOL:FLTPOS', NoneCheck=True)
-        ttspecFltPosFwhm = get_es_value(es, instrument+':TIMETOOL:FLTPOSFWHM', NoneCheck=True)
-        ttspecFltPosPs = get_es_value(es, instrument+':TIMETOOL:FLTPOS_PS', NoneCheck=True)
-        ttspecRefAmpl = get_es_value(es, instrument+':TIMETOOL:REFAMPL', NoneCheck=True)
-        myHdf5['/entry_1/result_1/timeToolDelay'][nHits] = timeToolDelay
-        myHdf5['/entry_1/result_1/laserTimeZero'][nHits] = laserTimeZero
-        myHdf5['/entry_1/result_1/laserTimeDelay'][nHits] = laserTimeDelay
-        myHdf5['/entry_1/result_1/laserTimePhaseLocked'][nHits] = laserTimePhaseLocked
-        myHdf5['/LCLS/ttspecAmpl'][nHits] = ttspecAmpl
-        myHdf5['/LCLS/ttspecAmplNxt'][nHits] = ttspecAmplNxt
-        myHdf5['/LCLS/ttspecFltPos'][nHits] = ttspecFltPos
-        myHdf5['/LCLS/ttspecFltPosFwhm'][nHits] = ttspecFltPosFwhm
-        myHdf5['/LCLS/ttspecFltPosPs'][nHits] = ttspecFltPosPs
-        myHdf5['/LCLS/ttspecRefAmpl'][nHits] = ttspecRefAmpl
-
-        if evr0:
-            ec = evr0.eventCodes(evt)
-            if ec is None: ec = [-1]
-            myHdf5['/LCLS/detector_1/evr0'][nHits] = np.array(ec)
-        if evr1:
-            ec = evr1.eventCodes(evt)
-            if ec is None: ec = [-1]
-            myHdf5['/LCLS/detector_1/evr1'][nHits] = np.array(ec)
-        if evr2:
-            ec = evr2.eventCodes(evt)
-            if ec is None: ec = [-1]
-            myHdf5['/LCLS/detector_1/evr2'][nHits] = np.array(ec)
+        hitBuffer.setRow("/entry_1/result_1/peakRadius", radius)
+
+        # time stamp, epics variables and evr codes
+        for dataset, value in info.items():
+            hitBuffer.set(dataset, value)
+        hitBuffer.next()
         nHits += 1
 
     return nHits
@@ -137,17 +184,44 @@ def runclient(args,ds,run,times,det,numEvents,detDesc):
     except:
         evr2 = None
 
-    myJobs = getMyUnfairShare(numEvents, size, rank)
-    numJobs = len(myJobs) # events per rank
-    reportFreq = numJobs/2 + 1
+    if args.scheduler == 'dynamic':
+        # ranks pull small batches of events on demand
+        scheduler = DynamicShare(comm, numEvents, args.schedulerBatch)
+        myJobs = scheduler
+        firstJobs = np.arange(numEvents)
+    else:
+        scheduler = None
+        myJobs = getMyUnfairShare(numEvents, size, rank)
+        firstJobs = myJobs
 
     runStr = "%04d" % args.run
-    fname = args.outDir + '/' + args.exp +"_"+ runStr +"_"+str(rank)
-    if args.tag: fname += '_' + args.tag
-    fname += ".cxi"
-    myHdf5 = h5py.File(fname,"r+")
+    if args.singleFile:
+        # all ranks write their hits into the master .cxi
+        fname = args.outDir + '/' + args.exp +"_"+ runStr
+        if args.tag: fname += '_' + args.tag
+        fname += ".cxi"
+        myHdf5 = h5py.File(fname, "r+", driver='mpio', comm=comm)
+        # the buffer holds an image per hit, so it is capped by imageBuffer as well
+        hitBuffer = Hdf5SharedWriteBuffer(myHdf5, comm, hitDatasets,
+                                          bufferSize=min(args.writeBuffer, args.imageBuffer))
+        evr0 = evr1 = evr2 = None # variable length datasets can not be written in parallel
+    else:
+        fname = args.outDir + '/' + args.exp +"_"+ runStr +"_"+str(rank)
+        if args.tag: fname += '_' + args.tag
+        fname += ".cxi"
+        myHdf5 = h5py.File(fname,"r+")
+        hitBuffer = Hdf5WriteBuffer(myHdf5, bufferSize=args.writeBuffer)
+    nPeaksAll = np.ones(numEvents, dtype=int) * -1
+
+    evt = getValidEvent(run, times, firstJobs)
 
-    evt = getValidEvent(run, times, myJobs)
+    peakCache = None
+    if args.peakCache:
+        peakCache = PeakCache(args.peakCache, getPeakCacheKey(args, det, evt))
+        if rank == 0: print("Peak cache: {} ({} events cached)".format(peakCache.path, len(peakCache)))
+
+    # masks and geometry computed by rank 0 and shared by the ranks of each node
+    geomCache = GeometryCache(args.exp, args.run, args.det, det, evt, args.geomCache or None, comm)
 
     # Initialize hit finding
     if not hasattr(det,'peakFinder'):
@@ -182,7 +256,11 @@ def runclient(args,ds,run,times,det,numEvents,detDesc):
                                           minResCutoff=args.minRes,
                                           clen=args.clen,
                                           localCalib=args.localCalib,
-                                          access=args.access)
+                                          access=args.access,
+                                          geomCache=geomCache,
+                                          ds=ds,
+                                          psanaRun=run,
+                                          times=times)
         elif args.algorithm >= 2:
             det.peakFinder = pf.PeakFinder(args.exp, args.run, args.det, evt, det,
                                          args.algorithm, args.alg_npix_min,
@@ -213,11 +291,13 @@ def runclient(args,ds,run,times,det,numEvents,detDesc):
                                          minResCutoff=args.minRes,
                                          clen=args.clen,
                                          localCalib=args.localCalib,
-                                         access=args.access)
-        ix = det.indexes_x(evt)
-        iy = det.indexes_y(evt)
-        det.iX = np.array(ix, dtype=np.int64)
-        det.iY = np.array(iy, dtype=np.int64)
+                                         access=args.access,
+                                         geomCache=geomCache,
+                                         ds=ds,
+                                         psanaRun=run,
+                                         times=times)
+        det.iX, det.iY = geomCache.indexes()
+        det.tile = np.empty(detDesc.tileDim, dtype=np.float32) # reused cheetah tile for saving hits
         try:
             det.ipx, det.ipy = det.point_indexes(evt, pxy_um=(0, 0),
                                               pix_scale_size_um=None,
@@ -226,10 +306,21 @@ def runclient(args,ds,run,times,det,numEvents,detDesc):
         except AttributeError:
             det.ipx, det.ipy = det.point_indexes(evt, pxy_um=(0, 0))
 
-    for i, nevent in enumerate(myJobs):
-        evt = run.event(times[nevent])
-        if evt is None: continue
-
+    if args.inputImages:
+        # one open handle and an eventNumber to row map instead of a lookup per event
+        inputImages = h5py.File(args.inputImages, 'r')
+        inputRow = {int(nevent): row for row, nevent in enumerate(inputImages['eventNumber'][()])}
+    runLock = threading.Lock()
+
+    def fetchCalib(nevent):
+        """Fetch and calibrate an event, runs in the prefetch threads"""
+        tic = time.time()
+        with runLock:
+            evt = run.event(times[nevent])
+            info = None if evt is None else getEventInfo(args, evt, es, evr0, evr1, evr2)
+        toc = time.time()
+        prefetcher.addTime('fetch', toc - tic)
+        if evt is None: return evt, None, None
         if not args.inputImages:
             if args.cm0 > 0: # override common mode correction
                 if args.cm0 == 5:  # Algorithm 5
@@ -239,17 +330,70 @@ def runclient(args,ds,run,times,det,numEvents,detDesc):
             else:
                 detarr = det.calib(evt)
         else:
-            f = h5py.File(args.inputImages)
-            ind = np.where(f['eventNumber'][()] == nevent)[0][0]
-            if len(f['/data/data'].shape) == 3:
-                detarr = detDesc.ipct(f['data/data'][ind, :, :])
+            ind = inputRow[int(nevent)]
+            if len(inputImages['/data/data'].shape) == 3:
+                detarr = detDesc.ipct(inputImages['data/data'][ind, :, :])
             else:
-                detarr = f['data/data'][ind, :, :, :]
-            f.close()
-        if detarr is None: continue
-
-        numHits = calcPeaks(args, numHits, myHdf5, detarr, evt, det, nevent, detDesc, es, evr0, evr1, evr2)
+                detarr = inputImages['data/data'][ind, :, :, :]
+        prefetcher.addTime('calib', time.time() - toc)
+        return evt, detarr, info
+
+    # a single thread calibrates ahead, det is shared and psana calls are not thread safe
+    prefetcher = Prefetcher(fetchCalib, depth=args.prefetch, numThreads=1)
+
+    numCachedMisses = 0
+    def uncached(events):
+        """
+        Events that need calibration, misses are decided from the cached peaks.
+        Cached misses are never calibrated, so they are left out of powderMisses and counted in numCachedMisses.
+        """
+        nonlocal numCachedMisses
+        for nevent in events:
+            if peakCache is not None and nevent in peakCache:
+                det.peakFinder.setPeaks(peakCache.get(nevent), args.minPeaks)
+                if not isHit(args, det.peakFinder.numPeaksFound, det.peakFinder.maxRes):
+                    nPeaksAll[nevent] = det.peakFinder.numPeaksFound
+                    numCachedMisses += 1
+                    if args.singleFile: hitBuffer.poll()
+                    continue
+            yield nevent
+
+    for nevent, (evt, detarr, info) in prefetcher.imap(uncached(myJobs)):
+        if detarr is not None:
+            tic = time.time()
+            numHits = calcPeaks(args, numHits, hitBuffer, nPeaksAll, detarr, evt, det, nevent, detDesc, info)
+            if peakCache is not None: peakCache.put(nevent, det.peakFinder.peaks)
+            prefetcher.addTime('peaks', time.time() - tic)
+        # in single file mode all ranks write their hits together whenever the buffer of any rank is full
+        if args.singleFile: hitBuffer.poll()
+    if args.singleFile: hitBuffer.finish()
+
+    prefetcher.close()
+    if args.inputImages: inputImages.close()
+    if args.profile:
+        print("rank {} timing (s): ".format(rank) + ", ".join(
+            "{} {:.2f}".format(stage, t) for stage, t in sorted(prefetcher.timing.items())))
+
+    if scheduler is not None:
+        scheduler.free()
+        myJobs = np.array(scheduler.myJobs, dtype=int)
+    geomCache.close() # masks and pixel indexes are no longer needed
+    numJobs = len(myJobs) # events per rank
+    if peakCache is not None: peakCache.save(rank)
 
+    # Write out remaining hits
+    hitBuffer.flush()
+    if args.singleFile:
+        # the master rank fills in nPeaksAll, powders, mask and status once the shared file is closed
+        numHitsAll = hitBuffer.numRows
+    else:
+        numHitsAll = numHits
+        if numJobs > 0:
+            first, last = np.min(myJobs), np.max(myJobs)
+            myHdf5["/entry_1/result_1/nPeaksAll"][first:last+1] = nPeaksAll[first:last+1]
+        # record which events this rank processed
+        if '/psocake/events' in myHdf5: del myHdf5['/psocake/events']
+        myHdf5.create_dataset('/psocake/events', data=myJobs, dtype=int)
 
     # Finished with peak finding
     # Fill in clen and photon energy (eV)
@@ -284,34 +428,38 @@ def runclient(args,ds,run,times,det,numEvents,detDesc):
             ebeam = ebeamDet.get(evt)
             photonEnergy = ebeam.ebeamPhotonEnergy()
 
-    myHdf5['/LCLS/detector_1/EncoderValue'][...] = lclsDet
-    myHdf5['/LCLS/photon_energy_eV'][...] = photonEnergy
-
-    # crop
-    cropHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHits)
-    cropHdf5(myHdf5, '/LCLS/photon_energy_eV', numHits)
-    cropHdf5(myHdf5, '/LCLS/detector_1/EncoderValue', numHits)
-    cropHdf5(myHdf5, '/LCLS/eventNumber', numHits)
-    cropHdf5(myHdf5, '/LCLS/machineTime', numHits)
-    cropHdf5(myHdf5, '/LCLS/machineTimeNanoSeconds', numHits)
-    cropHdf5(myHdf5, '/LCLS/fiducial', numHits)
+    # crop (collective in single file mode, every rank resizes to the total number of hits)
+    cropHdf5(myHdf5, '/entry_1/result_1/nPeaks', numHitsAll)
+    cropHdf5(myHdf5, '/LCLS/photon_energy_eV', numHitsAll)
+    cropHdf5(myHdf5, '/LCLS/detector_1/EncoderValue', numHitsAll)
+    if not args.singleFile or rank == 0:
+        myHdf5['/LCLS/detector_1/EncoderValue'][...] = lclsDet
+        myHdf5['/LCLS/photon_energy_eV'][...] = photonEnergy
+    cropHdf5(myHdf5, '/LCLS/eventNumber', numHitsAll)
+    cropHdf5(myHdf5, '/LCLS/machineTime', numHitsAll)
+    cropHdf5(myHdf5, '/LCLS/machineTimeNanoSeconds', numHitsAll)
+    cropHdf5(myHdf5, '/LCLS/fiducial', numHitsAll)
 
     # resize
     dataShape = myHdf5["/entry_1/data_1/data"].shape
-    myHdf5["/entry_1/data_1/data"].resize((numHits, dataShape[1], dataShape[2]))
-    myHdf5["/entry_1/result_1/peakXPosRaw"].resize((numHits,args.maxPeaks))
-    myHdf5["/entry_1/result_1/peakYPosRaw"].resize((numHits,args.maxPeaks))
+    myHdf5["/entry_1/data_1/data"].resize((numHitsAll, dataShape[1], dataShape[2]))
+    myHdf5["/entry_1/result_1/peakXPosRaw"].resize((numHitsAll,args.maxPeaks))
+    myHdf5["/entry_1/result_1/peakYPosRaw"].resize((numHitsAll,args.maxPeaks))
 
-    myHdf5["/entry_1/result_1/rcent"].resize((numHits, args.maxPeaks))
-    myHdf5["/entry_1/result_1/ccent"].resize((numHits, args.maxPeaks))
-    myHdf5["/entry_1/result_1/rmin"].resize((numHits, args.maxPeaks))
-    myHdf5["/entry_1/result_1/rmax"].resize((numHits, args.maxPeaks))
-    myHdf5["/entry_1/result_1/cmin"].resize((numHits, args.maxPeaks))
-    myHdf5["/entry_1/result_1/cmax"].resize((numHits, args.maxPeaks))
+    myHdf5["/entry_1/result_1/rcent"].resize((numHitsAll, args.maxPeaks))
+    myHdf5["/entry_1/result_1/ccent"].resize((numHitsAll, args.maxPeaks))
+    myHdf5["/entry_1/result_1/rmin"].resize((numHitsAll, args.maxPeaks))
+    myHdf5["/entry_1/result_1/rmax"].resize((numHitsAll, args.maxPeaks))
+    myHdf5["/entry_1/result_1/cmin"].resize((numHitsAll, args.maxPeaks))
+    myHdf5["/entry_1/result_1/cmax"].resize((numHitsAll, args.maxPeaks))
 
-    myHdf5["/entry_1/result_1/peakTotalIntensity"].resize((numHits,args.maxPeaks))
-    myHdf5["/entry_1/result_1/peakMaxIntensity"].resize((numHits,args.maxPeaks))
-    myHdf5["/entry_1/result_1/peakRadius"].resize((numHits, args.maxPeaks))
+    myHdf5["/entry_1/result_1/peakTotalIntensity"].resize((numHitsAll,args.maxPeaks))
+    myHdf5["/entry_1/result_1/peakMaxIntensity"].resize((numHitsAll,args.maxPeaks))
+    myHdf5["/entry_1/result_1/peakRadius"].resize((numHitsAll, args.maxPeaks))
+
+    if args.singleFile:
+        myHdf5.close() # collective
+        return numHits, numJobs, nPeaksAll, numCachedMisses
 
     # add powder
     myHdf5["/entry_1/data_1/powderHits"][...] = detDesc.pct(det.peakFinder.powderHits)
@@ -337,3 +485,5 @@ def runclient(args,ds,run,times,det,numEvents,detDesc):
     if '/status/findPeaks' in myHdf5: del myHdf5['/status/findPeaks']
     myHdf5['/status/findPeaks'] = 'success'
     myHdf5.close()
+
+    return numHits, numJobs, nPeaksAll, numCachedMisses
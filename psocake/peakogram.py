@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 import re
 import ntpath
+from itertools import islice
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-i", default="peaks.txt", help="peaks.txt file")
@@ -30,72 +31,155 @@ parser.add_argument("--nmax", default=np.inf, type=int, help="maximum number of
 parser.add_argument("-o", default="peakogram", help="output file prefix")
 args = parser.parse_args()
 
-data = []
-n = 0
-
-if (args.i.endswith(".txt")):
-    with open(args.i) as f:
-        for line in f:
-            if n > args.nmax:
-                break
-            columns = line.split(',')
-            if columns[0].isdigit():
-                n += 1
-                data.append([columns[8], columns[13]])
-                if n % 1000 == 0:
-                    sys.stdout.write("\r%i peaks found" % n)
-                    sys.stdout.flush()
-    data = np.asarray(data, dtype=float)
-    sys.stdout.write("\r%i peaks found" % n)
-    sys.stdout.flush()
-    print("")
-    x = data[:, 0]
-    y = data[:, 1]
-
-else:
-    for i in range(args.n):
+def getComm():
+    """MPI communicator when running under mpirun, otherwise None"""
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return None
+    return MPI.COMM_WORLD if MPI.COMM_WORLD.Get_size() > 1 else None
+
+comm = getComm()
+rank = comm.Get_rank() if comm else 0
+size = comm.Get_size() if comm else 1
+
+def readText(fname, nmax, blockLines=100000):
+    """peak radius and maximum intensity from the peaks.txt file, a block of lines at a time"""
+    n = 0
+    with open(fname) as f:
+        while n <= nmax:
+            block = list(islice(f, blockLines))
+            if not block: break
+            lines = [line for line in block if line.split(',', 1)[0].isdigit()]
+            if not lines: continue
+            lines = lines[:int(min(len(lines), nmax + 1 - n))]
+            data = np.loadtxt(lines, delimiter=',', usecols=(8, 13), dtype=float, ndmin=2)
+            n += len(lines)
+            sys.stdout.write("\r%i peaks found" % n)
+            sys.stdout.flush()
+            yield data[:, 0], data[:, 1]
+
+def readCxi(fnames, blockSize=2**20):
+    """peak radius and maximum intensity from the cxi files, a block of whole HDF5 chunks at a time"""
+    for fname in fnames:
+        with h5py.File(fname, 'r') as f:
+            dsx = f['entry_1/result_1/peakRadius']
+            dsy = f['entry_1/result_1/peakMaxIntensity']
+            numRows = dsx.shape[0]
+            rowSize = int(np.prod(dsx.shape[1:]))
+            chunkRows = dsx.chunks[0] if dsx.chunks else 1
+            step = max(1, blockSize // max(rowSize, 1) // chunkRows) * chunkRows
+            for i in range(0, numRows, step):
+                yield dsx[i:i + step].ravel(), dsy[i:i + step].ravel()
+
+def readPeaks():
+    """this rank's share of the peaks, as (radius, intensity) blocks"""
+    if args.i.endswith(".txt"):
+        return readText(args.i, args.nmax) if rank == 0 else iter(())
+    fnames = []
+    for i in np.array_split(np.arange(args.n), size)[rank]:
         fname = args.i + "_" + str(i)
         if args.t: fname += "_"+args.t
         fname += ".cxi"
-        f = h5py.File(fname, 'r')
-        if i == 0:
-            x = f['entry_1/result_1/peakRadius'][()]
-            y = f['entry_1/result_1/peakMaxIntensity'][()]
-        else:
-            x = np.append(x,f['entry_1/result_1/peakRadius'][()],axis=0)
-            y = np.append(y,f['entry_1/result_1/peakMaxIntensity'][()],axis=0)
-        f.close()
-
-xmin = np.min(x[x > 0])
-xmax = np.max(x)
-ymin = np.min(y[y > 0])
-ymax = np.max(y)
-
-if args.rmin is not None:
-    xmin = args.rmin
-if args.rmax is not None:
-    xmax = args.rmax
-if args.imin is not None:
-    ymin = args.imin
-if args.imax is not None:
-    ymax = args.imax
-
-keepers = np.where((x > xmin) & (x < xmax) & (y > ymin) & (y < ymax))
-
-x = x[keepers]
-y = y[keepers]
+        fnames.append(fname)
+    return readCxi(fnames)
+
+def reduceLimits(lo, hi):
+    """global minimum of lo and maximum of hi over the ranks"""
+    if comm is None: return lo, hi
+    from mpi4py import MPI
+    return [comm.allreduce(a, op=MPI.MIN) for a in lo], [comm.allreduce(a, op=MPI.MAX) for a in hi]
+
+def getSampleDtype(dtype):
+    """dtype histogram2d would see for the stacked (y, x) samples, agreed over the ranks"""
+    if comm is not None:
+        dtype = next((d for d in comm.allgather(dtype) if d is not None), None)
+    return np.dtype(dtype if dtype is not None else float)
+
+def getLimits():
+    """data limits of the peaks, xmin and ymin over the positive values only"""
+    lo = [np.inf, np.inf]
+    hi = [-np.inf, -np.inf]
+    for x, y in readPeaks():
+        xp = x[x > 0]
+        yp = y[y > 0]
+        if xp.size: lo[0] = min(lo[0], xp.min())
+        if yp.size: lo[1] = min(lo[1], yp.min())
+        if x.size: hi[0] = max(hi[0], x.max())
+        if y.size: hi[1] = max(hi[1], y.max())
+    lo, hi = reduceLimits(lo, hi)
+    return lo[0], hi[0], lo[1], hi[1]
+
+def keep(x, y):
+    """peaks within the cutoffs, intensity in log scale if requested"""
+    keepers = np.where((x > xmin) & (x < xmax) & (y > ymin) & (y < ymax))
+    x = x[keepers]
+    y = y[keepers]
+    if args.l:
+        y = np.log10(y)
+    return x, y
+
+def getOuterEdges(lo, hi):
+    """outer bin edges histogram2d derives from the data range"""
+    if lo > hi: # no peaks
+        lo, hi = 0, 1
+    if lo == hi:
+        lo = lo - 0.5
+        hi = hi + 0.5
+    return lo, hi
+
+def binIndex(a, edges):
+    """histogram bin of every value with 0 and len(edges) for the outliers, values on the last edge in the last bin"""
+    ind = np.searchsorted(edges, a, side='right')
+    ind[a == edges[-1]] -= 1
+    return ind
+
+# Pass 1: cutoffs, only from the data where they are not given
+xmin = args.rmin
+xmax = args.rmax
+ymin = args.imin
+ymax = args.imax
+if None in (xmin, xmax, ymin, ymax):
+    limits = getLimits()
+    xmin, xmax, ymin, ymax = [lim if arg is None else arg for lim, arg in zip(limits, (xmin, xmax, ymin, ymax))]
+
+# Pass 2: range of the kept peaks, which sets the bin edges
+lo = [np.inf, np.inf]
+hi = [-np.inf, -np.inf]
+dtype = None
+for x, y in readPeaks():
+    x, y = keep(x, y)
+    dtype = np.result_type(y, x)
+    if x.size:
+        lo = [min(lo[0], y.min()), min(lo[1], x.min())]
+        hi = [max(hi[0], y.max()), max(hi[1], x.max())]
+lo, hi = reduceLimits(lo, hi)
+sampleDtype = getSampleDtype(dtype)
+bins = 300
+yedges = np.linspace(*getOuterEdges(*[sampleDtype.type(a) for a in (lo[0], hi[0])]), bins + 1)
+xedges = np.linspace(*getOuterEdges(*[sampleDtype.type(a) for a in (lo[1], hi[1])]), bins + 1)
+
+# Pass 3: fixed-bin histogram, one block at a time
+counts = np.zeros((bins + 2) * (bins + 2), dtype=np.int64)
+for x, y in readPeaks():
+    x, y = keep(x, y)
+    ind = binIndex(y.astype(sampleDtype, copy=False), yedges) * (bins + 2) + \
+          binIndex(x.astype(sampleDtype, copy=False), xedges)
+    counts += np.bincount(ind, minlength=counts.size)
+if args.i.endswith(".txt") and rank == 0: print("")
+if comm is not None:
+    from mpi4py import MPI
+    comm.Reduce(MPI.IN_PLACE if rank == 0 else counts, counts if rank == 0 else None, op=MPI.SUM)
+    if rank > 0: sys.exit()
+H = counts.reshape(bins + 2, bins + 2)[1:-1, 1:-1].astype(float)
 
 if args.l:
-    y = np.log10(y)
     ymin = np.log10(ymin)
     ymax = np.log10(ymax)
 
-bins = 300
-H, xedges, yedges = np.histogram2d(y, x, bins=bins)
-
 fig = plt.figure()
 ax1 = plt.subplot(111)
-plot = ax1.pcolormesh(yedges, xedges, H, norm=LogNorm())
+plot = ax1.pcolormesh(xedges, yedges, H, norm=LogNorm())
 cbar = plt.colorbar(plot)
 plt.xlim([xmin, xmax])
 plt.ylim([ymin, ymax])
@@ -15,6 +15,7 @@ import argparse
 import threading
 import copy
 from sklearn.neighbors import NearestNeighbors
+import scipy.sparse
 import subprocess
 
 # Parse user input
@@ -23,6 +24,8 @@ parser.add_argument("-e","--embedding",help="full filename to embed_<exp>.h5", t
 parser.add_argument("-f","--filepath",help="full path to <exp>_<run>.cxi", type=str)
 parser.add_argument("-t","--tag",help="tag", default=None, type=str)
 parser.add_argument("-v","--verbose",help="print detail", default=0, type=int)
+parser.add_argument("-k","--knn",help="number of nearest neighbours in the diffusion kernel", default=50, type=int)
+parser.add_argument("--tol",help="stop propagating when at most this fraction of labels changes", default=0, type=float)
 args = parser.parse_args()
 fname = args.embedding
 path = args.filepath
@@ -513,99 +516,82 @@ def setup(experimentName,runNumber,detInfo):
     return run, times, det, evt
 
 def diffusionKernel(X, eps, knn, D=None):
-    nbrs = NearestNeighbors(n_neighbors=knn, algorithm='ball_tree').fit(X)    
+    """Sparse (CSR) column-stochastic diffusion kernel on the kNN graph of X, memory is O(N*knn)"""
+    knn = min(knn, X.shape[0])
+    nbrs = NearestNeighbors(n_neighbors=knn, algorithm='ball_tree').fit(X)
     D = nbrs.kneighbors_graph(X, mode='distance')
-    term = D.multiply(D)/-eps
-    G = np.exp(term.toarray())
-    G[np.where(G==1)]=0
-    G = G + np.eye(G.shape[0])
-    deg = np.sum(G,axis=0)
-    P = G/deg
+    G = D.multiply(D).tocsr()
+    G.data = np.exp(G.data/-eps)
+    G.data[G.data == 1] = 0 # zero distances, e.g. self
+    G.eliminate_zeros()
+    G = G + scipy.sparse.identity(G.shape[0], format='csr')
+    deg = np.asarray(G.sum(axis=0)).ravel()
+    P = G.dot(scipy.sparse.diags(1./deg)).tocsr()
     return P, D
 
-def propagate(matrix, list):
-    for i in np.arange(X[:,0].size):
-        label = np.amax(matrix[:,i])
-        if label != 0:
-            idx = np.argmax(matrix[:,i])
-            if propLabels[list[idx]] != 0:
-                propLabels[i] = propLabels[list[idx]]
-            else:
-                propLabels[i] = userLabels[list[idx]]
-
-def fillProp():
-    global propLabels
-    global userLabels
-    num = 0
-    while 1:
-        list = []
-        for i in np.arange(X[:,0].size):
-            if propLabels[i] != 0 :
-                list.append(i)
-        matrix = P[list,:]
-        if num == matrix.shape[0]:
-            num = matrix.shape[0]
-            break
-        num = matrix.shape[0]
-        propagate(matrix, list)
-    #print "###: ", userLabels, len(userLabels)
-    #propagate(P,np.arange(X[:,0].size))
-    ##Update the dataset
-    files = {}
+def propagate(P, labels):
+    """
+    One sweep of label propagation: every event takes the label of the labelled event
+    with the largest transition probability to it.
+    :param P: sparse diffusion kernel
+    :param labels: current labels, 0 is unlabelled
+    :return: new labels
+    """
+    labelled = np.flatnonzero(labels)
+    newLabels = np.copy(labels)
+    if len(labelled) == 0: return newLabels
+    M = P[labelled,:].tocoo()
+    keep = M.data > 0
+    row, col, val = M.row[keep], M.col[keep], M.data[keep]
+    # sort by column, then probability, ties go to the first labelled event like np.argmax
+    order = np.lexsort((-row, val, col))
+    row, col = row[order], col[order]
+    last = np.append(col[1:] != col[:-1], True) # largest probability of every column
+    newLabels[col[last]] = labels[labelled[row[last]]]
+    return newLabels
+
+def saveLabels():
+    """Write propLabels to <exp>_<run>_labels.h5 of every run"""
     filePath = "/reg/d/psdm/" + expName[:3] + "/" + expName + "/scratch/" + user + "/psocake"
     for run in ir.runs:
         if not os.path.exists(filePath + '/r' + str(run).zfill(4)):
             os.makedirs(filePath + '/r' + str(run).zfill(4))
+        evts = np.where(ir.runList == run)[0]
         f = h5py.File(filePath+ '/r' + str(run).zfill(4)+'/'+expName+'_'+str(run).zfill(4) + '_labels.h5', 'a')
-        files[run] = f
-    for idx, label in enumerate(propLabels):
-        evtNum = ir.eventInd[idx]
-        try:
-            files[ir.runList[idx]]['propLabels'][ir.eventInd[idx]] = label
-        except:
+        if 'propLabels' not in f:
             if args.tag is not None:
-                eventsTotal = h5py.File(filePath+ '/r' + str(int(ir.runList[idx])).zfill(4)+'/'+expName+'_'+str(int(ir.runList[idx])).zfill(4) + '_' + args.tag + '.cxi', 'r+')['/entry_1/result_1/nHitsAll'].size
+                eventsTotal = h5py.File(filePath+ '/r' + str(run).zfill(4)+'/'+expName+'_'+str(run).zfill(4) + '_' + args.tag + '.cxi', 'r+')['/entry_1/result_1/nHitsAll'].size
             else:
-                eventsTotal = h5py.File(filePath+ '/r' + str(int(ir.runList[idx])).zfill(4)+'/'+expName+'_'+str(int(ir.runList[idx])).zfill(4) + '.cxi', 'r+')['/entry_1/result_1/nHitsAll'].size
-            dset = files[ir.runList[idx]].create_dataset("propLabels", (eventsTotal, 1))
-            dset[ir.eventInd[idx]] = label
-    for run, f in files.iteritems():
+                eventsTotal = h5py.File(filePath+ '/r' + str(run).zfill(4)+'/'+expName+'_'+str(run).zfill(4) + '.cxi', 'r+')['/entry_1/result_1/nHitsAll'].size
+            f.create_dataset("propLabels", (eventsTotal, 1))
+        dset = f['propLabels']
+        arr = dset[()]
+        arr[ir.eventInd[evts].astype(int), 0] = propLabels[evts]
+        dset[...] = arr
         f.close()
+
+def fillProp():
+    global propLabels
+    global userLabels
+    # propagate until at most a fraction tol of the labels changes
+    for i in range(X.shape[0]):
+        newLabels = propagate(P, propLabels)
+        numChanged = np.count_nonzero(newLabels != propLabels)
+        propLabels = newLabels
+        if numChanged <= args.tol * len(propLabels): break
+    #print "###: ", userLabels, len(userLabels)
+    ##Update the dataset
+    saveLabels()
     print "Done"
 
 ## Propagate Button ##
 def onClick(event):
-    list = []
-    for i in np.arange(X[:,0].size):
-        if propLabels[i] != 0 :
-            list.append(i)
-    matrix = P[list,:]
-    #print matrix.shape
-    propagate(matrix, list)
-    #propagate(P,np.arange(X[:,0].size))
+    global propLabels
+    propLabels = propagate(P, propLabels)
     ax.clear()
     colors = ['red' if propLabels[idx] == 1 else 'green' if propLabels[idx] == 2 else 'blue' if propLabels[idx] == 3 else 'black' for idx, val in enumerate(X[:,1])]
     ax.scatter(X[:,0],X[:,1],X[:,2], color = colors, picker=5, alpha=0.1)
-    files = {}
-    filePath = "/reg/d/psdm/" + expName[:3] + "/" + expName + "/scratch/" + user + "/psocake"
-    for run in ir.runs:
-        if not os.path.exists(filePath + '/r' + str(run).zfill(4)):
-            os.makedirs(filePath + '/r' + str(run).zfill(4))
-        f = h5py.File(filePath+ '/r' + str(run).zfill(4)+'/'+expName+'_'+str(run).zfill(4) + '_labels.h5', 'a')
-        files[run] = f
-    for idx, label in enumerate(propLabels):
-        evtNum = ir.eventInd[idx]
-        try:
-            files[ir.runList[idx]]['propLabels'][ir.eventInd[idx]] = label
-        except:
-            if args.tag is not None:
-                eventsTotal = h5py.File(filePath+ '/r' + str(int(ir.runList[idx])).zfill(4)+'/'+expName+'_'+str(int(ir.runList[idx])).zfill(4) + '_' + args.tag + '.cxi', 'r+')['/entry_1/result_1/nHitsAll'].size
-            else:
-                eventsTotal = h5py.File(filePath+ '/r' + str(int(ir.runList[idx])).zfill(4)+'/'+expName+'_'+str(int(ir.runList[idx])).zfill(4) + '.cxi', 'r+')['/entry_1/result_1/nHitsAll'].size
-            dset = files[ir.runList[idx]].create_dataset("propLabels", (eventsTotal, 1))
-            dset[ir.eventInd[idx]] = label
-    for run, f in files.iteritems():
-        f.close()
+    saveLabels()
     print "Done"
 
 ## Refresh Button ##
@@ -659,88 +645,30 @@ def mostConfusing(event):
         #Save it as confusion
     global maxEvents
     knn = 10
-    num = 0
-    events = []
-    (numEvents, numLabels) = X.shape
-    # X.shape = (numEvents, numEigs)
     myList = np.where(propLabels != 0)[0]
     if len(myList) < 2: return
-    # P is non-symmetric
-    matrix = P[:,myList]
-
-    if 0:
-        ind = 1868 # amo86615 197
-        probs = np.copy(matrix[:,ind])
-        sorted = np.sort(probs)#, axis=None)
-        argsorted = np.argsort(probs)#, axis=None)
-        print "sorted: ", sorted[0], sorted[1], sorted[-2], sorted[-1]
-        print "argsorted: ", argsorted[0], argsorted[1], argsorted[-2], argsorted[-1]
-        fig = plt.figure()
-        plt.subplot(341)
-        plt.plot(matrix[:,ind],'x-')
-        print "sum: ", np.sum(matrix[ind,:]), np.sum(matrix[:,ind])
-        plt.subplot(342)
-        plt.imshow(getAssemImage(ind),interpolation='none',vmin=0, vmax=300)
-        plt.subplot(345)
-        maxInd = argsorted[-2]
-        plt.imshow(getAssemImage(maxInd),interpolation='none',vmin=0, vmax=300)
-        plt.title(matrix[maxInd,ind])
-        plt.subplot(346)
-        maxInd = argsorted[-3]
-        plt.imshow(getAssemImage(maxInd),interpolation='none',vmin=0, vmax=300)
-        plt.title(matrix[maxInd,ind])
-        plt.subplot(347)
-        maxInd = argsorted[-4]
-        plt.imshow(getAssemImage(maxInd),interpolation='none',vmin=0, vmax=300)
-        plt.title(matrix[maxInd,ind])
-        plt.subplot(348)
-        maxInd = argsorted[-5]
-        plt.imshow(getAssemImage(maxInd),interpolation='none',vmin=0, vmax=300)
-        plt.title(matrix[maxInd,ind])
-        plt.subplot(349)
-        minInd = argsorted[0]
-        plt.imshow(getAssemImage(minInd),interpolation='none',vmin=0, vmax=300)
-        plt.title(matrix[minInd,ind])
-        plt.subplot(3,4,10)
-        minInd = argsorted[1]
-        plt.imshow(getAssemImage(minInd),interpolation='none',vmin=0, vmax=300)
-        plt.title(matrix[minInd,ind])
-        plt.subplot(3,4,11)
-        minInd = argsorted[2]
-        plt.imshow(getAssemImage(minInd),interpolation='none',vmin=0, vmax=300)
-        plt.title(matrix[minInd,ind])
-        plt.subplot(3,4,12)
-        minInd = argsorted[3]
-        plt.imshow(getAssemImage(minInd),interpolation='none',vmin=0, vmax=300)
-        plt.title(matrix[minInd,ind])
-        plt.show()
 
     import time
     tic = time.time()
-    confusion = np.zeros(numEvents) # confusion
-    for i in np.arange(numEvents):
-        probs = np.copy(matrix[:,i])
-        sorted = np.argsort(probs)
-        _label = propLabels[sorted[-knn:]]
-        _currentLabel = _label[-1]
-        _prob = probs[sorted[-knn:]]
-        confusion[i] = np.sum(_prob[np.where(_label!=_currentLabel)])
-        #print i, _label, _prob, np.sum(_prob[np.where(_label==1)]), np.sum(_prob[np.where(_label!=1)]), _currentLabel, confusion[i]
+    # P is non-symmetric, the neighbours of an event are the rows of its column
+    M = P.tocoo()
+    keep = M.data > 0
+    row, col, val = M.row[keep], M.col[keep], M.data[keep]
+    order = np.lexsort((-val, col)) # by column, most probable neighbour first
+    row, col, val = row[order], col[order], val[order]
+    start = np.searchsorted(col, col) # most probable neighbour of every column
+    top = np.arange(len(col)) - start < knn
+    # confusion: probability of the knn neighbours labelled differently from the most probable neighbour
+    differs = top & (propLabels[row] != propLabels[row[start]])
+    confusion = np.bincount(col[differs], weights=val[differs], minlength=P.shape[1])
     toc = time.time()
     print "time: ", toc-tic
 
-    events = np.argsort(confusion)
-    if len(events) > maxEvents: events = events[-maxEvents:]
-    
-    # Only for debug
-    for i in events:
-        probs = np.copy(matrix[:,i])
-        sorted = np.argsort(probs)
-        _label = propLabels[sorted[-knn:]]
-        _currentLabel = _label[-1]
-        _prob = probs[sorted[-knn:]]
-        confusion[i] = np.sum(_prob[np.where(_label!=_currentLabel)])
-        if args.verbose >= 1: print "most confusing: ", i, _label, _currentLabel, _prob, confusion[i]
+    numShow = min(int(maxEvents), len(confusion))
+    events = np.argpartition(confusion, -numShow)[-numShow:]
+    events = events[np.argsort(confusion[events])]
+    if args.verbose >= 1:
+        for i in events: print "most confusing: ", i, confusion[i]
     eventsToShow(events)
 
     #tic = time.time()
@@ -957,7 +885,7 @@ print "Provided Labels: ", round(fracUserLabels, 3), " %"
 propLabels = np.copy(userLabels)
 
 # Calculate diffusion kernel
-P,_ = diffusionKernel(X, eps=eps, knn=len(propLabels))
+P,_ = diffusionKernel(X, eps=eps, knn=args.knn)
 
 # Launch GUI app
 app = QtGui.QApplication(sys.argv)
@@ -17,6 +17,7 @@ class psanaWhisperer():
         self.aduPerPhoton = aduPerPhoton
         self.localCalib = localCalib
         self.access = access
+        self.eventIndex = None
 
     def setupExperiment(self):
         access = 'exp=' + str(self.experimentName) + ':run=' + str(self.runNumber) + ':idx'
@@ -26,6 +27,7 @@ class psanaWhisperer():
         self.run = next(self.ds.runs())
         self.times = self.run.times()
         self.eventTotal = len(self.times)
+        self.eventIndex = None # built on the first timestamp lookup
         self.env = self.ds.env()
         self.evt = self.run.event(self.times[0])
         self.det = psana.Detector(str(self.detInfo), self.env)
@@ -132,14 +134,17 @@ class psanaWhisperer():
         # Gets psana event given cheetahFilename, e.g. LCLS_2015_Jul26_r0014_035035_e820.h5
         hrsMinSec = cheetahFilename.split('_')[-2]
         fid = int(cheetahFilename.split('_')[-1].split('.')[0], 16)
-        for t in self.times:
-            if t.fiducial() == fid:
-                localtime = time.strftime('%H:%M:%S', time.localtime(t.seconds()))
-                localtime = localtime.replace(':', '')
-                if localtime[0:3] == hrsMinSec[0:3]:
-                    self.evt = self.run.event(t)
-                else:
-                    self.evt = None
+        if self.eventIndex is None:
+            self.eventIndex = utils.EventIndex.fromTimes(self.times)
+        i = self.eventIndex.lastWithFiducial(fid)
+        if i is not None:
+            t = self.times[i]
+            localtime = time.strftime('%H:%M:%S', time.localtime(t.seconds()))
+            localtime = localtime.replace(':', '')
+            if localtime[0:3] == hrsMinSec[0:3]:
+                self.evt = self.run.event(t)
+            else:
+                self.evt = None
 
     def getStartTime(self):
         self.evt = self.run.event(self.times[0])
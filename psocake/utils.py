@@ -2,9 +2,18 @@ import json
 import psana
 import sys
 import numpy as np
+import h5py
 from numba import jit
 import subprocess, os
 import string, random
+import hashlib
+import threading, time
+import mmap, shutil
+import select, re
+from collections import deque, OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
 
 ansi_cmap = {"k": '0;30',
         "r": '0;31',
@@ -40,6 +49,95 @@ def getMyUnfairShare(numJobs, numWorkers, rank):
     myJobs = allJobs[myChunk[0]:myChunk[-1]+1]
     return myJobs
 
+class DynamicShare(object):
+    """
+    Work-stealing alternative to getMyUnfairShare.
+    Events are handed out in small batches on demand through a shared counter held
+    in a one-sided MPI window on rank 0, so fast ranks keep pulling work while slow
+    ranks finish their current batch. Iterating yields event numbers and records
+    every event this rank was given in self.myJobs.
+    :param comm: MPI communicator, all ranks must construct the scheduler
+    :param numJobs: total number of events
+    :param batchSize: number of events handed out per request
+    """
+    def __init__(self, comm, numJobs, batchSize=8):
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.numJobs = numJobs
+        self.batchSize = max(int(batchSize), 1)
+        self.myJobs = []
+        if comm.Get_rank() == 0:
+            self.counter = np.zeros(1, dtype=np.int64)
+            self.win = MPI.Win.Create(self.counter, comm=comm)
+        else:
+            self.counter = None
+            self.win = MPI.Win.Create(None, comm=comm)
+        self._incr = np.array([self.batchSize], dtype=np.int64)
+        self._start = np.zeros(1, dtype=np.int64)
+
+    def nextBatch(self):
+        """Atomically reserve the next batch of events, empty when all events are taken"""
+        self.win.Lock(0, self.MPI.LOCK_SHARED)
+        self.win.Fetch_and_op(self._incr, self._start, 0, 0, self.MPI.SUM)
+        self.win.Unlock(0)
+        start = int(self._start[0])
+        return np.arange(min(start, self.numJobs), min(start + self.batchSize, self.numJobs))
+
+    def __iter__(self):
+        while True:
+            batch = self.nextBatch()
+            if len(batch) == 0: break
+            self.myJobs.extend(batch)
+            for nevent in batch:
+                yield nevent
+
+    def free(self):
+        """Collective: release the MPI window once every rank is done"""
+        self.win.Free()
+
+class Prefetcher(object):
+    """
+    Bounded read-ahead: func is applied to upcoming items in a pool of worker threads
+    while the caller works on the current item. Results are returned in order.
+    Time spent waiting for results is counted in timing['wait'], func may add its own
+    stages with addTime().
+    :param func: function applied to every item, e.g. fetch and calibrate an event
+    :param depth: maximum number of items in flight, 0 calls func in the calling thread
+    :param numThreads: number of worker threads
+    """
+    def __init__(self, func, depth=4, numThreads=1):
+        self.func = func
+        self.depth = max(int(depth), 0)
+        self.timing = {} # stage -> seconds
+        self.lock = threading.Lock()
+        self.pool = None
+        if self.depth > 0:
+            self.pool = ThreadPoolExecutor(max_workers=max(int(numThreads), 1))
+
+    def addTime(self, stage, seconds):
+        with self.lock:
+            self.timing[stage] = self.timing.get(stage, 0.) + seconds
+
+    def imap(self, items):
+        """Yields (item, func(item)) in the order of items"""
+        if self.pool is None:
+            for item in items:
+                yield item, self.func(item)
+            return
+        items = iter(items)
+        pending = deque((item, self.pool.submit(self.func, item)) for item in islice(items, self.depth))
+        while pending:
+            item, future = pending.popleft()
+            tic = time.time()
+            result = future.result()
+            self.addTime('wait', time.time() - tic)
+            for nextItem in islice(items, 1):
+                pending.append((nextItem, self.pool.submit(self.func, nextItem)))
+            yield item, result
+
+    def close(self):
+        if self.pool is not None: self.pool.shutdown(wait=True)
+
 def batchSubmit(cmd, queue, cores, log='%j.log', jobName=None, batchType='slurm', params=None):
     """
     Simplify batch jobs submission for lsf & slurm
@@ -83,6 +181,82 @@ def getNoe(args, facility):
         numJobs = args.noe
     return numJobs
 
+# Batch job monitoring
+
+class FileTail(object):
+    """
+    Hands over what was appended to files since the last read, up to their last complete line.
+    wait() returns as soon as inotify reports a change in the directory of a watched file, and falls
+    back to sleeping for the timeout where inotify is not available. Files written from other nodes of
+    a network file system do not raise inotify events, so the timeout doubles as the polling interval.
+    """
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    def __init__(self, minInterval=0.5):
+        """
+        :param minInterval: minimum time in seconds between two returns of wait()
+        """
+        self.minInterval = minInterval
+        self.offsets = {}
+        self.dirs = set()
+        self.lastWake = 0
+        self.fd = None
+        try:
+            import ctypes, ctypes.util
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0: self.fd = fd
+        except (OSError, AttributeError): # not Linux
+            pass
+
+    def watch(self, fname):
+        """start following fname, which need not exist yet"""
+        self.offsets.setdefault(fname, 0)
+        dirname = os.path.dirname(os.path.abspath(fname))
+        if self.fd is not None and dirname not in self.dirs:
+            mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+            if self.libc.inotify_add_watch(self.fd, dirname.encode(), mask) >= 0:
+                self.dirs.add(dirname)
+
+    def read(self, fname):
+        """
+        :return: bytes appended to fname since the last read, and whether fname shrank and is read again from the start
+        """
+        offset = self.offsets.get(fname, 0)
+        try:
+            size = os.path.getsize(fname)
+        except OSError: # file does not exist yet
+            return b'', False
+        restarted = size < offset
+        if restarted: offset = 0
+        if size == offset: return b'', restarted
+        with open(fname, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+        end = data.rfind(b'\n') + 1 # keep a partly written line for the next read
+        self.offsets[fname] = offset + end
+        return data[:end], restarted
+
+    def wait(self, timeout):
+        """block until a watched directory changes or timeout seconds have passed"""
+        time.sleep(max(0, self.lastWake + self.minInterval - time.time()))
+        if self.fd is None:
+            time.sleep(timeout)
+        elif select.select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 65536): pass # drain the events, files are checked by size
+            except OSError:
+                pass
+        self.lastWake = time.time()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
 # HDF5-related
 
 def reshapeHdf5(h5file, dataset, ind, numAppend):
@@ -97,6 +271,756 @@ def updateHdf5(h5file, dataset, ind, val):
     except:
         h5file[dataset][ind] = 0
 
+class Hdf5WriteBuffer(object):
+    """
+    Write-behind buffer for row-wise hdf5 output.
+    Rows are collected in preallocated numpy arrays and each dataset is written
+    with a single hyperslab write when the buffer is full or flush() is called.
+    :param h5file: open h5py file
+    :param bufferSize: number of rows held in memory before flushing
+    :param start: first row in the file that the buffer writes to
+    """
+    def __init__(self, h5file, bufferSize=64, start=0):
+        self.h5file = h5file
+        self.bufferSize = max(int(bufferSize), 1)
+        self.start = start # file row of the first buffered row
+        self.row = 0 # current row in the buffer
+        self.buffers = {}
+
+    def _getBuffer(self, dataset):
+        if dataset not in self.buffers:
+            dset = self.h5file[dataset]
+            if h5py.check_dtype(vlen=dset.dtype) is not None:
+                buf = np.empty((self.bufferSize,), dtype=object)
+            else:
+                buf = np.zeros((self.bufferSize,) + dset.shape[1:], dtype=dset.dtype)
+            self.buffers[dataset] = buf
+        return self.buffers[dataset]
+
+    def set(self, dataset, val):
+        """Set the value of dataset in the current row"""
+        self._getBuffer(dataset)[self.row] = val
+
+    def setRow(self, dataset, val):
+        """Set the first len(val) elements of dataset in the current row, zero the rest"""
+        buf = self._getBuffer(dataset)
+        n = len(val)
+        buf[self.row, :n] = val
+        buf[self.row, n:] = 0
+
+    def next(self):
+        """Advance to the next row, flushing if the buffer is full"""
+        self.row += 1
+        if self.row == self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows to the file"""
+        if self.row == 0: return
+        for dataset, buf in self.buffers.items():
+            dset = self.h5file[dataset]
+            if dset.shape[0] < self.start + self.row:
+                dset.resize((self.start + self.row,) + dset.shape[1:])
+            if buf.dtype == object: # variable length rows can not be written as one slab
+                for i in range(self.row):
+                    dset[self.start + i] = buf[i]
+            else:
+                dset[self.start:self.start + self.row] = buf[:self.row]
+        self.start += self.row
+        self.row = 0
+
+class Hdf5SharedWriteBuffer(Hdf5WriteBuffer):
+    """
+    Hdf5WriteBuffer for a single file opened by all ranks with driver='mpio'.
+    Opening, resizing and allocating datasets are collective in parallel hdf5, so all datasets
+    are opened up front on every rank and every rank joins every flush(), with or without rows.
+    flush() reserves the rows of each rank with a prefix sum of the number of rows buffered
+    on every rank, so the rows of all ranks are packed back to back, and grows the datasets by
+    exactly those rows.
+    Ranks do not flush in lockstep: a rank whose buffer is full requests a flush through a counter in a
+    one-sided MPI window on rank 0 (see DynamicShare), and every rank joins the requested flushes the next
+    time it calls poll(). Ranks call poll() after every event, and finish() once they are out of events,
+    which keeps joining the flushes of the other ranks until every rank is done.
+    :param h5file: h5py file opened with driver='mpio'
+    :param comm: MPI communicator the file was opened with
+    :param datasets: every dataset rows are written to, fixed length types only
+    :param bufferSize: number of rows held in memory before flushing
+    """
+    def __init__(self, h5file, comm, datasets, bufferSize=64):
+        from mpi4py import MPI
+        super(Hdf5SharedWriteBuffer, self).__init__(h5file, bufferSize=bufferSize, start=0)
+        self.MPI = MPI
+        self.comm = comm
+        self.numRows = 0 # rows written by all ranks
+        self.numFlushes = 0 # collective flushes this rank took part in
+        self.datasets = sorted(datasets) # same order on every rank
+        for dataset in self.datasets:
+            if h5py.check_dtype(vlen=h5file[dataset].dtype) is not None:
+                raise ValueError("variable length dataset {} can not be written in parallel".format(dataset))
+            super(Hdf5SharedWriteBuffer, self)._getBuffer(dataset)
+        # [flushes requested, ranks done]
+        if comm.Get_rank() == 0:
+            self.counter = np.zeros(2, dtype=np.int64)
+            self.win = MPI.Win.Create(self.counter, disp_unit=self.counter.itemsize, comm=comm)
+        else:
+            self.counter = None
+            self.win = MPI.Win.Create(None, comm=comm)
+        self._val = np.zeros(1, dtype=np.int64)
+        self._result = np.zeros(1, dtype=np.int64)
+
+    def _counter(self, index, op, val=0):
+        """Atomically apply op with val to a counter on rank 0, returns its previous value"""
+        self._val[0] = val
+        self.win.Lock(0, self.MPI.LOCK_SHARED)
+        self.win.Fetch_and_op(self._val, self._result, 0, index, op)
+        self.win.Unlock(0)
+        return int(self._result[0])
+
+    def _getBuffer(self, dataset):
+        return self.buffers[dataset] # datasets are opened by every rank in __init__
+
+    def next(self):
+        """Advance to the next row, flushing is left to poll() since it is collective"""
+        self.row += 1
+
+    def poll(self):
+        """Request a flush when the buffer is full and join the flushes requested by any rank"""
+        if self.row >= self.bufferSize:
+            self._counter(0, self.MPI.MAX, self.numFlushes + 1)
+        while self._counter(0, self.MPI.NO_OP) > self.numFlushes:
+            self.flush()
+
+    def finish(self):
+        """Collective: called once this rank is out of events, returns when every rank is"""
+        self._counter(1, self.MPI.SUM, 1)
+        while True:
+            done = self._counter(1, self.MPI.NO_OP) == self.comm.Get_size() # before reading the requests
+            if self._counter(0, self.MPI.NO_OP) > self.numFlushes:
+                self.flush()
+            elif done:
+                break
+            else:
+                time.sleep(0.001)
+        self.win.Free()
+
+    def flush(self):
+        """Collective: write the buffered rows of all ranks to the file"""
+        offset = self.comm.exscan(self.row) # None on rank 0
+        total = self.comm.allreduce(self.row)
+        self.start = self.numRows + (offset or 0)
+        for dataset in self.datasets:
+            dset = self.h5file[dataset]
+            if total > 0:
+                dset.resize((self.numRows + total,) + dset.shape[1:])
+            if self.row > 0:
+                dset[self.start:self.start + self.row] = self.buffers[dataset][:self.row]
+        self.numRows += total
+        self.numFlushes += 1
+        self.start = self.numRows
+        self.row = 0
+
+    def crop(self, datasets):
+        """Collective: crop datasets to the number of rows written by all ranks"""
+        for dataset in datasets:
+            dset = self.h5file[dataset]
+            dset.resize((self.numRows,) + dset.shape[1:])
+
+# Geometry cache
+
+def getCalibHash(det, evt):
+    """sha1 of the calib constants and pixel coordinates of a detector, which masks and geometry derive from"""
+    calibHash = hashlib.sha1()
+    for const in [det.pedestals(evt), det.gain(evt), det.status(evt), det.common_mode(evt), det.coords_x(evt)]:
+        if const is not None: calibHash.update(np.ascontiguousarray(const).tobytes())
+    return calibHash.hexdigest()
+
+class GeometryCache(object):
+    """
+    Per-run detector masks, pixel indexes and coordinates computed once instead of by every rank.
+    Rank 0 computes an array, or loads it from <cacheDir>/<exp>_<det>_<run>_<calib hash>/<name>.npy where an
+    earlier job saved it, and sends it to one rank per node. The ranks of a node then map the same pages of
+    an MPI shared memory window. Without comm the arrays are memory-mapped from cacheDir.
+    Every call is collective when comm is given, so all ranks must request the same arrays in the same order.
+    Returned arrays are read-only.
+    :param cacheDir: directory of the .npy files, None to only share the arrays between ranks
+    :param comm: MPI communicator of the ranks sharing the arrays
+    """
+    def __init__(self, exp, run, detname, det, evt, cacheDir=None, comm=None):
+        self.det = det
+        self.evt = evt
+        self.comm = comm
+        self.arrays = {}
+        self.windows = []
+        key = None
+        if comm is None or comm.Get_rank() == 0:
+            key = exp + '_' + detname + '_' + str(run).zfill(4) + '_' + getCalibHash(det, evt)[:16]
+        if comm is not None:
+            from mpi4py import MPI
+            self.MPI = MPI
+            key = comm.bcast(key, root=0)
+            self.nodeComm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+            self.leaderComm = comm.Split(0 if self.nodeComm.Get_rank() == 0 else MPI.UNDEFINED, comm.Get_rank())
+        self.path = os.path.join(cacheDir, key) if cacheDir else None
+
+    def load(self, name, compute):
+        """array from the cache directory, computed and saved there first if it is not cached yet"""
+        fname = os.path.join(self.path, name + '.npy') if self.path else None
+        if fname is not None and os.path.exists(fname):
+            return np.load(fname, mmap_mode='r')
+        arr = compute()
+        if arr is None: return None
+        arr = np.ascontiguousarray(arr)
+        if fname is not None:
+            if not os.path.exists(self.path): os.makedirs(self.path)
+            tmpName = fname + '.' + str(os.getpid()) + '.tmp.npy' # rename is atomic, readers never see a partial file
+            np.save(tmpName, arr)
+            os.rename(tmpName, fname)
+        return arr
+
+    def get(self, name, compute):
+        """
+        Cached array called name
+        :param compute: function returning the array, only called on rank 0 when it is not cached yet
+        """
+        if name in self.arrays: return self.arrays[name]
+        if self.comm is None:
+            arr = self.load(name, compute)
+            if arr is not None: arr.flags.writeable = False
+            self.arrays[name] = arr
+            return arr
+        arr = None
+        meta = None
+        if self.comm.Get_rank() == 0:
+            arr = self.load(name, compute)
+            if arr is not None: meta = (arr.shape, arr.dtype.str)
+        meta = self.comm.bcast(meta, root=0)
+        if meta is None:
+            self.arrays[name] = None
+            return None
+        shape, dtype = meta
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize if self.nodeComm.Get_rank() == 0 else 0
+        win = self.MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=self.nodeComm)
+        buf, itemsize = win.Shared_query(0)
+        shared = np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+        if self.leaderComm != self.MPI.COMM_NULL:
+            if self.comm.Get_rank() == 0: shared[...] = arr
+            self.leaderComm.Bcast(shared, root=0)
+        self.nodeComm.Barrier()
+        shared.flags.writeable = False
+        self.windows.append(win)
+        self.arrays[name] = shared
+        return shared
+
+    def mask(self, **kwargs):
+        """det.mask with the given flags, e.g. mask(calib=True, status=True)"""
+        name = 'mask_' + '_'.join(key + str(int(bool(val))) for key, val in sorted(kwargs.items()))
+        return self.get(name, lambda: self.det.mask(self.evt, **kwargs))
+
+    def indexes(self):
+        """(iX, iY) int64 pixel indexes of the assembled image, with a segment axis"""
+        def compute(indexes):
+            ind = np.array(indexes(self.evt), dtype=np.int64)
+            return np.expand_dims(ind, axis=0) if len(ind.shape) == 2 else ind
+        return self.get('indexes_x', lambda: compute(self.det.indexes_x)), \
+               self.get('indexes_y', lambda: compute(self.det.indexes_y))
+
+    def pixelCoords(self):
+        """(x, y) pixel coordinates and pixel mask of the geometry, inputs of RadialBkgd"""
+        geo = {}
+        def compute(name):
+            if not geo:
+                geo['geo'] = self.det.geometry(self.evt)
+                geo['coords_x'], geo['coords_y'], _ = geo['geo'].get_pixel_coords()
+            if name == 'pixel_mask': return geo['geo'].get_pixel_mask(mbits=0o0377)
+            return geo[name]
+        return self.get('coords_x', lambda: compute('coords_x')), \
+               self.get('coords_y', lambda: compute('coords_y')), \
+               self.get('pixel_mask', lambda: compute('pixel_mask'))
+
+    def close(self):
+        """Collective: release the shared memory windows and communicators, the arrays must not be used afterwards"""
+        self.arrays = {}
+        if self.comm is None: return
+        for win in self.windows:
+            win.Free()
+        self.windows = []
+        if self.leaderComm != self.MPI.COMM_NULL: self.leaderComm.Free()
+        self.nodeComm.Free()
+
+# Event index
+
+class EventIndex(object):
+    """
+    Per-run timestamp index: event numbers keyed on the packed 64-bit (seconds << 32 | nanoseconds)
+    timestamp, sorted once so lookups are a binary search instead of a scan over the run.
+    :param sec: seconds of every event in run order
+    :param nsec: nanoseconds of every event in run order
+    :param fid: fiducials of every event in run order
+    """
+    def __init__(self, sec, nsec, fid):
+        self.keys = np.asarray(sec, dtype=np.uint64) << np.uint64(32) | np.asarray(nsec, dtype=np.uint64)
+        self.fid = np.asarray(fid, dtype=np.int64)
+        self.order = np.argsort(self.keys, kind='stable')
+        self.sortedKeys = self.keys[self.order]
+        self.fidMap = None
+
+    @classmethod
+    def fromTimes(cls, times):
+        """Builds the index from psana run.times()"""
+        n = len(times)
+        return cls(np.fromiter((t.seconds() for t in times), dtype=np.uint64, count=n),
+                   np.fromiter((t.nanoseconds() for t in times), dtype=np.uint64, count=n),
+                   np.fromiter((t.fiducial() for t in times), dtype=np.int64, count=n))
+
+    def find(self, sec, nsec, fid=None):
+        """Returns the first event number with this timestamp (and fiducial), None if there is none"""
+        key = np.uint64(int(sec) << 32 | int(nsec))
+        lo = np.searchsorted(self.sortedKeys, key, side='left')
+        hi = np.searchsorted(self.sortedKeys, key, side='right')
+        for i in self.order[lo:hi]: # stable sort keeps run order among equal timestamps
+            if fid is None or self.fid[i] == fid:
+                return int(i)
+        return None
+
+    def lastWithFiducial(self, fid):
+        """Returns the last event number with this fiducial, None if there is none"""
+        if self.fidMap is None:
+            self.fidMap = dict(zip(self.fid.tolist(), range(len(self.fid))))
+        return self.fidMap.get(int(fid))
+
+# Image cache
+
+class LruCache(object):
+    """
+    Thread-safe least recently used cache of numpy arrays capped in memory.
+    Values are tuples whose numpy arrays count towards the cap.
+    :param maxMB: memory cap in MB, 0 disables the cache
+    """
+    def __init__(self, maxMB=512):
+        self.maxBytes = int(maxMB * 1024 * 1024)
+        self.nbytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sizeOf(value):
+        return sum(v.nbytes for v in value if isinstance(v, np.ndarray))
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def get(self, key):
+        """Returns the cached value, None on a miss"""
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None: self.items[key] = value # most recently used
+            return value
+
+    def put(self, key, value):
+        size = self.sizeOf(value)
+        if size > self.maxBytes: return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None: self.nbytes -= self.sizeOf(old)
+            self.items[key] = value
+            self.nbytes += size
+            while self.nbytes > self.maxBytes:
+                _, old = self.items.popitem(last=False)
+                self.nbytes -= self.sizeOf(old)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+# Peak cache
+
+class PeakCache(object):
+    """
+    Persistent per-run store of the peaks found in every event.
+    Entries live in a directory named after a hash of key, so a change in anything
+    that goes into the key (run, detector, calib constants, peak finding parameters)
+    starts a new entry. Each save() adds a shard of .npy files (events, number of peaks,
+    concatenated peaks); existing shards are memory-mapped, so get() only reads the
+    peaks of the events asked for.
+    :param cacheDir: directory holding the cache entries
+    :param key: dict of everything that changes the peaks found in an event
+    """
+    def __init__(self, cacheDir, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.path = os.path.join(cacheDir, digest)
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError: # another rank made it
+                pass
+        keyFname = os.path.join(self.path, 'key.json')
+        if not os.path.exists(keyFname):
+            tmpFname = keyFname + '.' + randomString(10)
+            json.dump(key, open(tmpFname, 'w'), sort_keys=True, default=str, indent=1)
+            os.rename(tmpFname, keyFname)
+        self.index = {} # event number -> (peaks, offset, number of peaks)
+        for fname in sorted(os.listdir(self.path)):
+            if not fname.endswith('_events.npy'): continue
+            shard = os.path.join(self.path, fname[:-len('_events.npy')])
+            events = np.load(shard + '_events.npy')
+            counts = np.load(shard + '_counts.npy')
+            peaks = np.load(shard + '_peaks.npy', mmap_mode='r')
+            offsets = np.cumsum(counts) - counts
+            for nevent, offset, count in zip(events, offsets, counts):
+                self.index.setdefault(int(nevent), (peaks, offset, count))
+        self.newEvents = []
+        self.newPeaks = []
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, nevent):
+        return int(nevent) in self.index
+
+    def get(self, nevent):
+        """Returns the peaks of nevent, None if the event is not cached"""
+        entry = self.index.get(int(nevent))
+        if entry is None: return None
+        peaks, offset, count = entry
+        return np.array(peaks[offset:offset+count])
+
+    def put(self, nevent, peaks):
+        """Remember the peaks of nevent until the next save()"""
+        if int(nevent) in self.index: return
+        self.newEvents.append(int(nevent))
+        self.newPeaks.append(np.asarray(peaks))
+
+    def save(self, name):
+        """Write the peaks put since the last save as a new shard
+        :param name: shard name prefix, e.g. rank number
+        """
+        if not self.newEvents: return
+        counts = np.array([len(peaks) for peaks in self.newPeaks], dtype=np.int64)
+        found = [peaks.reshape(len(peaks), -1) for peaks in self.newPeaks if len(peaks) > 0]
+        if found:
+            peaks = np.concatenate(found)
+        else:
+            peaks = np.zeros((0, 1), dtype=np.float32)
+        shard = os.path.join(self.path, str(name) + '_' + randomString(10))
+        # events are written last, so readers never see an incomplete shard
+        for suffix, arr in [('_peaks.npy', peaks), ('_counts.npy', counts),
+                            ('_events.npy', np.array(self.newEvents, dtype=np.int64))]:
+            with open(shard + suffix + '.tmp', 'wb') as f:
+                np.save(f, arr)
+            os.rename(shard + suffix + '.tmp', shard + suffix)
+        peaks = np.load(shard + '_peaks.npy', mmap_mode='r')
+        for nevent, offset, count in zip(self.newEvents, np.cumsum(counts) - counts, counts):
+            self.index.setdefault(nevent, (peaks, offset, count))
+        self.newEvents = []
+        self.newPeaks = []
+
+# CrystFEL stream
+
+class StreamIndex(object):
+    """
+    Index of the chunks of a CrystFEL stream built in a single pass and saved next to the stream as
+    <stream>.idx.npy, which is memory-mapped and reused until the stream changes. When the index can not be
+    saved (e.g. read-only directory) it is kept in memory only. Chunks that are still being written are left out. Cell parameters and reflection count are those of the first crystal.
+    :param fname: stream file
+    :param rebuild: ignore an existing index
+    """
+    dtype = np.dtype([('offset', np.int64), ('length', np.int64), ('event', np.int64), ('indexed', np.bool_),
+                      ('cell', np.float32, (6,)), ('numReflections', np.int32),
+                      ('latticeType', 'S12'), ('centering', 'S1'), ('uniqueAxis', 'S1')])
+    beginChunk = b'----- Begin chunk -----'
+    endChunk = b'----- End chunk -----'
+
+    def __init__(self, fname, rebuild=False):
+        self.fname = fname
+        self.indexName = fname + '.idx.npy'
+        if not rebuild and os.path.exists(self.indexName) and \
+           os.path.getmtime(self.indexName) >= os.path.getmtime(fname):
+            self.entries = np.load(self.indexName, mmap_mode='r')
+        else:
+            self.entries = self.build()
+            self.save(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self, entries):
+        try:
+            with open(self.indexName + '.tmp', 'wb') as f:
+                np.save(f, entries)
+            os.rename(self.indexName + '.tmp', self.indexName)
+        except (IOError, OSError): # the in-memory index is still valid
+            print("Couldn't save stream index: ", self.indexName)
+            try:
+                os.remove(self.indexName + '.tmp') # partially written
+            except (IOError, OSError):
+                pass
+
+    @staticmethod
+    def getValue(mm, key, start, end):
+        """bytes following key up to the end of its line, None if key is not in mm[start:end]"""
+        i = mm.find(key, start, end)
+        if i < 0: return None
+        j = mm.find(b'\n', i, end)
+        return mm[i + len(key):j if j >= 0 else end].strip()
+
+    def parseChunk(self, mm, start, end):
+        entry = np.zeros((), dtype=self.dtype)
+        entry['offset'] = start
+        entry['length'] = end - start
+        event = self.getValue(mm, b'Event:', start, end)
+        try:
+            entry['event'] = int(event.split(b'//')[-1])
+        except (AttributeError, ValueError):
+            entry['event'] = -1
+        indexedBy = self.getValue(mm, b'indexed_by =', start, end)
+        entry['indexed'] = indexedBy is not None and b'none' not in indexedBy
+        cell = self.getValue(mm, b'Cell parameters', start, end)
+        if cell is not None: # a b c nm, al be ga deg
+            a, b, c, _, al, be, ga, _ = cell.split()
+            entry['cell'] = (float(a) * 10, float(b) * 10, float(c) * 10, float(al), float(be), float(ga)) # Angstrom
+            entry['latticeType'] = self.getValue(mm, b'lattice_type =', start, end) or b''
+            entry['centering'] = self.getValue(mm, b'centering =', start, end) or b''
+            entry['uniqueAxis'] = self.getValue(mm, b'unique_axis =', start, end) or b''
+            numReflections = self.getValue(mm, b'num_reflections =', start, end)
+            if numReflections is not None: entry['numReflections'] = int(numReflections)
+        return entry
+
+    def build(self):
+        entries = []
+        with open(self.fname, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0: return np.zeros(0, dtype=self.dtype)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = mm.find(self.beginChunk)
+                while start >= 0:
+                    end = mm.find(self.endChunk, start)
+                    if end < 0: break # chunk still being written
+                    end = mm.find(b'\n', end)
+                    end = len(mm) if end < 0 else end + 1
+                    entries.append(self.parseChunk(mm, start, end))
+                    start = mm.find(self.beginChunk, end)
+            finally:
+                mm.close()
+        return np.array(entries, dtype=self.dtype)
+
+    def getChunk(self, i):
+        """text of the i-th chunk"""
+        with open(self.fname, 'rb') as f:
+            f.seek(int(self.entries['offset'][i]))
+            return f.read(int(self.entries['length'][i])).decode()
+
+    def getHeader(self):
+        """text preceding the first chunk, which holds the geometry"""
+        size = int(self.entries['offset'][0]) if len(self) else os.path.getsize(self.fname)
+        with open(self.fname, 'rb') as f:
+            return f.read(size).decode()
+
+    def numIndexed(self):
+        return int(np.count_nonzero(self.entries['indexed']))
+
+    def indexingRate(self):
+        """percentage of the processed events that were indexed"""
+        return self.numIndexed() * 100. / len(self) if len(self) else 0.
+
+    def getCells(self):
+        """(a, b, c, al, be, ga) in Angstrom and degrees of every indexed event"""
+        return np.asarray(self.entries['cell'][self.entries['indexed']], dtype=np.float64)
+
+def mergeStreams(fnames, outFname):
+    """
+    Concatenate stream files into outFname, its index is assembled from the indexes of the inputs.
+    Missing inputs are skipped.
+    :return: StreamIndex of outFname
+    """
+    entries = []
+    offset = 0
+    with open(outFname, 'wb') as outfile:
+        for fname in fnames:
+            try:
+                myIndex = StreamIndex(fname)
+                with open(fname, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile)
+                    size = infile.tell()
+            except (IOError, OSError): # file may not exist yet
+                print("Couldn't open: ", fname)
+                continue
+            myEntries = np.array(myIndex.entries)
+            myEntries['offset'] += offset
+            entries.append(myEntries)
+            offset += size
+    outIndex = StreamIndex.__new__(StreamIndex)
+    outIndex.fname = outFname
+    outIndex.indexName = outFname + '.idx.npy'
+    outIndex.entries = np.concatenate(entries) if entries else np.zeros(0, dtype=StreamIndex.dtype)
+    outIndex.save(outIndex.entries)
+    return outIndex
+
+class StreamProgress(object):
+    """
+    Running number of processed and indexed events of growing stream files, counted from the
+    Begin crystal and End chunk markers of the bytes appended to them (see FileTail.read)
+    """
+    markers = re.compile(b'--- Begin crystal|----- End chunk -----')
+
+    def __init__(self):
+        self.counts = {} # fname: [numIndexed, numProcessed, current chunk has a crystal]
+
+    def update(self, fname, data, restarted=False):
+        """:return: True if the counts changed"""
+        if restarted or fname not in self.counts:
+            self.counts[fname] = [0, 0, False]
+        count = self.counts[fname]
+        before = count[:2]
+        for m in self.markers.finditer(data):
+            if m.group(0).startswith(b'----- End'):
+                count[0] += count[2]
+                count[1] += 1
+                count[2] = False
+            else:
+                count[2] = True
+        return count[:2] != before or restarted
+
+    def numIndexed(self):
+        return sum(count[0] for count in self.counts.values())
+
+    def numProcessed(self):
+        return sum(count[1] for count in self.counts.values())
+
+# Powder statistics
+
+def mergeStats(inbuf, inoutbuf, datatype):
+    """MPI reduction op: merge two packed PowderStats buffers into inoutbuf with Chan's pairwise update"""
+    from mpi4py import MPI
+    dtype = np.float32 if datatype.decode()[0] == MPI.FLOAT else np.float64
+    a = np.frombuffer(inbuf, dtype=dtype)
+    b = np.frombuffer(inoutbuf, dtype=dtype)
+    na, nb = a[0], b[0]
+    if na == 0: return
+    if nb == 0:
+        b[:] = a
+        return
+    size = (len(b) - 1) // 4
+    meanA, m2A, maxA, minA = [a[1+i*size:1+(i+1)*size] for i in range(4)]
+    meanB, m2B, maxB, minB = [b[1+i*size:1+(i+1)*size] for i in range(4)]
+    n = na + nb
+    delta = meanA - meanB
+    m2B += m2A + delta * delta * (na * nb / n)
+    meanB += delta * (na / n)
+    np.maximum(maxB, maxA, out=maxB)
+    np.minimum(minB, minA, out=minB)
+    b[0] = n
+
+class PowderStats(object):
+    """
+    Per-pixel count, mean, M2 (sum of squared deviations from the mean), max and min. Events are added with
+    Welford's update and ranks are merged pairwise with Chan's formula, which unlike sum of squares minus
+    mean squared does not lose the variance to cancellation on bright pixels. All statistics live in one
+    packed buffer [count, mean, M2, max, min] so that a single Reduce with mergeStats combines them.
+    :param dtype: np.float64, or np.float32 for half the memory at single precision
+    """
+    statsOp = None
+
+    def __init__(self, dtype=np.float64):
+        self.buf = None
+        self.dtype = dtype
+        self.shape = None
+        self.nevent = 0
+
+    def allocate(self, shape):
+        self.shape = shape
+        size = int(np.prod(shape))
+        self.buf = np.zeros(1 + 4 * size, dtype=self.dtype)
+        self.count = self.buf[:1]
+        self.mean, self.m2, self.maximum, self.minimum = [self.buf[1+i*size:1+(i+1)*size].reshape(shape) for i in range(4)]
+        self.maximum[...] = -np.inf
+        self.minimum[...] = np.inf
+        self.delta = np.empty(shape, dtype=self.dtype) # scratch
+
+    def update(self, detarr):
+        if self.buf is None: self.allocate(detarr.shape)
+        self.count += 1
+        n = float(self.count[0])
+        # mean += delta / n and M2 += delta**2 * (n-1) / n with a single scratch array
+        np.subtract(detarr, self.mean, out=self.delta)
+        self.delta *= 1. / n
+        self.mean += self.delta
+        self.delta *= self.delta
+        self.delta *= n * (n - 1)
+        self.m2 += self.delta
+        np.maximum(self.maximum, detarr, out=self.maximum)
+        np.minimum(self.minimum, detarr, out=self.minimum)
+        self.nevent += 1
+
+    def reduce(self, comm, root=0):
+        """
+        Collective: merge the statistics of all ranks into root, which then holds totevent and stddev.
+        Ranks without events take part with an empty buffer.
+        :return: False on every rank when no rank has an event, True otherwise
+        """
+        from mpi4py import MPI
+        shapes = [s for s in comm.allgather(self.shape) if s is not None]
+        if not shapes: return False
+        if self.buf is None: self.allocate(shapes[0])
+        if PowderStats.statsOp is None: PowderStats.statsOp = MPI.Op.Create(mergeStats, commute=True)
+        # one contiguous element, so that MPI cannot split the packed buffer into segments
+        mpiType = (MPI.FLOAT if self.dtype == np.float32 else MPI.DOUBLE).Create_contiguous(len(self.buf)).Commit()
+        if comm.Get_rank() == root:
+            comm.Reduce(MPI.IN_PLACE, [self.buf, 1, mpiType], op=PowderStats.statsOp, root=root)
+            self.totevent = int(self.count[0])
+            self.stddev = np.sqrt(self.m2 / max(self.totevent, 1))
+        else:
+            comm.Reduce([self.buf, 1, mpiType], None, op=PowderStats.statsOp, root=root)
+        mpiType.Free()
+        return True
+
+# Peak likelihood
+
+def calculateLikelihood(qPeaks, cutoff=10.):
+    """
+    Likelihood that an event is a crystal. Every peak is mirrored through each of its closest neighbours
+    and the peaks near the mirrored position are counted with a gaussian weight whose width is a quarter
+    of the neighbour distance. A KD-tree replaces the all-pairs distance matrix.
+    :param qPeaks: q-vectors of the peaks, shape (3, nPeaks)
+    :param cutoff: peaks further than cutoff gaussian widths from a mirrored position are not counted
+    :return: [median closest neighbour distance, pairs found per spot]
+    """
+    coords = np.ascontiguousarray(np.transpose(qPeaks), dtype=np.float64)
+    nPeaks = coords.shape[0]
+    tree = cKDTree(coords)
+    dist, _ = tree.query(coords, k=2)
+    # every neighbour at the closest distance: candidates within a hair of the tree distance,
+    # ties are then decided on euclidean distances computed like the all-pairs matrix
+    near = tree.query_ball_point(coords, r=dist[:, 1] * (1 + 1e-9))
+    numNear = np.fromiter(map(len, near), dtype=np.int64, count=nPeaks)
+    peak = np.repeat(np.arange(nPeaks), numNear)
+    neighbour = np.concatenate(near).astype(np.int64)
+    other = neighbour != peak
+    peak, neighbour = peak[other], neighbour[other]
+    d = np.sqrt(np.sum((coords[peak] - coords[neighbour]) ** 2, axis=1))
+    closestNeighborDist = np.full(nPeaks, np.inf)
+    np.minimum.at(closestNeighborDist, peak, d)
+    meanClosestNeighborDist = np.median(closestNeighborDist)
+    # (peak, closest neighbour) pairs, including ties
+    tie = d == closestNeighborDist[peak]
+    peak, neighbour = peak[tie], neighbour[tie]
+    flip = 2 * coords[peak] - coords[neighbour]
+    sigma = closestNeighborDist[peak] / 4.
+    found = tree.query_ball_point(flip, r=cutoff * sigma)
+    numFound = np.fromiter(map(len, found), dtype=np.int64, count=len(found))
+    pair = np.repeat(np.arange(len(found)), numFound)
+    if len(pair):
+        match = np.concatenate(found).astype(np.int64)
+        d2 = np.sum((coords[match] - flip[pair]) ** 2, axis=1)
+        pairsFound = np.sum(np.exp(-d2 / (2. * sigma[pair] ** 2)))
+    else:
+        pairsFound = 0.
+    pairsFound = pairsFound / 2.
+    pairsFoundPerSpot = pairsFound / float(nPeaks)
+    return [meanClosestNeighborDist, pairsFoundPerSpot]
+
 # Upsampling
 @jit(nopython=True)
 def upsample(warr, dim, binr, binc):
@@ -5,8 +5,10 @@ import psana
 import time
 import argparse
 import os, json, sys
+import threading, queue
 
 import psanaWhisperer
+from psocake.utils import Hdf5WriteBuffer
 
 from mpi4py import MPI
 
@@ -37,6 +39,8 @@ parser.add_argument("--mode",help="type of experiment (e.g. sfx, spi)",default='
 parser.add_argument("--saveADU", help="Save assembled images in ADU.", action='store_true')
 parser.add_argument("--savePhot", help="Save assembled images in photons.", action='store_true')
 parser.add_argument("--tag",help="cxi file tag",default="", type=str)
+parser.add_argument("--prefetch",help="number of hits fetched and calibrated ahead of writing",default=4, type=int)
+parser.add_argument("--flushEvery",help="number of hits buffered before scalars are written to the cxi file",default=100, type=int)
 args = parser.parse_args()
 
 def writeStatus(fname,d):
@@ -54,6 +58,64 @@ def getMyUnfairShare(numJobs, numWorkers, rank):
     except:
         return None
 
+class EpicsCache(object):
+    """
+    Epics values re-queried only when the time stamp of the PV changes.
+    Missing PVs are remembered and return 0 without querying the store again.
+    """
+    def __init__(self, es):
+        self.es = es
+        self.cache = {}
+
+    def value(self, name):
+        cached = self.cache.get(name)
+        if cached is not None and cached[0] is None: return cached[1] # missing PV
+        try:
+            pv = self.es.getPV(name)
+        except:
+            pv = None
+        if pv is None:
+            self.cache[name] = (None, 0)
+            return 0
+        try:
+            stamp = pv.stamp()
+            key = (stamp.sec(), stamp.nsec())
+        except:
+            key = False # no time stamp, always re-query
+        if cached is not None and key and cached[0] == key: return cached[1]
+        try:
+            val = self.es.value(name)
+            if val is None: val = 0
+        except:
+            val = 0
+        self.cache[name] = (key, val)
+        return val
+
+# (name, epics PV) of the LCLS scalars saved for every hit
+lclsEpics = [('electronBeamEnergy', 'BEND:DMP1:400:BDES'),
+             ('beamRepRate', 'EVNT:SYS0:1:LCLSBEAMRATE'),
+             ('particleN_electrons', 'BPMS:DMP1:199:TMIT1H'),
+             ('eVernier', 'SIOC:SYS0:ML00:AO289'),
+             ('charge', 'BEAM:LCLS:ELEC:Q'),
+             ('peakCurrentAfterSecondBunchCompressor', 'SIOC:SYS0:ML00:AO195'),
+             ('pulseLength', 'SIOC:SYS0:ML00:AO820'),
+             ('ebeamEnergyLossConvertedToPhoton_mJ', 'SIOC:SYS0:ML00:AO569'),
+             ('calculatedNumberOfPhotons', 'SIOC:SYS0:ML00:AO580'),
+             ('photonBeamEnergy', 'SIOC:SYS0:ML00:AO541'),
+             ('wavelength', 'SIOC:SYS0:ML00:AO192')]
+# (name, dataset) where the LCLS scalars are saved
+lclsDatasets = [('electronBeamEnergy', "LCLS/detector_1/electronBeamEnergy"),
+                ('beamRepRate', "LCLS/detector_1/beamRepRate"),
+                ('particleN_electrons', "LCLS/detector_1/particleN_electrons"),
+                ('eVernier', "LCLS/eVernier"),
+                ('charge', "LCLS/charge"),
+                ('peakCurrentAfterSecondBunchCompressor', "LCLS/peakCurrentAfterSecondBunchCompressor"),
+                ('pulseLength', "LCLS/pulseLength"),
+                ('ebeamEnergyLossConvertedToPhoton_mJ', "LCLS/ebeamEnergyLossConvertedToPhoton_mJ"),
+                ('calculatedNumberOfPhotons', "LCLS/calculatedNumberOfPhotons"),
+                ('photonBeamEnergy', "LCLS/photonBeamEnergy"),
+                ('wavelength', "LCLS/wavelength")]
+
 # Set up variable
 experimentName = args.exp
 runNumber = args.run
@@ -417,39 +479,10 @@ myJobs = getMyUnfairShare(numHits,size,rank)
 
 myHitInd = hitInd[myJobs]
 
-ds_expId = f.require_dataset("entry_1/experimental_identifier",(numHits,),dtype=int)
-ds_photonEnergy_1 = f.require_dataset("LCLS/photon_energy_eV", (numHits,), dtype=float)
-ds_photonEnergy = f.require_dataset("entry_1/instrument_1/source_1/energy", (numHits,), dtype=float)
-ds_pulseEnergy = f.require_dataset("entry_1/instrument_1/source_1/pulse_energy", (numHits,), dtype=float)
-ds_pulseWidth = f.require_dataset("entry_1/instrument_1/source_1/pulse_width", (numHits,), dtype=float)
-ds_dist_1 = f.require_dataset("entry_1/instrument_1/detector_1/distance", (numHits,), dtype=float) # in meters
-ds_x_pixel_size_1 = f.require_dataset("entry_1/instrument_1/detector_1/x_pixel_size", (numHits,), dtype=float)
-ds_y_pixel_size_1 = f.require_dataset("entry_1/instrument_1/detector_1/y_pixel_size", (numHits,), dtype=float)
-ds_lclsDet_1 = f.require_dataset("LCLS/detector_1/EncoderValue",(numHits,), dtype=float)
-ds_ebeamCharge_1 = f.require_dataset("LCLS/detector_1/electronBeamEnergy",(numHits,), dtype=float)
-ds_beamRepRate_1 = f.require_dataset("LCLS/detector_1/beamRepRate",(numHits,), dtype=float)
-ds_particleN_electrons_1 = f.require_dataset("LCLS/detector_1/particleN_electrons",(numHits,), dtype=float)
-ds_eVernier_1 = f.require_dataset("LCLS/eVernier",(numHits,), dtype=float)
-ds_charge_1 = f.require_dataset("LCLS/charge",(numHits,), dtype=float)
-ds_peakCurrentAfterSecondBunchCompressor_1 = f.require_dataset("LCLS/peakCurrentAfterSecondBunchCompressor",(numHits,), dtype=float)
-ds_pulseLength_1 = f.require_dataset("LCLS/pulseLength",(numHits,), dtype=float)
-ds_ebeamEnergyLossConvertedToPhoton_mJ_1 = f.require_dataset("LCLS/ebeamEnergyLossConvertedToPhoton_mJ",(numHits,), dtype=float)
-ds_calculatedNumberOfPhotons_1 = f.require_dataset("LCLS/calculatedNumberOfPhotons",(numHits,), dtype=float)
-ds_photonBeamEnergy_1 = f.require_dataset("LCLS/photonBeamEnergy",(numHits,), dtype=float)
-ds_wavelength_1 = f.require_dataset("LCLS/wavelength",(numHits,), dtype=float)
-ds_wavelengthA_1 = f.require_dataset("LCLS/photon_wavelength_A",(numHits,), dtype=float)
-ds_sec_1 = f.require_dataset("LCLS/machineTime",(numHits,),dtype=int)
-ds_nsec_1 = f.require_dataset("LCLS/machineTimeNanoSeconds",(numHits,),dtype=int)
-ds_fid_1 = f.require_dataset("LCLS/fiducial",(numHits,),dtype=int)
-ds_evtNum_1 = f.require_dataset("LCLS/eventNumber",(numHits,),dtype=int)
+# Images are written straight through, the other datasets through hitBuffer
 if mode == 'sfx':
     dset_1 = f.require_dataset("entry_1/instrument_1/detector_1/data", (numHits, dim0, dim1),
                                dtype=np.float32)  # ,chunks=(1,dim0,dim1))
-    ds_nPeaks = f.require_dataset("/entry_1/result_1/nPeaks", (numHits,), dtype=int)
-    ds_posX = f.require_dataset("/entry_1/result_1/peakXPosRaw", (numHits,2048), dtype='float32')#, chunks=(1,2048))
-    ds_posY = f.require_dataset("/entry_1/result_1/peakYPosRaw", (numHits,2048), dtype='float32')#, chunks=(1,2048))
-    ds_atot = f.require_dataset("/entry_1/result_1/peakTotalIntensity", (numHits,2048), dtype='float32')#, chunks=(1,2048))
-    ds_maxRes = f.require_dataset("/entry_1/result_1/maxRes", (numHits,), dtype=int)
 elif mode == 'spi':
     if args.saveADU:
         dset_1 = f.require_dataset("entry_1/instrument_1/detector_1/data", (numHits, dim0, dim1),
@@ -457,7 +490,6 @@ elif mode == 'spi':
     if args.savePhot:
         dset_2 = f.require_dataset("entry_1/instrument_1/detector_1/photons", (numHits, dim0, dim1),
                                    dtype=int)
-    ds_nHits = f.require_dataset("/entry_1/result_1/nHits", (numHits,), dtype=int)
 
 if rank == 0:
     try:
@@ -466,166 +498,119 @@ if rank == 0:
     except:
         pass
 
-es = ps.ds.env().epicsStore()
+hitBuffer = Hdf5WriteBuffer(f, bufferSize=args.flushEvery, start=myJobs[0])
 
-for i,val in enumerate(myHitInd):
-    t0 = time.time()
+def readHits(hitQueue):
+    """Reader thread: fetch, calibrate and query the epics/ebeam values of my hits in order"""
+    try:
+        ebeamDet = psana.Detector('EBeam')
+        epics = EpicsCache(ps.ds.env().epicsStore())
+        for val in myHitInd:
+            ps.getEvent(val)
+            hit = {'val': val}
+            # Image in cheetah format
+            if mode == 'sfx' and 'cspad' in ps.detInfo.lower():
+                hit['img'] = ps.getCheetahImg()
+                assert(hit['img'] is not None)
+            elif mode == 'sfx' and 'rayonix' in ps.detInfo.lower():
+                img = ps.getCalibImg()
+                assert(img is not None)
+                hit['img'] = img[0,:,:]
+            elif mode == 'spi':
+                if backgroundThreshMax > -1:
+                    ind = abs(missInd - val)
+                    backgroundEvent = missInd[np.argmin(ind)]
+                    if args.saveADU: hit['img'] = ps.getCleanAssembledImg(backgroundEvent)
+                    if args.savePhot: hit['phot'] = ps.getCleanAssembledPhotons(backgroundEvent)
+                else:
+                    if args.saveADU: hit['img'] = ps.getAssembledImg()
+                    if args.savePhot: hit['phot'] = ps.getAssembledPhotons()
+
+            # Epics values must be read before the next event is fetched
+            hit['pulseWidth'] = epics.value('SIOC:SYS0:ML00:AO820') * 1e-15 # s
+            if "cxi" in args.exp or "xpp" in args.exp:
+                hit['EncoderValue'] = epics.value(args.clen) # mm
+            else:
+                hit['EncoderValue'] = 0 # FIXME: mfx
+            for name, pv in lclsEpics:
+                hit[name] = epics.value(pv)
+
+            ebeam = ebeamDet.get(ps.evt)
+            try:
+                hit['energy'] = ebeam.ebeamPhotonEnergy()
+            except:
+                hit['energy'] = 0
+            try:
+                hit['photonEnergy'] = ebeam.ebeamPhotonEnergy() * 1.60218e-19 # J
+                hit['pulseEnergy'] = ebeam.ebeamL3Energy() # MeV
+            except:
+                hit['photonEnergy'] = 0
+                hit['pulseEnergy'] = 0
+                wavelengthA = hit['wavelength'] * 10.
+                if wavelengthA > 0:
+                    h = 6.626070e-34  # J.m
+                    c = 2.99792458e8  # m/s
+                    joulesPerEv = 1.602176621e-19  # J/eV
+                    hit['photonEnergy'] = (h / joulesPerEv * c) / (wavelengthA * 1e-9)
+
+            evtId = ps.evt.get(psana.EventId)
+            hit['sec'] = evtId.time()[0]
+            hit['nsec'] = evtId.time()[1]
+            hit['fid'] = evtId.fiducials()
+            hitQueue.put(hit)
+    except Exception as e:
+        hitQueue.put(e)
+        return
+    hitQueue.put(None)
+
+# Event fetching and calibration of the next hits overlaps with writing the current hit
+hitQueue = queue.Queue(maxsize=max(args.prefetch, 1))
+reader = threading.Thread(target=readHits, args=(hitQueue,))
+reader.daemon = True
+reader.start()
+
+i = 0
+while True:
+    hit = hitQueue.get()
+    if hit is None: break
+    if isinstance(hit, Exception): raise hit
+    val = hit['val']
     globalInd = myJobs[0]+i
-    ds_expId[globalInd] = val
-    ps.getEvent(val)
-    t1 = time.time()
-
-    ebeamDet = psana.Detector('EBeam')
-    t2 = time.time()
-    # Write image in cheetah format
-    if mode == 'sfx' and 'cspad' in ps.detInfo.lower():
-        img = ps.getCheetahImg()
-        assert(img is not None)
-        dset_1[globalInd,:,:] = img
-    elif mode == 'sfx' and 'rayonix' in ps.detInfo.lower():
-        img = ps.getCalibImg()
-        assert(img is not None)
-        dset_1[globalInd,:,:] = img[0,:,:]
-    elif mode == 'spi':
-        if backgroundThreshMax > -1:
-            ind = abs(missInd - val)
-            backgroundEvent = missInd[np.argmin(ind)]
-            if args.saveADU: img = ps.getCleanAssembledImg(backgroundEvent)
-            if args.savePhot: phot = ps.getCleanAssembledPhotons(backgroundEvent)
-        else:
-            if args.saveADU:
-                dset_1[globalInd, :, :] = ps.getAssembledImg()
-            if args.savePhot:
-                dset_2[globalInd, :, :] = ps.getAssembledPhotons()
-    t3 = time.time()
 
-    try:
-        pulseLength = es.value('SIOC:SYS0:ML00:AO820')*1e-15 # s
-        numPhotons = es.value('SIOC:SYS0:ML00:AO580')*1e12 # number of photons
-    except:
-        pulseLength = 0
-        numPhotons = 0
+    # Images are written straight through, scalars are buffered and written in bulk
+    if 'img' in hit: dset_1[globalInd,:,:] = hit['img']
+    if 'phot' in hit: dset_2[globalInd,:,:] = hit['phot']
 
-    ds_pulseWidth[globalInd] = pulseLength
-    ds_dist_1[globalInd] = detectorDistance
-    ds_x_pixel_size_1[globalInd] = x_pixel_size
-    ds_y_pixel_size_1[globalInd] = y_pixel_size
-    #f.flush()
-    t4 = time.time()
+    hitBuffer.set("entry_1/experimental_identifier", val)
+    hitBuffer.set("entry_1/instrument_1/source_1/pulse_width", hit['pulseWidth'])
+    hitBuffer.set("entry_1/instrument_1/detector_1/distance", detectorDistance)
+    hitBuffer.set("entry_1/instrument_1/detector_1/x_pixel_size", x_pixel_size)
+    hitBuffer.set("entry_1/instrument_1/detector_1/y_pixel_size", y_pixel_size)
 
     # LCLS
-    if "cxi" in args.exp:
-        ds_lclsDet_1[globalInd] = es.value(args.clen) # mm
-    elif "mfx" in args.exp:
-        ds_lclsDet_1[globalInd] = 0 # FIXME
-    elif "xpp" in args.exp:
-        ds_lclsDet_1[globalInd] = es.value(args.clen)  # mm
-
-    try:
-        ds_ebeamCharge_1[globalInd] = es.value('BEND:DMP1:400:BDES')
-    except:
-        ds_ebeamCharge_1[globalInd] = 0
-
-    try:
-        ds_beamRepRate_1[globalInd] = es.value('EVNT:SYS0:1:LCLSBEAMRATE')
-    except:
-        ds_beamRepRate_1[globalInd] = 0
-
-    try:
-        ds_particleN_electrons_1[globalInd] = es.value('BPMS:DMP1:199:TMIT1H')
-    except:
-        ds_particleN_electrons_1[globalInd] = 0
-
-    try:
-        ds_eVernier_1[globalInd] = es.value('SIOC:SYS0:ML00:AO289')
-    except:
-        ds_eVernier_1[globalInd] = 0
-
-    try:
-        ds_charge_1[globalInd] = es.value('BEAM:LCLS:ELEC:Q')
-    except:
-        ds_charge_1[globalInd] = 0
-
-    try:
-        ds_peakCurrentAfterSecondBunchCompressor_1[globalInd] = es.value('SIOC:SYS0:ML00:AO195')
-    except:
-        ds_peakCurrentAfterSecondBunchCompressor_1[globalInd] = 0
-
-    try:
-        ds_pulseLength_1[globalInd] = es.value('SIOC:SYS0:ML00:AO820')
-    except:
-        ds_pulseLength_1[globalInd] = 0
-
-    try:
-        ds_ebeamEnergyLossConvertedToPhoton_mJ_1[globalInd] = es.value('SIOC:SYS0:ML00:AO569')
-    except:
-        ds_ebeamEnergyLossConvertedToPhoton_mJ_1[globalInd] = 0
-
-    try:
-        ds_calculatedNumberOfPhotons_1[globalInd] = es.value('SIOC:SYS0:ML00:AO580')
-    except:
-        ds_calculatedNumberOfPhotons_1[globalInd] = 0
-
-    try:
-        ds_photonBeamEnergy_1[globalInd] = es.value('SIOC:SYS0:ML00:AO541')
-    except:
-        ds_photonBeamEnergy_1[globalInd] = 0
-
-    try:
-        ds_wavelength_1[globalInd] = es.value('SIOC:SYS0:ML00:AO192')
-    except:
-        ds_wavelength_1[globalInd] = 0
-
-    try:
-        ds_wavelengthA_1[globalInd] = ds_wavelength_1[globalInd] * 10.
-    except:
-        ds_wavelengthA_1[globalInd] = 0
-    t5 = time.time()
-
-    ebeam = ebeamDet.get(ps.evt)  #ebeam = ps.evt.get(psana.Bld.BldDataEBeamV7, psana.Source('BldInfo(EBeam)'))
-    try:
-        ds_photonEnergy[globalInd] = ebeam.ebeamPhotonEnergy()
-    except:
-        ds_photonEnergy[globalInd] = 0
-    try:
-        photonEnergy = ebeam.ebeamPhotonEnergy() * 1.60218e-19 # J
-        pulseEnergy = ebeam.ebeamL3Energy() # MeV
-    except:
-        photonEnergy = 0
-        pulseEnergy = 0
-        if ds_wavelengthA_1[globalInd] > 0:
-            h = 6.626070e-34  # J.m
-            c = 2.99792458e8  # m/s
-            joulesPerEv = 1.602176621e-19  # J/eV
-            photonEnergy = (h / joulesPerEv * c) / (ds_wavelengthA_1[globalInd] * 1e-9)
-    ds_photonEnergy_1[globalInd] = photonEnergy
-    ds_pulseEnergy[globalInd] = pulseEnergy
-
-    #f.flush()
-    t6 = time.time()
-
-    evtId = ps.evt.get(psana.EventId)
-    sec = evtId.time()[0]
-    nsec = evtId.time()[1]
-    fid = evtId.fiducials()
-
-    ds_sec_1[globalInd] = sec
-    ds_nsec_1[globalInd] = nsec
-    ds_fid_1[globalInd] = fid
-    ds_evtNum_1[globalInd] = val
-    t7 = time.time()
+    hitBuffer.set("LCLS/detector_1/EncoderValue", hit['EncoderValue'])
+    for name, dset in lclsDatasets:
+        hitBuffer.set(dset, hit[name])
+    hitBuffer.set("LCLS/photon_wavelength_A", hit['wavelength'] * 10.)
+    hitBuffer.set("entry_1/instrument_1/source_1/energy", hit['energy'])
+    hitBuffer.set("LCLS/photon_energy_eV", hit['photonEnergy'])
+    hitBuffer.set("entry_1/instrument_1/source_1/pulse_energy", hit['pulseEnergy'])
+
+    hitBuffer.set("LCLS/machineTime", hit['sec'])
+    hitBuffer.set("LCLS/machineTimeNanoSeconds", hit['nsec'])
+    hitBuffer.set("LCLS/fiducial", hit['fid'])
+    hitBuffer.set("LCLS/eventNumber", val)
 
     if mode == 'sfx':
-        ds_nPeaks[globalInd] = nPeaks[val]
-        ds_posX[globalInd,:] = posX[val,:]
-        ds_posY[globalInd,:] = posY[val,:]
-        ds_atot[globalInd,:] = atot[val,:]
-        ds_maxRes[globalInd] = maxRes[val]
+        hitBuffer.set("/entry_1/result_1/nPeaks", nPeaks[val])
+        hitBuffer.set("/entry_1/result_1/peakXPosRaw", posX[val,:])
+        hitBuffer.set("/entry_1/result_1/peakYPosRaw", posY[val,:])
+        hitBuffer.set("/entry_1/result_1/peakTotalIntensity", atot[val,:])
+        hitBuffer.set("/entry_1/result_1/maxRes", maxRes[val])
     elif mode == 'spi':
-        ds_nHits[globalInd] = nHits[val]
-    t8 = time.time()
-    #f.flush()
-    t9 = time.time()
+        hitBuffer.set("/entry_1/result_1/nHits", nHits[val])
+    hitBuffer.next()
+
     if i%100 == 0: print("Rank: "+str(rank)+", Done "+str(i)+" out of "+str(len(myJobs)))
 
     if rank == 0 and i%10 == 0:
@@ -636,8 +621,8 @@ for i,val in enumerate(myHitInd):
             writeStatus(statusFname, d)
         except:
             pass
-    #t10 = time.time()
-    #print "hit convert: ", rank, t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5, t7-t6, t8-t7, t9-t8, t10-t9
+    i += 1
+hitBuffer.flush()
 f.close()
 print("DONE: ", comm.rank)
 
@@ -0,0 +1,51 @@
+# Micro-benchmark of the psana <-> cheetah tile transforms in psocake.cheetahUtils
+# usage: python benchmarkCheetahUtils.py -n 20
+import time
+import argparse
+import numpy as np
+from psocake import cheetahUtils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--repeat", help="number of transforms to time", default=20, type=int)
+args = parser.parse_args()
+
+def loopPct(detDesc, unassembled):
+    """reference implementation: copy one asic at a time"""
+    counter = 0
+    img = np.zeros(detDesc.tileDim)
+    for quad in range(detDesc.quads.numQuad):
+        for seg in range(detDesc.quads.numAsicsPerQuad):
+            img[seg * detDesc.psanaDim.rows:(seg + 1) * detDesc.psanaDim.rows,
+                quad * detDesc.psanaDim.cols:(quad + 1) * detDesc.psanaDim.cols] = unassembled[counter, :, :]
+            counter += 1
+    return img
+
+def timeit(func, repeat):
+    tic = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - tic) / repeat * 1e3 # ms
+
+for name in ['cspad', 'epix10k2m', 'jungfrau4m', 'rayonix']:
+    detDesc = getattr(cheetahUtils, name)()
+    segs, rows, cols = detDesc.psanaDim
+    calib = np.random.rand(segs, rows, cols).astype(np.float32)
+    tile = np.empty(detDesc.tileDim, dtype=np.float32)
+    unassembled = np.empty_like(calib)
+
+    assert np.array_equal(detDesc.pct(calib), loopPct(detDesc, calib))
+    assert np.array_equal(detDesc.ipct(detDesc.pct(calib, out=tile), out=unassembled), calib)
+    s = np.random.randint(0, segs, 1000)
+    r = np.random.randint(0, rows, 1000)
+    c = np.random.randint(0, cols, 1000)
+    row2d, col2d = detDesc.convert_peaks_to_cheetah(s, r, c)
+    assert np.array_equal(loopPct(detDesc, calib)[row2d, col2d], calib[s, r, c])
+    _s, _r, _c = detDesc.convert_peaks_to_psana(row2d, col2d)
+    assert np.array_equal(_s, s) and np.array_equal(_r, r) and np.array_equal(_c, c)
+
+    print("{:>10s} loop pct: {:7.2f} ms, pct: {:7.2f} ms, pct(out=float32): {:7.2f} ms, ipct(out=float32): {:7.2f} ms".format(
+          name,
+          timeit(lambda: loopPct(detDesc, calib), args.repeat),
+          timeit(lambda: detDesc.pct(calib), args.repeat),
+          timeit(lambda: detDesc.pct(calib, out=tile), args.repeat),
+          timeit(lambda: detDesc.ipct(tile, out=unassembled), args.repeat)))
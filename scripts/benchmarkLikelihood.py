@@ -0,0 +1,59 @@
+# Equivalence check and micro-benchmark of psocake.utils.calculateLikelihood against the
+# all-pairs implementation it replaced, including lattices with more than 8 equally close neighbours
+# usage: python benchmarkLikelihood.py -n 5
+import time
+import argparse
+import numpy as np
+from scipy.spatial import distance
+from psocake.utils import calculateLikelihood
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--repeat", help="number of scores to time", default=5, type=int)
+args = parser.parse_args()
+
+def denseLikelihood(qPeaks):
+    """reference implementation: all-pairs distance matrix"""
+    nPeaks = int(qPeaks.shape[1])
+    selfD = distance.cdist(qPeaks.transpose(), qPeaks.transpose(), 'euclidean')
+    sortedSelfD = np.sort(selfD)
+    closestNeighborDist = sortedSelfD[:, 1]
+    meanClosestNeighborDist = np.median(closestNeighborDist)
+    coords = qPeaks.transpose()
+    pairsFound = 0.
+    for ii in range(nPeaks):
+        index = np.where(selfD[ii, :] == closestNeighborDist[ii])
+        closestPeaks = coords[list(index[0]), :].copy()
+        p = coords[ii, :]
+        flip = 2 * p - closestPeaks
+        d = distance.cdist(coords, flip, 'euclidean')
+        sigma = closestNeighborDist[ii] / 4.
+        pairsFound += np.sum(np.exp(-d ** 2 / (2. * sigma ** 2)))
+    pairsFound = pairsFound / 2.
+    pairsFoundPerSpot = pairsFound / float(nPeaks)
+    return [meanClosestNeighborDist, pairsFoundPerSpot]
+
+def lattice(basis, n, spacing=0.01):
+    """q-vectors of n x n x n unit cells with the given basis, shape (3, nPeaks)"""
+    cells = np.stack(np.meshgrid(*[np.arange(n)] * 3, indexing='ij'), axis=-1).reshape(-1, 1, 3)
+    return ((cells + np.asarray(basis, dtype=float)).reshape(-1, 3) * spacing).T
+
+rng = np.random.default_rng(0)
+cubic = lattice([[0, 0, 0]], 6) # 6 closest neighbours
+fcc = lattice([[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]], 4) # 12 closest neighbours
+bcc = lattice([[0, 0, 0], [0.5, 0.5, 0.5]], 5) # 8 closest neighbours
+cases = [('cubic', cubic), ('fcc', fcc), ('bcc', bcc),
+         ('fcc + noise', fcc + rng.normal(scale=1e-4, size=fcc.shape)),
+         ('random 50', rng.random((3, 50))), ('random 2000', rng.random((3, 2000)))]
+
+for name, qPeaks in cases:
+    ref = denseLikelihood(qPeaks)
+    new = calculateLikelihood(qPeaks)
+    assert np.allclose(new, ref, rtol=1e-9, atol=0), (name, ref, new)
+    tic = time.time()
+    for i in range(args.repeat): denseLikelihood(qPeaks)
+    dense = (time.time() - tic) / args.repeat * 1e3
+    tic = time.time()
+    for i in range(args.repeat): calculateLikelihood(qPeaks)
+    tree = (time.time() - tic) / args.repeat * 1e3
+    print("{:>12s} {:5d} peaks, score {:.4f}: dense {:8.2f} ms, kd-tree {:7.2f} ms".format(
+          name, qPeaks.shape[1], new[1], dense, tree))
@@ -0,0 +1,70 @@
+# Equivalence check and micro-benchmark of psocake.myskbeam.StreakMask.getStreakMaskCalib against
+# getStreakMaskCalibReference, which assembles the whole image, on a synthetic 4-panel detector with a streak
+# usage: python benchmarkStreakMask.py -n 10
+import sys
+import time
+import types
+import argparse
+import importlib.util
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--repeat", help="number of events to check and time", default=10, type=int)
+args = parser.parse_args()
+
+try:
+    found = importlib.util.find_spec('PSCalib') is not None
+except ImportError:
+    found = False
+if not found: # only CFRAME_PSANA is needed
+    sys.modules['PSCalib'] = types.ModuleType('PSCalib')
+    sys.modules['PSCalib.GlobalUtils'] = types.SimpleNamespace(CFRAME_PSANA=0)
+from psocake import myskbeam
+
+# 2x2 panels of 200x220 pixels with gaps between them
+numPanels, rows, cols = 4, 200, 220
+iX = np.zeros((numPanels, rows, cols), dtype=np.int64)
+iY = np.zeros((numPanels, rows, cols), dtype=np.int64)
+for p in range(numPanels):
+    iX[p] = (p // 2) * (rows + 20) + np.arange(rows)[:, None]
+    iY[p] = (p % 2) * (cols + 30) + np.arange(cols)[None, :]
+
+class Detector(object):
+    """assembles through the pixel index maps like psana's det.image"""
+    calibData = None
+    def calib(self, evt):
+        return self.calibData
+    def image(self, evt, nda=None):
+        img = np.zeros((iX.max() + 1, iY.max() + 1))
+        img[iX, iY] = self.calibData if nda is None else nda
+        return img
+    def point_indexes(self, evt, **kwargs):
+        return 230, 250
+
+rng = np.random.default_rng(0)
+det = Detector()
+background = rng.normal(10, 3, iX.shape).clip(0)
+streak = np.zeros(iX.shape)
+for c in range(iY.max() + 1): # two pixel wide sloped streak through the beam centre
+    r = 230 + int(0.3 * (c - 250))
+    streak[((iX == r) | (iX == r + 1)) & (iY == c)] = 200.
+det.calibData = background
+streakMask = myskbeam.StreakMask(det, None, width=300, sigma=1)
+
+numMasked = []
+fast = reference = 0.
+for i in range(args.repeat):
+    # alternate events with and without the streak, so pixels masked by the previous event are reset
+    calib = background + rng.normal(0, 1, iX.shape).clip(0) + (streak if i % 2 == 0 else 0)
+    det.calibData = calib
+    tic = time.time()
+    ref = streakMask.getStreakMaskCalibReference(None, calib)
+    reference += time.time() - tic
+    tic = time.time()
+    new = streakMask.getStreakMaskCalib(None, calib)
+    fast += time.time() - tic
+    assert new.shape == ref.shape and np.array_equal(new, ref), (i, np.count_nonzero(new != ref))
+    numMasked.append(int(np.count_nonzero(new == 0)))
+assert max(numMasked) > 0, "no streak was masked"
+print("{} events, masked pixels {}..{}: reference {:.2f} ms, getStreakMaskCalib {:.2f} ms".format(
+      args.repeat, min(numMasked), max(numMasked), reference / args.repeat * 1e3, fast / args.repeat * 1e3))
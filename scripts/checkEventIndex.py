@@ -0,0 +1,130 @@
+# Equivalence check of psocake.utils.EventIndex and psanaWhisperer.getPsanaEvent against the linear scans over
+# run.times() they replaced, on a synthetic run with duplicate timestamps, repeated and missing fiducials and
+# cheetah file names from the wrong hour. LCLS packages that are not installed are replaced by empty stand-ins.
+# usage: python checkEventIndex.py -n 20000
+import sys
+import time
+import types
+import argparse
+import importlib.util
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--noe", help="number of events in the synthetic run", default=20000, type=int)
+args = parser.parse_args()
+
+def standIn(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+for name in ['psana', 'PSCalib', 'PSCalib.GlobalUtils', 'PSCalib.GeometryAccess', 'pyimgalgos',
+             'pyimgalgos.RadialBkgd', 'Detector', 'Detector.PyDetector']:
+    try:
+        found = importlib.util.find_spec(name) is not None
+    except ImportError: # parent is a stand-in
+        found = False
+    if not found: sys.modules[name] = standIn(name, GeometryAccess=None, RadialBkgd=None, polarization_factor=None)
+
+from psocake import utils, cheetahUtils
+sys.modules.setdefault('utils', utils) # psanaWhisperer imports its siblings by plain name
+sys.modules.setdefault('cheetahUtils', cheetahUtils)
+from psocake.psanaWhisperer import psanaWhisperer
+from psocake.utils import EventIndex
+
+class EventTime(object):
+    def __init__(self, sec, nsec, fid):
+        self.sec, self.nsec, self.fid = int(sec), int(nsec), int(fid)
+    def seconds(self):
+        return self.sec
+    def nanoseconds(self):
+        return self.nsec
+    def fiducial(self):
+        return self.fid
+
+class Run(object):
+    def event(self, t):
+        return ('evt', t)
+
+# 120 Hz over a few hours, with bursts of events sharing a timestamp and fiducials that repeat as the
+# 17 bit counter wraps around
+rng = np.random.default_rng(0)
+sec = 1437955200 + np.sort(rng.integers(0, 4 * 3600, args.noe))
+nsec = rng.integers(0, 10, args.noe) * 100000000 # few distinct values, so timestamps repeat
+fid = rng.integers(0, 2 ** 17, args.noe)
+fid[rng.integers(0, args.noe, args.noe // 20)] = fid[0] # one fiducial seen many times
+times = [EventTime(*x) for x in zip(sec, nsec, fid)]
+
+def linearFind(sec, nsec, fid=None):
+    """first event number with this timestamp and fiducial"""
+    for i, t in enumerate(times):
+        if t.seconds() == sec and t.nanoseconds() == nsec and (fid is None or t.fiducial() == fid):
+            return i
+    return None
+
+def linearGetPsanaEvent(whisperer, cheetahFilename):
+    """psanaWhisperer.getPsanaEvent before the index"""
+    hrsMinSec = cheetahFilename.split('_')[-2]
+    fid = int(cheetahFilename.split('_')[-1].split('.')[0], 16)
+    for t in whisperer.times:
+        if t.fiducial() == fid:
+            localtime = time.strftime('%H:%M:%S', time.localtime(t.seconds()))
+            localtime = localtime.replace(':', '')
+            if localtime[0:3] == hrsMinSec[0:3]:
+                whisperer.evt = whisperer.run.event(t)
+            else:
+                whisperer.evt = None
+
+def cheetahFilename(t, hourOffset=0):
+    hrsMinSec = time.strftime('%H%M%S', time.localtime(t.seconds() + hourOffset * 3600))
+    return 'LCLS_2015_Jul26_r0014_' + hrsMinSec + '_' + format(t.fiducial(), 'x') + '.h5'
+
+index = EventIndex.fromTimes(times)
+assert index.find(sec[0], nsec[0], fid[0]) == 0
+
+# lookups by timestamp: every event of a sample, with the right fiducial, a wrong one and none
+sample = rng.choice(args.noe, 200, replace=False)
+numChecked = 0
+for i in sample:
+    t = times[i]
+    for f in [t.fiducial(), t.fiducial() + 1, None]:
+        assert index.find(t.seconds(), t.nanoseconds(), f) == linearFind(t.seconds(), t.nanoseconds(), f), (i, f)
+        numChecked += 1
+# timestamps that are not in the run
+for s, ns in [(sec[0] - 1, 0), (sec[-1] + 1, 0), (sec[args.noe // 2], 5)]:
+    assert index.find(s, ns) is None and linearFind(s, ns) is None
+assert any(linearFind(times[i].seconds(), times[i].nanoseconds()) != i for i in range(args.noe)), \
+    "no duplicate timestamps in the synthetic run"
+
+# lookups by cheetah file name: last event with the fiducial decides, wrong hour gives None,
+# a fiducial that is not in the run leaves the current event as it is
+whisperer = psanaWhisperer.__new__(psanaWhisperer)
+whisperer.run = Run()
+whisperer.times = times
+whisperer.eventIndex = None
+reference = psanaWhisperer.__new__(psanaWhisperer)
+reference.run = Run()
+reference.times = times
+missingFid = next(f for f in range(2 ** 17) if f not in set(fid.tolist()))
+names = [cheetahFilename(times[i], hourOffset) for i in list(sample[:50]) + [0] for hourOffset in [0, 1]] + \
+        [cheetahFilename(EventTime(sec[0], 0, missingFid))]
+outcomes = set()
+for name in names:
+    whisperer.evt = reference.evt = 'previous'
+    whisperer.getPsanaEvent(name)
+    linearGetPsanaEvent(reference, name)
+    assert whisperer.evt == reference.evt, (name, whisperer.evt, reference.evt)
+    outcomes.add('previous' if whisperer.evt == 'previous' else 'none' if whisperer.evt is None else 'event')
+assert outcomes == {'previous', 'none', 'event'}
+
+tic = time.time()
+EventIndex.fromTimes(times)
+build = (time.time() - tic) * 1e3
+tic = time.time()
+for i in sample: index.find(sec[i], nsec[i], fid[i])
+indexed = (time.time() - tic) / len(sample) * 1e6
+tic = time.time()
+for i in sample[:20]: linearFind(sec[i], nsec[i], fid[i])
+linear = (time.time() - tic) / 20 * 1e6
+print("{} events, {} timestamp and {} file name lookups match the linear scans".format(args.noe, numChecked, len(names)))
+print("build {:.1f} ms, find {:.1f} us, linear scan {:.1f} us".format(build, indexed, linear))
@@ -0,0 +1,99 @@
+# Check that PeakFinder reuses the DataSource, run and detector of its caller (ds=, psanaRun=, times=) instead of
+# opening the run again. psana is replaced by a mock whose DataSource takes --openTime seconds and holds --numFiles
+# file handles, like parsing the xtc index and opening the chunk files. LCLS packages that are not installed are
+# replaced by empty stand-ins, PeakFinder's constructor only needs their names.
+# usage: python checkPeakFinderSetup.py
+import os
+import sys
+import time
+import types
+import argparse
+import importlib.util
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--openTime", help="seconds the mock DataSource takes to open a run", default=0.3, type=float)
+parser.add_argument("--numFiles", help="file handles held by the mock run", default=8, type=int)
+args = parser.parse_args()
+
+opened = [] # every mock DataSource and Detector
+
+class MockRun(object):
+    def __init__(self):
+        self.files = [open(os.devnull) for i in range(args.numFiles)] # xtc chunks
+    def times(self):
+        return list(range(1000))
+    def event(self, t):
+        return ('evt', t)
+
+class MockDataSource(object):
+    def __init__(self, access):
+        time.sleep(args.openTime) # xtc index
+        self.run = MockRun()
+        opened.append(self)
+    def runs(self):
+        yield self.run
+    def env(self):
+        return 'env'
+
+class MockDetector(object):
+    def __init__(self, name, env=None):
+        opened.append(self)
+    def do_reshape_2d_to_3d(self, flag):
+        pass
+    def calib(self, evt):
+        return None # no streak mask
+    def mask(self, run, **kwargs):
+        return np.ones((2, 4, 4), dtype=np.int16)
+    def indexes_x(self, evt):
+        return np.zeros((2, 4, 4))
+    def indexes_y(self, evt):
+        return np.zeros((2, 4, 4))
+    def point_indexes(self, evt, **kwargs):
+        return 1, 1
+
+def standIn(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+sys.modules['psana'] = standIn('psana', DataSource=MockDataSource, Detector=MockDetector)
+for name, attrs in [('PSCalib', {}), ('PSCalib.GlobalUtils', dict(CFRAME_PSANA=0)),
+                    ('psalgos', {}), ('psalgos.pypsalgos', dict(PyAlgos=lambda **kwargs: types.SimpleNamespace(
+                        set_peak_selection_pars=lambda **kwargs: None))),
+                    ('pyimgalgos', {}), ('pyimgalgos.RadialBkgd', dict(RadialBkgd=None, polarization_factor=None)),
+                    ('pyimgalgos.MedianFilter', dict(median_filter_ndarr=None))]:
+    try:
+        found = importlib.util.find_spec(name) is not None
+    except ImportError: # parent is a stand-in
+        found = False
+    if not found: sys.modules[name] = standIn(name, **attrs)
+
+from psocake import PeakFinder as pf
+
+def numFds():
+    return len(os.listdir('/proc/self/fd'))
+
+ds = MockDataSource('exp=cxitut13:run=10:idx')
+run = next(ds.runs())
+times = run.times()
+det = MockDetector('DscCsPad')
+evt = run.event(times[0])
+params = ('cxitut13', 10, 'DscCsPad', evt, det, 1, 2, 30, 300, 600, 10,
+          'False', 0, 0, None, 'True', 'True', 'True', 'True', 'True', 'True', 'True')
+kwargs = dict(alg1_thr_low=0, alg1_thr_high=0, alg1_rank=3, alg1_radius=3, alg1_dr=1, access='ana')
+
+results = {}
+for label, handles in [('own DataSource', {}), ('caller handles', dict(ds=ds, psanaRun=run, times=times))]:
+    fds, numOpened, tic = numFds(), len(opened), time.time()
+    peakFinder = pf.PeakFinder(*params, **dict(kwargs, **handles))
+    results[label] = (time.time() - tic, numFds() - fds, len(opened) - numOpened, peakFinder)
+    print("{:>15s}: constructor {:.3f} s, +{} fds, +{} psana handles".format(label, *results[label][:3]))
+
+elapsed, fds, numOpened, peakFinder = results['caller handles']
+assert numOpened == 0 and fds == 0, "PeakFinder opened the run again"
+assert elapsed < args.openTime
+assert peakFinder.ds is ds and peakFinder.run is run and peakFinder.det is det and peakFinder.evt is evt
+assert peakFinder.eventTotal == len(times)
+assert results['own DataSource'][2] == 2 # the mock is in effect: DataSource and Detector
+print("OK")
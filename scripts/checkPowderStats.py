@@ -0,0 +1,50 @@
+# Check of psocake.utils.PowderStats (Welford update, Chan merge in an MPI reduction) against a long-double
+# two-pass reference on synthetic events. The result must not depend on the number of ranks, run it with each:
+# usage: mpirun -n 1 python checkPowderStats.py; mpirun -n 4 python checkPowderStats.py; mpirun -n 16 python checkPowderStats.py
+import argparse
+import numpy as np
+from mpi4py import MPI
+from psocake.utils import PowderStats
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--noe", help="number of synthetic events", default=500, type=int)
+parser.add_argument("--float32", help="accumulate in float32", action='store_true')
+args = parser.parse_args()
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+size = comm.Get_size()
+
+# bright pixels with a small spread, where sum of squares minus mean squared cancels
+shape = (2, 8, 16)
+rng = np.random.default_rng(0)
+events = 1e5 + rng.normal(scale=1., size=(args.noe,) + shape)
+dtype = np.float32 if args.float32 else np.float64
+
+stats = PowderStats(dtype)
+for i in np.array_split(np.arange(args.noe), size)[rank]: # ranks beyond noe get no events
+    stats.update(events[i].astype(dtype))
+assert stats.reduce(comm)
+
+# a single event on the last rank, every other rank takes part with an empty buffer
+empty = PowderStats(dtype)
+if rank == size - 1: empty.update(events[-1].astype(dtype))
+assert empty.reduce(comm)
+
+# no events on any rank
+assert not PowderStats(dtype).reduce(comm)
+
+if rank == 0:
+    ref = events.astype(np.longdouble)
+    mean = ref.mean(axis=0)
+    std = np.sqrt(((ref - mean) ** 2).mean(axis=0))
+    rtol = (1e-5, 1e-1) if args.float32 else (1e-12, 1e-9) # mean, std; float32 rounds 1e5 to 0.008
+    assert stats.totevent == args.noe
+    assert np.allclose(stats.mean, mean, rtol=rtol[0], atol=0), np.abs(stats.mean - mean).max()
+    assert np.allclose(stats.stddev, std, rtol=rtol[1], atol=0), np.abs(stats.stddev - std).max()
+    assert np.array_equal(stats.maximum, events.astype(dtype).max(axis=0))
+    assert np.array_equal(stats.minimum, events.astype(dtype).min(axis=0))
+    assert empty.totevent == 1 and np.array_equal(empty.mean, events[-1].astype(dtype))
+    assert np.all(empty.stddev == 0)
+    print("{} ranks, {} events: max std error {:.2e}, max mean error {:.2e}".format(
+          size, args.noe, float(np.abs(stats.stddev - std).max()), float(np.abs(stats.mean - mean).max())))
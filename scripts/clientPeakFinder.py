@@ -4,7 +4,6 @@ import numpy as np
 from psalgos.pypsalgos import PyAlgos
 from ImgAlgos.PyAlgos import PyAlgos as PA
 from scipy.spatial.distance import cdist
-from scipy.spatial import distance
 import time
 import json
 import base64
@@ -23,6 +22,7 @@ from skimage import morphology
 from peaknet_utils import json_parser, psanaRun, nEvents
 import pandas
 import Utils
+from psocake.utils import calculateLikelihood
 
 import torch
 
@@ -116,31 +116,9 @@ class clientPeakFinder(clientAbstract.clientAbstract):
         """ Calculate the likelihood that an event is a crystal
     
         Arguments:
-        qPeaks -- 
+        qPeaks -- q-vectors of the peaks, shape (3, nPeaks)
         """
-        nPeaks = int(qPeaks.shape[1])
-        selfD = distance.cdist(qPeaks.transpose(), qPeaks.transpose(), 'euclidean')
-        sortedSelfD = np.sort(selfD)
-        closestNeighborDist = sortedSelfD[:, 1]
-        meanClosestNeighborDist = np.median(closestNeighborDist)
-        closestPeaks = [None] * nPeaks
-        coords = qPeaks.transpose()
-        pairsFound = 0.
-        for ii in range(nPeaks):
-            index = np.where(selfD[ii, :] == closestNeighborDist[ii])
-            closestPeaks[ii] = coords[list(index[0]), :].copy()
-            p = coords[ii, :]
-            flip = 2 * p - closestPeaks[ii]
-            d = distance.cdist(coords, flip, 'euclidean')
-            sigma = closestNeighborDist[ii] / 4.
-            mu = 0.
-            bins = d
-            vals = np.exp(-(bins - mu) ** 2 / (2. * sigma ** 2))
-            weight = np.sum(vals)
-            pairsFound += weight
-        pairsFound = pairsFound / 2.
-        pairsFoundPerSpot = pairsFound / float(nPeaks)
-        return [meanClosestNeighborDist, pairsFoundPerSpot]
+        return calculateLikelihood(qPeaks)
 
 
     def getPeaks(self, d, alg, hdr, fmt, mask, times, env, run, j):
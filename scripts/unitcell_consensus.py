@@ -1,9 +1,8 @@
 import sys
-sys.path.append("/reg/neh/home/yoon82/Software/autosfx/scripts")
 import os
 import numpy as np
 import subprocess
-import evaluateIndexing as ei 
+from psocake.utils import StreamIndex
 import sys
 import argparse
 from cctbx import uctbx
@@ -116,8 +115,11 @@ unique_unitcell[3], unique_unitcell[4], unique_unitcell[5], spacegroup)
 #out = out.split('\n')
 #streamfile = out[0]
 
-numIndex, numHits, indexHistogram, bravais = ei.getIndexHistogram(streamfile)
-lattice = indexHistogram[:,9:15].copy() 
+streamIndex = StreamIndex(streamfile) # reused on later runs until the stream changes
+indexed = np.array(streamIndex.entries[streamIndex.entries['indexed']])
+numIndex, numHits = len(indexed), len(streamIndex)
+lattice = indexed['cell'].astype(float) # a b c (Angstrom) al be ga (deg)
+bravais = [[x.decode() for x in indexed[k]] for k in ('latticeType', 'centering', 'uniqueAxis')]
 
 #spacegroup = "P1"
 #for i in range(numIndex):